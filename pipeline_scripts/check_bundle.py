@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import os
+import sys
+
+import google_crc32c
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def process_args():
+    parser = argparse.ArgumentParser(
+        description="Check the unpacked files of a reference bundle "
+        "against the bundle manifest"
+    )
+    parser.add_argument("manifest", help="The bundle manifest.json")
+    parser.add_argument(
+        "files_dir", nargs="?", help="The directory of unpacked files"
+    )
+    parser.add_argument(
+        "--parts",
+        default="bundle",
+        help="The unpacked parts of the bundle to check (comma-separated)",
+    )
+    parser.add_argument(
+        "--list_parts",
+        action="store_true",
+        help="Print the parts of the bundle instead, one per line",
+    )
+    return parser.parse_args()
+
+
+def bundled_path(files_dir, gs_path):
+    return os.path.join(files_dir, gs_path[len("gs://") :])
+
+
+def file_crc32c(path):
+    """The CRC32C of a file, encoded as in Cloud Storage object metadata"""
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+def main(args):
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    if args.list_parts:
+        for part in sorted(manifest["parts"]):
+            print(part)
+        return 0
+    parts = args.parts.split(",")
+    entries = [x for x in manifest["files"] if x["part"] in parts]
+    errors = 0
+    for entry in entries:
+        local_path = bundled_path(args.files_dir, entry["path"])
+        if not os.path.isfile(local_path):
+            print("Missing from the bundle: " + entry["path"])
+            errors += 1
+        elif os.path.getsize(local_path) != entry["size"]:
+            print(
+                "Unexpected size of {}: {} bytes, expected {}".format(
+                    entry["path"], os.path.getsize(local_path), entry["size"]
+                )
+            )
+            errors += 1
+        else:
+            crc32c = file_crc32c(local_path)
+            if crc32c != entry["crc32c"]:
+                print(
+                    "Unexpected CRC32C of {}: {}, expected {}".format(
+                        entry["path"], crc32c, entry["crc32c"]
+                    )
+                )
+                errors += 1
+    print(
+        "Checked {} bundled files, {} errors".format(len(entries), errors)
+    )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(process_args()))
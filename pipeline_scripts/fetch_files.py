@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import base64
+import hashlib
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+storage_url = "https://storage.googleapis.com/storage/v1/b/{}/o/{}"
+token_url = (
+    "http://metadata.google.internal/computeMetadata/v1/instance/"
+    "service-accounts/default/token"
+)
+headers = {"Metadata-Flavor": "Google"}
+block_size = 8 * 1024 * 1024
+
+
+def process_args():
+    parser = argparse.ArgumentParser(
+        description="Download many files concurrently, reading large "
+        "objects in slices, and verify their checksums"
+    )
+    parser.add_argument(
+        "manifest",
+        help="A file of tab-separated source and destination paths, one "
+        "transfer per line",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=16, help="Concurrent slice downloads"
+    )
+    parser.add_argument(
+        "--slice_size",
+        type=int,
+        default=128,
+        help="Download objects larger than this many MiB in slices",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Attempts for each slice and object before failing",
+    )
+    parser.add_argument(
+        "--requester_project", help="A project to bill for the downloads"
+    )
+    parser.add_argument(
+        "--local_root",
+        help="Read gs://bucket/object from local_root/bucket/object "
+        "instead of Google Cloud Storage",
+    )
+    return parser.parse_args()
+
+
+def split_gs_path(gs_path):
+    bucket, _, name = gs_path[len("gs://") :].partition("/")
+    return bucket, name
+
+
+class Checksum(object):
+    """The strongest checksum available for an object"""
+
+    def __init__(self, crc32c=None, md5=None):
+        self.kind, self.expected, self.hasher = None, None, None
+        hasher = crc32c_hasher() if crc32c else None
+        if hasher:
+            self.kind, self.expected, self.hasher = "crc32c", crc32c, hasher
+        elif md5:
+            self.kind, self.expected, self.hasher = "md5", md5, hashlib.md5
+
+    def verify(self, path):
+        if not self.kind:
+            return True
+        hasher = self.hasher()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                hasher.update(block)
+        return base64.b64encode(hasher.digest()).decode() == self.expected
+
+
+def crc32c_hasher():
+    """A hashlib-style crc32c constructor, or None if only slow ones exist"""
+    try:
+        import google_crc32c
+
+        if google_crc32c.implementation == "c":
+            return google_crc32c.Checksum
+    except ImportError:
+        pass
+    try:
+        import crcmod.predefined
+
+        if crcmod._usingExtension:
+            return lambda: crcmod.predefined.Crc("crc-32c")
+    except ImportError:
+        pass
+    return None
+
+
+class GcsSource(object):
+    """Objects read through the Cloud Storage JSON API"""
+
+    def __init__(self, requester_project=None, threads=16):
+        import requests
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=threads, pool_maxsize=threads
+        )
+        self.session.mount("https://", adapter)
+        self.requester_project = requester_project
+        self.lock = threading.Lock()
+        self.token, self.token_expiry = None, 0
+
+    def _headers(self, extra=None):
+        with self.lock:
+            if time.time() > self.token_expiry - 300:
+                response = self.session.get(token_url, headers=headers)
+                response.raise_for_status()
+                token = response.json()
+                self.token = token["access_token"]
+                self.token_expiry = time.time() + token["expires_in"]
+        out = {"Authorization": "Bearer " + self.token}
+        out.update(extra or {})
+        return out
+
+    def _params(self, params):
+        if self.requester_project:
+            params["userProject"] = self.requester_project
+        return params
+
+    def stat(self, src):
+        bucket, name = split_gs_path(src)
+        response = self.session.get(
+            storage_url.format(bucket, quote(name, safe="")),
+            headers=self._headers(),
+            params=self._params({"fields": "size,generation,crc32c,md5Hash"}),
+            timeout=60,
+        )
+        response.raise_for_status()
+        meta = response.json()
+        return {
+            "size": int(meta["size"]),
+            "generation": meta["generation"],
+            "crc32c": meta.get("crc32c"),
+            "md5": meta.get("md5Hash"),
+        }
+
+    def read(self, src, stat, start, end, out):
+        """Write bytes [start, end) of an object to a file object"""
+        bucket, name = split_gs_path(src)
+        params = {"alt": "media", "generation": stat["generation"]}
+        response = self.session.get(
+            storage_url.format(bucket, quote(name, safe="")),
+            headers=self._headers(
+                {"Range": "bytes={}-{}".format(start, end - 1)}
+            ),
+            params=self._params(params),
+            stream=True,
+            timeout=300,
+        )
+        response.raise_for_status()
+        written = 0
+        # Keep the stored bytes of gzip-encoded objects
+        for block in response.raw.stream(block_size, decode_content=False):
+            out.write(block)
+            written += len(block)
+        if written != end - start:
+            raise IOError(
+                "Short read of {}: {} of {} bytes".format(
+                    src, written, end - start
+                )
+            )
+
+
+class LocalSource(object):
+    """Objects read from a local directory standing in for the buckets"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, src):
+        return os.path.join(self.root, *split_gs_path(src))
+
+    def stat(self, src):
+        path = self._path(src)
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                md5.update(block)
+        return {
+            "size": os.path.getsize(path),
+            "generation": None,
+            "crc32c": None,
+            "md5": base64.b64encode(md5.digest()).decode(),
+        }
+
+    def read(self, src, stat, start, end, out):
+        with open(self._path(src), "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    raise IOError("Short read of " + src)
+                out.write(block)
+                remaining -= len(block)
+
+
+class Transfer(object):
+    """One object download, split into byte ranges"""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.stat = None
+        self.slices = []
+        self.failed = False
+        self.start = None
+        self.end = None
+
+
+def retryable(err):
+    """Missing objects and denied requests will not succeed on a retry"""
+    response = getattr(err, "response", None)
+    if getattr(response, "status_code", None) in (401, 403, 404):
+        return False
+    return not isinstance(err, (IOError, OSError)) or err.errno != 2
+
+
+def with_retries(fun, retries, what):
+    for attempt in range(retries):
+        try:
+            return fun()
+        except Exception as err:  # Catch all exceptions
+            if attempt + 1 == retries or not retryable(err):
+                raise
+            delay = min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+            print(
+                "Retrying {} in {:.0f}s: {}".format(what, delay, err),
+                file=sys.stderr,
+            )
+            time.sleep(delay)
+
+
+class Fetcher(object):
+    def __init__(self, source, threads=16, slice_size=128, retries=5):
+        self.source = source
+        self.threads = threads
+        self.slice_size = slice_size * 1024 * 1024
+        self.retries = retries
+
+    def _stat(self, transfer):
+        try:
+            transfer.stat = with_retries(
+                lambda: self.source.stat(transfer.src),
+                self.retries,
+                "stat of " + transfer.src,
+            )
+        except Exception as err:  # Catch all exceptions
+            print("Cannot find {}: {}".format(transfer.src, err))
+            transfer.failed = True
+
+    def _prepare(self, transfer):
+        """Create the destination file and split the object into slices"""
+        dst_dir = os.path.dirname(os.path.abspath(transfer.dst))
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        size = transfer.stat["size"]
+        with open(transfer.dst, "wb") as f:
+            f.truncate(size)
+        transfer.start, transfer.end = None, None
+        starts = list(range(0, size, self.slice_size)) or [0]
+        transfer.slices = [
+            (start, min(size, start + self.slice_size)) for start in starts
+        ]
+
+    def _read_slice(self, item):
+        transfer, (start, end) = item
+        if transfer.failed:
+            return
+        if transfer.start is None:
+            transfer.start = time.time()
+
+        def read():
+            with open(transfer.dst, "r+b") as out:
+                out.seek(start)
+                if end > start:
+                    self.source.read(
+                        transfer.src, transfer.stat, start, end, out
+                    )
+
+        try:
+            with_retries(
+                read,
+                self.retries,
+                "bytes {}-{} of {}".format(start, end, transfer.src),
+            )
+        except Exception as err:  # Catch all exceptions
+            print("Failed to download {}: {}".format(transfer.src, err))
+            transfer.failed = True
+        transfer.end = max(transfer.end or 0, time.time())
+
+    def _download(self, transfers):
+        items = [(x, s) for x in transfers for s in x.slices]
+        # Interleave the slices of different files so that small files
+        # are not stuck behind the slices of a large one
+        items.sort(key=lambda x: x[1][0])
+        pool = ThreadPool(max(1, min(self.threads, len(items))))
+        try:
+            pool.map(self._read_slice, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, transfers):
+        """Download all transfers, returning the number that failed"""
+        pool = ThreadPool(max(1, min(self.threads, len(transfers))))
+        try:
+            pool.map(self._stat, transfers)
+        finally:
+            pool.close()
+            pool.join()
+        todo = [x for x in transfers if not x.failed]
+        for attempt in range(self.retries):
+            for transfer in todo:
+                self._prepare(transfer)
+            self._download(todo)
+            retry = []
+            for transfer in todo:
+                checksum = Checksum(
+                    transfer.stat["crc32c"], transfer.stat["md5"]
+                )
+                if transfer.failed:
+                    continue
+                if not checksum.verify(transfer.dst):
+                    print(
+                        "{} checksum mismatch for {}".format(
+                            checksum.kind, transfer.src
+                        )
+                    )
+                    retry.append(transfer)
+                    continue
+                report(transfer, checksum.kind)
+            if retry and attempt + 1 == self.retries:
+                for transfer in retry:
+                    transfer.failed = True
+            todo = retry
+            if not todo:
+                break
+        return sum(1 for x in transfers if x.failed)
+
+
+def report(transfer, checksum_kind):
+    size = transfer.stat["size"]
+    elapsed = max(1e-6, (transfer.end or time.time()) - transfer.start)
+    print(
+        "Transferred {} to {}: {} bytes in {:.1f}s ({:.1f} MB/s, {} "
+        "slices, {} verified)".format(
+            transfer.src,
+            transfer.dst,
+            size,
+            elapsed,
+            size / elapsed / 1e6,
+            len(transfer.slices),
+            checksum_kind or "size",
+        )
+    )
+
+
+def read_manifest(path):
+    transfers = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            src, dst = line.split("\t")
+            transfers.append(Transfer(src, dst))
+    return transfers
+
+
+def main(args):
+    transfers = read_manifest(args.manifest)
+    local = [x for x in transfers if not x.src.startswith("gs://")]
+    remote = [x for x in transfers if x.src.startswith("gs://")]
+    for transfer in local:
+        shutil.copyfile(transfer.src, transfer.dst)
+    if not remote:
+        return 0
+    if args.local_root:
+        source = LocalSource(args.local_root)
+    else:
+        source = GcsSource(args.requester_project, args.threads)
+    start = time.time()
+    fetcher = Fetcher(source, args.threads, args.slice_size, args.retries)
+    failed = fetcher.fetch(remote)
+    elapsed = max(1e-6, time.time() - start)
+    total = sum(x.stat["size"] for x in remote if x.stat and not x.failed)
+    print(
+        "Transferred {} files, {} bytes in {:.1f}s ({:.1f} MB/s), "
+        "{} failed".format(
+            len(remote) - failed, total, elapsed, total / elapsed / 1e6, failed
+        )
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(process_args()))
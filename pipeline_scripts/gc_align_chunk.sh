@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=$(nproc)
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(FQ1 FQ2 OUTPUT_BUCKET REF READGROUP CHUNK_PART \
+    CHUNK_PIPELINE STREAM_INPUT PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION \
+    REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE)
+unset_none_variables ${environmental_variables[@]}
+
+readonly FQ1 FQ2 OUTPUT_BUCKET REF READGROUP CHUNK_PART CHUNK_PIPELINE \
+    STREAM_INPUT PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION \
+    REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE
+
+release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
+
+# Basic error handling #
+if [[ -z "$FQ1" ]]; then
+    echo "Chunked alignment requires FQ1"
+    exit 1
+fi
+
+# The aligner settings of the pipeline that processes the chunks
+if [[ "$CHUNK_PIPELINE" == "CCDG" ]]; then
+    bwa_xargs="-K 100000000 -Y"
+    run_samblaster="true"
+else
+    bwa_xargs="-M -K 10000000"
+    run_samblaster="false"
+fi
+
+# **********************************
+# 0. Setup
+# **********************************
+gc_setup
+export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
+export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
+
+download_reference
+
+# ******************************************
+# 1. Mapping reads with BWA-MEM, sorting
+# ******************************************
+chunk_name=$(basename "$OUTPUT_BUCKET")
+bwa_mem_align "${chunk_name}-" "$FQ1" "$FQ2" "$READGROUP" local_bams bam "$bwa_xargs" "" "$run_samblaster" "$CHUNK_PART"
+
+for bam in "${local_bams[@]}"; do
+    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp "$bam" "$bam".bai "$OUTPUT_BUCKET/"
+done
+exit 0
@@ -0,0 +1,49 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(REFERENCE_BUNDLE BUNDLE_FILES BUNDLE_BWA_FILES \
+    PIPELINE REQUESTER_PROJECT)
+unset_none_variables ${environmental_variables[@]}
+
+readonly REFERENCE_BUNDLE BUNDLE_FILES BUNDLE_BWA_FILES PIPELINE \
+    REQUESTER_PROJECT
+
+# Basic error handling #
+if [[ -z "$REFERENCE_BUNDLE" || -z "$BUNDLE_FILES" ]]; then
+    echo "Please supply the REFERENCE_BUNDLE and the BUNDLE_FILES to pack"
+    exit 1
+fi
+
+# ******************************************
+# 1. Download the files, keeping their paths
+# ******************************************
+## The BWA index is packed into its own part, so that only jobs aligning
+## FASTQ download it
+bundle_transfers=$(mktemp)
+IFS=',' read -r -a bundle_files <<< "$BUNDLE_FILES"
+for src_file in "${bundle_files[@]}"; do
+    add_transfer "$bundle_transfers" "$src_file" "$scratch/bundle/files/${src_file#gs://}"
+done
+IFS=',' read -r -a bwa_files <<< "$BUNDLE_BWA_FILES"
+for src_file in "${bwa_files[@]}"; do
+    add_transfer "$bundle_transfers" "$src_file" "$scratch/bwa/files/${src_file#gs://}"
+done
+transfer_many "$bundle_transfers"
+
+# ******************************************
+# 2. Pack and upload the parts of the bundle
+# ******************************************
+run "tar -cf $scratch/bundle.tar -C $scratch/bundle files" "Packing the reference bundle"
+transfer $scratch/bundle.tar "$REFERENCE_BUNDLE/bundle.tar"
+if [[ -n "$BUNDLE_BWA_FILES" ]]; then
+    run "tar -cf $scratch/bwa.tar -C $scratch/bwa files" "Packing the BWA index"
+    transfer $scratch/bwa.tar "$REFERENCE_BUNDLE/bwa.tar"
+fi
+exit 0
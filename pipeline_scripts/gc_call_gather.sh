@@ -0,0 +1,92 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=$(nproc)
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(SHARD_OUTPUTS OUTPUT_BUCKET REF GVCF_OUTPUT \
+    PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION DNASCOPE_MODEL \
+    CALLING_ALGO REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE)
+unset_none_variables ${environmental_variables[@]}
+
+readonly SHARD_OUTPUTS OUTPUT_BUCKET REF GVCF_OUTPUT PIPELINE SENTIEON_KEY \
+    EMAIL SENTIEON_VERSION DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT \
+    REFERENCE_BUNDLE ARTIFACT_CACHE
+
+release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
+
+# Basic error handling #
+if [[ -z "$SHARD_OUTPUTS" ]]; then
+    echo "Please supply the SHARD_OUTPUTS to merge"
+    exit 1
+fi
+
+# **********************************
+# 0. Setup
+# **********************************
+gc_setup
+export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
+export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
+
+## Download input files
+download_reference
+if [[ $CALLING_ALGO == "DNAscope" && -n "$DNASCOPE_MODEL" ]]; then
+    fetch_artifact "$DNASCOPE_MODEL" ${input_dir}/dnascope.model
+fi
+
+# Shards are merged in the order they are supplied (reference order)
+IFS=',' read -r -a shard_outputs <<< "$SHARD_OUTPUTS"
+local_shards=()
+shard_transfers=$(mktemp)
+for i in "${!shard_outputs[@]}"; do
+    local_shard=$input_dir/shard-${i}.$(basename "${shard_outputs[$i]}")
+    add_transfer "$shard_transfers" "${shard_outputs[$i]}" "$local_shard"
+    add_transfer "$shard_transfers" "${shard_outputs[$i]}".tbi "${local_shard}".tbi
+    local_shards+=("$local_shard")
+done
+transfer_many "$shard_transfers"
+
+# ******************************************
+# 1. Merge the shards
+# ******************************************
+algo=Haplotyper
+outvcf=$work/hc.vcf.gz
+outgvcf=$work/hc.g.vcf.gz
+if [[ $CALLING_ALGO == "DNAscope" ]]; then
+    algo="DNAscope"
+    outvcf=$work/dnascope.vcf.gz
+    outgvcf=$work/dnascope.g.vcf.gz
+    tmpvcf=$work/tmp.vcf.gz
+fi
+
+if [[ -n "$GVCF_OUTPUT" ]]; then
+    outfile=$outgvcf
+else
+    outfile=$outvcf
+fi
+cmd="$release_dir/bin/sentieon driver --passthru -t $nt --algo $algo --merge $outfile ${local_shards[@]}"
+run "$cmd" "Merge shards"
+
+# DNAscope SV calling
+if [[ $CALLING_ALGO == "DNAscope" && -z "$GVCF_OUTPUT" && -z "$DNASCOPE_MODEL" ]]; then
+    mv $outvcf $tmpvcf
+    mv ${outvcf}.tbi ${tmpvcf}.tbi
+    cmd="$release_dir/bin/sentieon driver -t $nt -r \"$ref\" --algo SVSolver -v $tmpvcf $outvcf"
+    run "$cmd" "SVSolver"
+fi
+
+# DNAscope model apply
+if [[ $CALLING_ALGO == "DNAscope" && -z "$GVCF_OUTPUT" && -n "$DNASCOPE_MODEL" ]]; then
+    mv $outvcf $tmpvcf
+    mv ${outvcf}.tbi ${tmpvcf}.tbi
+    cmd="$release_dir/bin/sentieon driver -t $nt -r \"$ref\" --algo DNAModelApply --model ${input_dir}/dnascope.model -v $tmpvcf $outvcf"
+    run "$cmd" "DNAscope model apply"
+fi
+
+gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $outfile ${outfile}.tbi "$out_variants"
+exit 0
@@ -0,0 +1,157 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=$(nproc)
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(BAM OUTPUT_BUCKET REF RECAL_TABLE DBSNP INTERVAL \
+    INTERVAL_FILE SHARD GVCF_OUTPUT PIPELINE SENTIEON_KEY EMAIL \
+    SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO \
+    REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE)
+unset_none_variables ${environmental_variables[@]}
+
+readonly BAM OUTPUT_BUCKET REF RECAL_TABLE DBSNP INTERVAL INTERVAL_FILE \
+    SHARD GVCF_OUTPUT PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION \
+    CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT REFERENCE_BUNDLE \
+    ARTIFACT_CACHE
+
+release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
+
+# Basic error handling #
+if [[ -z "$BAM" || -z "$SHARD" ]]; then
+    echo "Sharded variant calling requires a BAM and a SHARD"
+    exit 1
+fi
+
+if [[ -n "$INTERVAL" && -n "$INTERVAL_FILE" ]]; then
+    echo "Please supply either an INTERVAL or INTERVAL_FILE, not both"
+    exit 1
+fi
+
+slice_bam()
+{
+    # Read the slice_regions of a remote BAM or CRAM file into a local BAM
+    # file. Only the blocks that the local index lists for the regions are
+    # read
+    fun_src=$1
+    fun_idx=$2
+    fun_dst=$3
+    for fun_try in 1 2 3; do
+        if samtools view -b -M -@ $nt -T "$ref" -X -o "$fun_dst" "$fun_src" "$fun_idx" $slice_regions; then
+            samtools index -@ $nt "$fun_dst"
+            return 0
+        fi
+        echo "Reading $fun_src failed (try $fun_try)"
+        sleep $((fun_try * 10))
+    done
+    return 1
+}
+
+# **********************************
+# 0. Setup
+# **********************************
+gc_setup
+export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
+export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
+
+## Download input files
+download_intervals
+download_reference
+if [[ $CALLING_ALGO == "DNAscope" && -n "$DNASCOPE_MODEL" ]]; then
+    fetch_artifact "$DNASCOPE_MODEL" ${input_dir}/dnascope.model
+fi
+
+if [[ -n "$RECAL_TABLE" ]]; then
+    bqsr_table=$input_dir/$(basename "$RECAL_TABLE")
+    transfer "$RECAL_TABLE" "$bqsr_table"
+fi
+
+if [[ -n "$DBSNP" ]]; then
+    transfer_all_sites $dbsnp_dir "$DBSNP"
+    dbsnp="${local_sites[0]}"
+fi
+
+## Read only the regions of the shard from each BAM or CRAM file
+IFS=',' read -r -a shard_regions <<< "$SHARD"
+IFS=',' read -r -a bams <<< "$BAM"
+idx_transfers=$(mktemp)
+local_idxs=()
+for bam in "${bams[@]}"; do
+    if [[ "$bam" == *.cram ]]; then
+        idx_ext=crai
+        bam_base=${bam%%.cram}
+    else
+        idx_ext=bai
+        bam_base=${bam%%.bam}
+    fi
+    if stat_file "${bam}".${idx_ext}; then
+        bai="${bam}".${idx_ext}
+    elif stat_file "${bam_base}".${idx_ext}; then
+        bai="${bam_base}".${idx_ext}
+    else
+        echo "Cannot find the index file for $bam"
+        exit 1
+    fi
+    local_idx=$input_dir/idx-${#local_idxs[@]}.${idx_ext}
+    add_transfer "$idx_transfers" "$bai" "$local_idx"
+    local_idxs+=("$local_idx")
+done
+transfer_many "$idx_transfers"
+
+if [[ -n "$REQUESTER_PROJECT" ]]; then
+    export GCS_REQUESTER_PAYS_PROJECT=$REQUESTER_PROJECT
+fi
+export nt ref slice_regions="${shard_regions[*]}"
+export -f slice_bam
+# htslib reads gs:// paths with this token, which is kept out of the log
+set +x
+GCS_OAUTH_TOKEN=$(gcloud auth print-access-token)
+export GCS_OAUTH_TOKEN
+set -x
+local_bams=()
+for i in "${!bams[@]}"; do
+    local_bam=$input_dir/slice-${i}.bam
+    run "slice_bam \"${bams[$i]}\" \"${local_idxs[$i]}\" \"$local_bam\"" "Read the shard of $(basename "${bams[$i]}")"
+    local_bams+=("$local_bam")
+done
+
+local_bams_str=""
+for bam in "${local_bams[@]}"; do
+    local_bams_str+=" -i \"$bam\" "
+done
+
+shard_str=""
+for region in "${shard_regions[@]}"; do
+    shard_str+=" --shard $region "
+done
+
+# ******************************************
+# 1. Variant Calling
+# ******************************************
+algo=Haplotyper
+extra_vcf_args=""
+if [[ $CALLING_ALGO == "DNAscope" ]]; then
+    algo="DNAscope"
+    if [[ -n "$DNASCOPE_MODEL" ]]; then
+        extra_vcf_args="--model ${input_dir}/dnascope.model"
+    else
+        extra_vcf_args="--var_type snp,indel,bnd"
+    fi
+fi
+
+if [[ -n "$GVCF_OUTPUT" ]]; then
+    outfile=$work/shard.g.vcf.gz
+    cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} $shard_str -t $nt -r \"$ref\" $local_bams_str ${bqsr_table:+-q $bqsr_table} --algo $algo $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} --emit_mode gvcf ${outfile}"
+else
+    outfile=$work/shard.vcf.gz
+    cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} $shard_str -t $nt -r \"$ref\" $local_bams_str ${bqsr_table:+-q $bqsr_table} --algo $algo $CALLING_ARGS $extra_vcf_args ${dbsnp:+-d \"$dbsnp\"} ${outfile}"
+fi
+run "$cmd" "Variant calling - shard"
+
+gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $outfile ${outfile}.tbi "$OUTPUT_BUCKET/"
+exit 0
@@ -4,22 +4,24 @@ set -xveo pipefail
 set +H
 
 BASEDIR=$(dirname "$0")
-scratch=/mnt/work
-nt=$(nproc)
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=${THREADS:-$(nproc)}
 source $BASEDIR/gc_functions.sh
 
 # Set "None" variables to an empty string
 environmental_variables=(FQ1 FQ2 BAM OUTPUT_BUCKET REF READGROUP BQSR_SITES \
     DBSNP INTERVAL INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT NO_HAPLOTYPER \
     GVCF_OUTPUT STREAM_INPUT PIPELINE OUTPUT_CRAM_FORMAT SENTIEON_KEY EMAIL \
-    SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO)
+    SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO REFERENCE_BUNDLE \
+    CHECKPOINTS ARTIFACT_CACHE)
 unset_none_variables ${environmental_variables[@]}
 OUTPUT_CRAM_FORMAT="" # Not yet supported
 
 readonly FQ1 FQ2 BAM OUTPUT_BUCKET REF READGROUP BQSR_SITES DBSNP INTERVAL \
     INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT NO_HAPLOTYPER GVCF_OUTPUT \
     STREAM_INPUT PIPELINE OUTPUT_CRAM_FORMAT SENTIEON_KEY EMAIL \
-    SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO
+    SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO REFERENCE_BUNDLE \
+    CHECKPOINTS ARTIFACT_CACHE
 
 release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
 
@@ -46,8 +48,17 @@ gc_setup
 export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
 export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
 
+## Reads processed by an earlier attempt need no alignment
+recal_done=
+dedup_done=
+if checkpoint_exists recalibrated; then
+    recal_done=true
+elif checkpoint_exists dedup; then
+    dedup_done=true
+fi
+
 ## Download input files
-if [[ -n "$BAM" ]]; then
+if [[ -n "$BAM" && -z "$recal_done$dedup_done" ]]; then
     download_bams "$BAM" local_bams $input_dir
 else
     local_bams=()
@@ -56,7 +67,7 @@ fi
 download_intervals
 download_reference
 if [[ $CALLING_ALGO == "DNAscope" && -n "$DNASCOPE_MODEL" ]]; then
-    curl -L -o ${input_dir}/dnascope.model "$DNASCOPE_MODEL"
+    fetch_artifact "$DNASCOPE_MODEL" ${input_dir}/dnascope.model
 fi
 
 ## Handle the sites files
@@ -70,19 +81,17 @@ if [[ -n "$DBSNP" ]]; then
     dbsnp="${local_sites[0]}"
 fi
 
+## Wait for the input BAM files downloading in the background
+wait_for_bams
+
 # ******************************************
 # 1. Mapping reads with BWA-MEM, sorting
 # ******************************************
 output_ext="bam"
-if [[ -n $FQ1 ]]; then
+if [[ -n $FQ1 && -z "$recal_done$dedup_done" ]]; then
     bwa_mem_align "" "$FQ1" "$FQ2" "$READGROUP" local_bams $output_ext "-K 100000000 -Y" "$util_sort_xargs" "true"
 fi
 
-local_bams_str=""
-for bam in "${local_bams[@]}"; do
-    local_bams_str+=" -i \"$bam\" "
-done
-
 # ******************************************
 # 2. Metrics command
 # ******************************************
@@ -93,58 +102,64 @@ if [[ -z "$NO_METRICS" ]]; then
     build_metrics_cmd "" metrics_cmd1 metrics_cmd2 metrics_files
 fi
 
+## The driver passes of the following stages are planned together, so
+## that stages reading the same reads share a pass
+plan_reset
+
+recal_finished()
+{
+    if [[ -z "$NO_BAM_OUTPUT" ]]; then
+        queue_task "Recalibrated CRAM upload" upload $work/recalibrated.cram $work/recalibrated.cram.crai "$out_bam"
+    fi
+}
+
 # ******************************************
 # 3. Remove duplicates
 # ******************************************
-output_ext="bam"
-
-run_mark_duplicates "" "markdup" metrics_cmd1 "$local_bams_str" dedup_bam_str dedup_bams "$dedup_xargs" $output_ext "true" "${local_bams[@]}"
-if [[ -z "$NO_METRICS" ]]; then
-    (gsutil cp $metrics_dir/dedup_metrics.txt "$out_metrics" &&
-        rm $metrics_dir/dedup_metrics.txt) &
-    upload_dedup_pid=$!
-else
-    rm $metrics_dir/dedup_metrics.txt &
-fi
-for bam in "${local_bams[@]}"; do
-    if [[ -f "$bam" ]]; then
-        rm "$bam" &
-    fi
-    if [[ -f "${bam}".bai ]]; then
-        rm "${bam}".bai &
-    fi
-    if [[ -f "${bam}".crai ]]; then
-        rm "${bam}".crai &
+dedup_finished()
+{
+    if [[ -z "$NO_METRICS" ]]; then
+        queue_task "Dedup metrics upload" upload_and_remove $metrics_dir/dedup_metrics.txt "$out_metrics"
+    else
+        rm $metrics_dir/dedup_metrics.txt &
     fi
-done
+}
 
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
+if [[ -z "$recal_done" ]]; then
+    output_ext="bam"
+
+    plan_mark_duplicates "" "markdup" "$dedup_xargs" $output_ext "true" "true" dedup_finished dedup_bams "${local_bams[@]}"
+fi
 
 # ******************************************
 # 4. Base recalibration
 # ******************************************
-bqsr_intervals="chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11,chr12,chr13,chr14,chr15,chr16,chr17,chr18,chr19,chr20,chr21,chr22"
-cmd="$release_dir/bin/sentieon driver -t $nt -r \"$ref\" --interval $bqsr_intervals $dedup_bam_str --algo QualCal $bqsr_sites $work/recal_data.table"
-run "$cmd" "BQSR"
+if [[ -n "$recal_done" ]]; then
+    restore_checkpoint recalibrated restored_files
+    plan_stream recalibrated "" false $work/recalibrated.cram
+    recal_finished
+else
+    bqsr_intervals="chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11,chr12,chr13,chr14,chr15,chr16,chr17,chr18,chr19,chr20,chr21,chr22"
+    if checkpoint_exists bqsr; then
+        restore_checkpoint bqsr restored_files
+    else
+        plan_stage qualcal "BQSR" deduped "" "$bqsr_intervals" "" "" false \
+            "--algo QualCal $bqsr_sites $work/recal_data.table" "save_checkpoint bqsr $work/recal_data.table"
+    fi
 
-cmd="$release_dir/bin/sentieon driver -t $nt -r \"$ref\" $dedup_bam_str --read_filter QualCalFilter,table=$work/recal_data.table,prior=-1.0,indel=false,levels=10/20/30,min_qual=6 --algo ReadWriter --cram_write_options version=3.0,compressor=gzip+rans $work/recalibrated.cram"
-run "$cmd" "ReadWriter"
+    plan_stage read_writer "ReadWriter" deduped "" "" "--read_filter QualCalFilter,table=$work/recal_data.table,prior=-1.0,indel=false,levels=10/20/30,min_qual=6" qualcal false \
+        "--algo ReadWriter $cram_write_options $work/recalibrated.cram" "save_checkpoint recalibrated $work/recalibrated.cram; recal_finished"
+    plan_stream recalibrated read_writer false $work/recalibrated.cram
+fi
 
-for bam in "${dedup_bams[@]}"; do
-    if [[ -f "$bam" ]]; then
-        rm "$bam" &
-    fi
-    if [[ -f "${bam}".bai ]]; then
-        rm "$bam".bai &
-    fi
-    if [[ -f "${bam}".crai ]]; then
-        rm "${bam}".crai &
-    fi
-done
+metrics_finished()
+{
+    queue_task "Metrics upload" plot_and_upload_metrics "$metrics_cmd2" "${metrics_files[@]}"
+}
 
-if [[ -z "$NO_BAM_OUTPUT" ]]; then
-    gsutil cp $work/recalibrated.cram $work/recalibrated.cram.crai "$out_bam" &
-    upload_recal_pid=$!
+# Metrics are collected over the whole genome, from the first reads read
+if [[ -n "$metrics_cmd1" ]]; then
+    plan_stage metrics "Metrics collection" "recalibrated,deduped,sorted" "*" "" "*" "" false "$metrics_cmd1" metrics_finished
 fi
 
 
@@ -174,16 +189,8 @@ if [[ $CALLING_ALGO == "DNAscope" ]]; then
     tmpvcf=$work/tmp.vcf.gz
 fi
 
-if [[ -z $NO_HAPLOTYPER ]]; then
-    if [[ -n "$GVCF_OUTPUT" ]]; then
-        cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" -i $work/recalibrated.cram --algo $algo $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} --emit_mode gvcf ${outgvcf}"
-        outfile=$outgvcf
-    else
-        cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" -i $work/recalibrated.cram --algo $algo $CALLING_ARGS $extra_vcf_args ${dbsnp:+-d \"$dbsnp\"} ${outvcf}"
-        outfile=$outvcf
-    fi
-    run "$cmd" "Variant calling"
-
+calling_finished()
+{
     # DNAscope SV calling
     if [[ $CALLING_ALGO == "DNAscope" && -z "$GVCF_OUTPUT" && -z "$DNASCOPE_MODEL" ]]; then
         mv $outvcf $tmpvcf
@@ -200,31 +207,26 @@ if [[ -z $NO_HAPLOTYPER ]]; then
         run "$cmd" "DNAscope model apply"
     fi
 
-    gsutil cp $outfile ${outfile}.tbi "$out_variants" &
-    upload_vcf_pid=$!
-fi
+    queue_task "VCF upload" upload $outfile ${outfile}.tbi "$out_variants"
+}
 
-# Wait for all running uploads to finish
-set +e
-if [[ -n $upload_recal_pid ]]; then
-    wait $upload_recal_pid
-fi
-if [[ -n $upload_metrics_pid ]]; then
-    wait $upload_metrics_pid
-fi
-if [[ -n $upload_dedup_pid ]]; then
-    wait $upload_dedup_pid
-fi
-if [[ -n $upload_deduped_pid ]]; then
-    wait $upload_deduped_pid
-fi
-if [[ -n $upload_bqsr_pid ]]; then
-    wait $upload_bqsr_pid
-fi
-if [[ -n $upload_vcf_pid ]]; then
-    wait $upload_vcf_pid
-fi
-if [[ -n $upload_bqsr_metrics_pid ]]; then
-    wait $upload_bqsr_metrics_pid
+if [[ -z $NO_HAPLOTYPER ]]; then
+    if [[ -n "$GVCF_OUTPUT" ]]; then
+        calling_args="--algo $algo $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} --emit_mode gvcf ${outgvcf}"
+        outfile=$outgvcf
+    else
+        calling_args="--algo $algo $CALLING_ARGS $extra_vcf_args ${dbsnp:+-d \"$dbsnp\"} ${outvcf}"
+        outfile=$outvcf
+    fi
+    plan_stage calling "Variant calling" recalibrated "" "$call_interval" "" "" false "$calling_args" calling_finished
 fi
+
+# ******************************************
+# 6. Run the planned passes
+# ******************************************
+run_plan
+
+# Wait for all queued uploads to finish
+upload_barrier
+remove_checkpoints
 exit 0
@@ -31,7 +31,7 @@ run()
     start=`date +"%D %T"`
     start_s=`date +%s`
     echo "$what start time: $start"
-    eval "$cmd"
+    python3 /opt/sentieon/record_stage.py "${stage_log:-/dev/null}" "$what" "$cmd"
     check_error $? "$what"
     end=`date +"%D %T"`
     end_s=`date +%s`
@@ -40,16 +40,89 @@ run()
     echo "$what runtime: $runtime"
 }
 
+bundled_file()
+{
+    # The path a file would have in the unpacked reference bundle
+    if [[ -n "$bundle_dir" && "$1" == gs://* ]]; then
+        echo "$bundle_dir/files/${1#gs://}"
+    fi
+}
+
+stat_file()
+{
+    test -e "$1" || test -e "$(bundled_file "$1")" || gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "$1"
+}
+
 transfer()
 {
     src_file=$1
     dst_file=$2
-    start_s=`date +%s`
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp "$src_file" "$dst_file"
-    check_error $? "Transfer $src_file to $dst_file"
-    end_s=`date +%s`
-    runtime=$(delta_time $start_s $end_s)
-    echo "Transfer runtime: $runtime"
+    bundled=$(bundled_file "$src_file")
+    if [[ -n "$bundled" && -f "$bundled" ]]; then
+        ln -f "$bundled" "$dst_file" || cp "$bundled" "$dst_file"
+        echo "Using $src_file from the reference bundle"
+        return
+    fi
+    run "gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp \"$src_file\" \"$dst_file\"" "Transfer $src_file to $dst_file"
+}
+
+add_transfer()
+{
+    # Queue a download in a manifest for transfer_many
+    printf '%s\t%s\n' "$2" "$3" >> "$1"
+}
+
+transfer_many()
+{
+    # Download all files of a manifest concurrently, linking the files
+    # found in the reference bundle
+    fun_manifest=$1
+    fetch_manifest=${fun_manifest}.fetch
+    shared_manifest=${fun_manifest}.shared
+    : > "$fetch_manifest"
+    : > "$shared_manifest"
+    while IFS=$'\t' read -r many_src many_dst; do
+        bundled=$(bundled_file "$many_src")
+        if [[ -n "$bundled" && -f "$bundled" ]]; then
+            transfer "$many_src" "$many_dst"
+        elif [[ -n "$SHARED_DIR" && "$many_dst" == "$SHARED_DIR"/* ]]; then
+            add_transfer "$shared_manifest" "$many_src" "$many_dst"
+        else
+            add_transfer "$fetch_manifest" "$many_src" "$many_dst"
+        fi
+    done < "$fun_manifest"
+    if [[ -s "$fetch_manifest" ]]; then
+        run "python3 /opt/sentieon/fetch_files.py ${REQUESTER_PROJECT:+--requester_project $REQUESTER_PROJECT} \"$fetch_manifest\"" "Transfer of $(wc -l < "$fetch_manifest") files"
+    fi
+    if [[ -s "$shared_manifest" ]]; then
+        transfer_shared "$shared_manifest"
+    fi
+    rm -f "$fun_manifest" "$fetch_manifest" "$shared_manifest"
+}
+
+transfer_shared()
+{
+    # Download the files shared by the samples of a packed job once. The
+    # samples take turns, and a marker is written after each completed
+    # download
+    fun_shared=$1
+    (
+        flock 9
+        fun_missing=${fun_shared}.missing
+        : > "$fun_missing"
+        while IFS=$'\t' read -r many_src many_dst; do
+            if [[ ! -e "${many_dst}.staged" ]]; then
+                add_transfer "$fun_missing" "$many_src" "$many_dst"
+            fi
+        done < "$fun_shared"
+        if [[ -s "$fun_missing" ]]; then
+            run "python3 /opt/sentieon/fetch_files.py ${REQUESTER_PROJECT:+--requester_project $REQUESTER_PROJECT} \"$fun_missing\"" "Transfer of $(wc -l < "$fun_missing") shared files"
+            cut -f 2 "$fun_missing" | while read -r many_dst; do
+                touch "${many_dst}.staged"
+            done
+        fi
+        rm -f "$fun_missing"
+    ) 9> "$SHARED_DIR/transfer.lock"
 }
 
 transfer_all_sites()
@@ -58,40 +131,224 @@ transfer_all_sites()
     src_files=("$@")
     local_sites=()
     local_str=""
+    sites_transfers=$(mktemp)
     for src_file in "${src_files[@]}"; do
         # File
         local_file=$dst_dir/$(basename "$src_file")
-        transfer "$src_file" "$local_file"
+        add_transfer "$sites_transfers" "$src_file" "$local_file"
         local_sites+=("$local_file")
         local_str+=" -k \"$local_file\" "
         # Index
-        if $(test -e "${src_file}".idx) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${src_file}".idx); then
+        if stat_file "${src_file}".idx; then
             idx="${src_file}".idx
-        elif $(test -e "${src_file}".tbi) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${src_file}".tbi); then
+        elif stat_file "${src_file}".tbi; then
             idx="${src_file}".tbi
         else
             echo "Cannot find idx for $src_file"
             exit 1
         fi
         local_idx=$dst_dir/$(basename "$idx")
-        transfer "$idx" "$local_idx"
+        add_transfer "$sites_transfers" "$idx" "$local_idx"
     done
+    transfer_many "$sites_transfers"
+}
+
+upload()
+{
+    # Upload files to the last argument, with parallel composite uploads
+    # for large files, and record the bytes and time of the upload
+    fun_bytes=$(du -cbL "${@:1:$#-1}" | tail -n 1 | cut -f 1) || true
+    fun_start_s=$(date +%s)
+    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -o GSUtil:parallel_composite_upload_threshold=150M cp "$@" || return 1
+    fun_upload_s=$(($(date +%s) - fun_start_s))
+    echo "Uploaded $fun_bytes bytes to ${@: -1} in ${fun_upload_s}s"
+    echo -e "${fun_bytes:-0}\t${fun_upload_s}" >> "$upload_log"
+}
+
+upload_and_remove()
+{
+    upload "$@" && rm "${@:1:$#-1}"
+}
+
+run_and_upload()
+{
+    fun_cmd=$1; shift
+    fun_what=$1; shift
+    run "$fun_cmd" "$fun_what" && upload "$@"
+}
+
+plot_and_upload_metrics()
+{
+    fun_plot_cmd=$1; shift
+    run "$fun_plot_cmd" "Plotting metrics results." && upload_and_remove "$@" "$out_metrics"
 }
 
-upload_metrics()
+queue_task()
 {
-    fun_var_cmd1=$1; shift
-    fun_var_cmd2=$1; shift
-    fun_pid=$1; shift
-    fun_metrics_files=("$@")
-    eval "fun_metrics_cmd1=\$$fun_var_cmd1"
-    eval "fun_metrics_cmd2=\$$fun_var_cmd2"
-    if [[ -n "$fun_metrics_cmd2" && -z "$fun_metrics_cmd1" && -f "${fun_metrics_files[0]}" ]]; then
-        (run "$fun_metrics_cmd2" "Plotting metrics results." &&
-            gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp ${fun_metrics_files[@]} "$out_metrics" &&
-            rm ${fun_metrics_files[@]}) &
-        eval "$fun_pid=$! "
-        eval "$fun_var_cmd2=''"
+    # Run a command in the background as part of the upload queue. The
+    # job fails at the upload_barrier if any queued task failed
+    fun_what=$1; shift
+    "$@" &
+    upload_pids+=($!)
+    upload_names+=("$fun_what")
+    echo "Queued $fun_what"
+}
+
+upload_status()
+{
+    for i in "${!upload_pids[@]}"; do
+        if kill -0 ${upload_pids[$i]} 2>/dev/null; then
+            echo "Upload queue: ${upload_names[$i]} running"
+        else
+            echo "Upload queue: ${upload_names[$i]} finished"
+        fi
+    done
+}
+
+upload_barrier()
+{
+    # Wait for every queued task, failing the job if any of them failed
+    upload_status
+    upload_failures=0
+    for i in "${!upload_pids[@]}"; do
+        if wait ${upload_pids[$i]}; then
+            echo "Upload queue: ${upload_names[$i]} succeeded"
+        else
+            echo "Upload queue: ${upload_names[$i]} failed"
+            upload_failures=$((upload_failures + 1))
+        fi
+    done
+    upload_pids=()
+    upload_names=()
+    if [[ -s "$upload_log" ]]; then
+        awk '{n += $1; t += $2} END {print "Uploaded " n " bytes in total, " t "s of upload time"}' "$upload_log"
+    fi
+    if [[ $upload_failures -gt 0 ]]; then
+        echo "Error. $upload_failures queued upload(s) failed"
+        exit 1
+    fi
+}
+
+upload_stage_log()
+{
+    if [[ -s "$stage_log" ]]; then
+        gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp "$stage_log" "$OUTPUT_BUCKET/worker_logs/stages.jsonl" || true
+    fi
+}
+
+checkpoint_exists()
+{
+    # Whether an earlier attempt of this run completed a stage
+    [[ -n "$checkpoint_dir" ]] && gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "$checkpoint_dir/$1.done"
+}
+
+save_checkpoint()
+{
+    # Queue the upload of the outputs of a completed stage and their
+    # indices, followed by the completion marker listing them. The files
+    # are hard linked first, so later stages can remove them meanwhile
+    fun_stage=$1; shift
+    if [[ -z "$checkpoint_dir" ]]; then
+        return
+    fi
+    fun_link_dir=$scratch/checkpoints/$fun_stage
+    mkdir -p "$fun_link_dir"
+    : > "$fun_link_dir.done"
+    fun_links=()
+    for fun_file in "$@"; do
+        for fun_path in "$fun_file" "${fun_file}.bai" "${fun_file}.crai" "${fun_file}.idx"; do
+            if [[ -f "$fun_path" ]]; then
+                ln -f "$fun_path" "$fun_link_dir/$(basename "$fun_path")"
+                fun_links+=("$fun_link_dir/$(basename "$fun_path")")
+                echo "$fun_path" >> "$fun_link_dir.done"
+            fi
+        done
+    done
+    queue_task "Checkpoint of $fun_stage" upload_checkpoint "$fun_stage" "${fun_links[@]}"
+}
+
+upload_checkpoint()
+{
+    # A checkpoint that fails to upload only costs the time of the stage
+    # if the run is preempted, so it does not fail the job
+    fun_stage=$1; shift
+    if upload "$@" "$checkpoint_dir/$fun_stage/" && upload "$scratch/checkpoints/$fun_stage.done" "$checkpoint_dir/$fun_stage.done"; then
+        rm -f "$@"
+    else
+        echo "Could not save the checkpoint of $fun_stage"
+    fi
+}
+
+restore_checkpoint()
+{
+    # Download the outputs of a stage completed by an earlier attempt to
+    # their original paths, returning the restored files other than indices.
+    # Files restored before are not downloaded again
+    fun_stage=$1
+    fun_dest_arr=$2
+    fun_marker=$scratch/checkpoints/$fun_stage.done
+    mkdir -p $scratch/checkpoints
+    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp "$checkpoint_dir/$fun_stage.done" "$fun_marker"
+    fun_transfers=$(mktemp)
+    fun_restored=()
+    while read -r fun_path; do
+        if [[ ! -f "$fun_path" ]]; then
+            add_transfer "$fun_transfers" "$checkpoint_dir/$fun_stage/$(basename "$fun_path")" "$fun_path"
+        fi
+        if [[ "$fun_path" != *.bai && "$fun_path" != *.crai && "$fun_path" != *.idx ]]; then
+            fun_restored+=("$fun_path")
+        fi
+    done < "$fun_marker"
+    transfer_many "$fun_transfers"
+    echo "Restored the checkpoint of $fun_stage"
+
+    eval "${fun_dest_arr}=(${fun_restored[@]})"
+}
+
+remove_checkpoints()
+{
+    # The checkpoints of a finished run are no longer needed
+    if [[ -n "$checkpoint_dir" ]]; then
+        gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -m -q rm -r "$checkpoint_dir" || true
+    fi
+}
+
+load_reference_bundle()
+{
+    bundle_dir=""
+    if [[ -z "$REFERENCE_BUNDLE" ]]; then
+        return
+    fi
+    local_bundle=${SHARED_DIR:-$scratch}/bundle
+    if [[ -n "$SHARED_DIR" && -d $local_bundle/files ]]; then
+        # Unpacked and checked by the setup of the packed job
+        bundle_dir=$local_bundle
+        return
+    fi
+    mkdir -p $local_bundle
+    if ! gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp "$REFERENCE_BUNDLE/manifest.json" $local_bundle/manifest.json; then
+        echo "Cannot find the reference bundle $REFERENCE_BUNDLE, downloading files individually"
+        return
+    fi
+    # The BWA index is a separate part, only needed to align FASTQ
+    bundle_parts=(bundle)
+    if [[ -n "$FQ1" || -n "$TUMOR_FQ1" || -n "$pack_fastq" ]] && \
+        python3 /opt/sentieon/check_bundle.py --list_parts $local_bundle/manifest.json | grep -qx bwa; then
+        bundle_parts+=(bwa)
+    fi
+    bundle_transfers=$(mktemp)
+    for part in "${bundle_parts[@]}"; do
+        add_transfer "$bundle_transfers" "$REFERENCE_BUNDLE/${part}.tar" $local_bundle/${part}.tar
+    done
+    transfer_many "$bundle_transfers"
+    for part in "${bundle_parts[@]}"; do
+        run "tar -xf $local_bundle/${part}.tar -C $local_bundle && rm -f $local_bundle/${part}.tar $local_bundle/${part}.tar.staged" "Unpacking the reference bundle ($part)"
+    done
+    if python3 /opt/sentieon/check_bundle.py --parts "$(IFS=','; echo "${bundle_parts[*]}")" $local_bundle/manifest.json $local_bundle/files; then
+        bundle_dir=$local_bundle
+    else
+        echo "The reference bundle does not match its manifest, downloading files individually"
+        rm -rf $local_bundle/files
     fi
 }
 
@@ -104,27 +361,85 @@ unset_none_variables()
     done
 }
 
+copy_cached()
+{
+    if [[ "$1" == gs://* ]]; then
+        gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q cp "$1" "$2"
+    else
+        cp "$1" "$2"
+    fi
+}
+
+fetch_artifact()
+{
+    # Download a release or model file from its mirror in the
+    # ARTIFACT_CACHE, checked against the sha256 saved beside it, falling
+    # back to the origin
+    fun_url=$1
+    fun_dst=$2
+    if [[ -n "$ARTIFACT_CACHE" ]]; then
+        fun_cached=${ARTIFACT_CACHE%/}/${fun_url#*://}
+        if copy_cached "$fun_cached".sha256 "$fun_dst".sha256 && \
+            copy_cached "$fun_cached" "$fun_dst" && \
+            [[ "$(sha256sum "$fun_dst" | cut -d ' ' -f 1)" == "$(cut -d ' ' -f 1 "$fun_dst".sha256)" ]]; then
+            rm -f "$fun_dst".sha256
+            return 0
+        fi
+        echo "Could not fetch $fun_url from the artifact cache"
+        rm -f "$fun_dst" "$fun_dst".sha256
+    fi
+    curl -fL -o "$fun_dst" "$fun_url"
+}
+
 gc_setup()
 {
-    ## Download the Sentieon software
-    curl -L https://sentieon-release.s3.amazonaws.com/software/sentieon-genomics-${SENTIEON_VERSION}.tar.gz | tar -zxf - -C /opt/sentieon
+    ## Download the Sentieon software, unless the image or the setup of a
+    ## packed job already has it
+    if [[ ! -x /opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/bin/sentieon ]]; then
+        release_tarball=/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}.tar.gz
+        fetch_artifact https://sentieon-release.s3.amazonaws.com/software/sentieon-genomics-${SENTIEON_VERSION}.tar.gz $release_tarball
+        tar -zxf $release_tarball -C /opt/sentieon
+        rm $release_tarball
+    fi
     PATH=/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/bin:$PATH
 
-    ## Dirs
+    ## Dirs. The samples of a packed job share the reference, sites and
+    ## license files under SHARED_DIR
+    shared=${SHARED_DIR:-$scratch}
     work=$scratch/work
     metrics_dir=$scratch/metrics
-    ref_dir=$scratch/ref
+    ref_dir=$shared/ref
     input_dir=$scratch/inputs
-    bqsr_dir=$scratch/bqsr
-    realign_dir=$scratch/realign
-    dbsnp_dir=$scratch/dbsnp
-    license_dir=$scratch/license
+    bqsr_dir=$shared/bqsr
+    realign_dir=$shared/realign
+    dbsnp_dir=$shared/dbsnp
+    license_dir=$shared/license
     mkdir -p $work $metrics_dir $ref_dir $input_dir $bqsr_dir \
         $realign_dir $dbsnp_dir $license_dir
 
+    ## Unpack the reference and sites files of a prebuilt bundle
+    load_reference_bundle
+
     out_metrics=$OUTPUT_BUCKET/metrics/
     out_variants=$OUTPUT_BUCKET/variants/
     out_bam=$OUTPUT_BUCKET/aligned_reads/
+    upload_log=$work/uploads.tsv
+
+    ## With CHECKPOINTS, save the outputs of each stage so that a relaunched
+    ## attempt can resume after the last completed stage. Checkpoints are
+    ## kept per configuration, so a changed run does not reuse them
+    checkpoint_dir=""
+    if [[ -n "$CHECKPOINTS" ]]; then
+        checkpoint_key=$(for var in "${environmental_variables[@]}"; do echo "$var=${!var}"; done | md5sum | cut -c 1-16)
+        checkpoint_dir=$OUTPUT_BUCKET/checkpoints/$checkpoint_key
+    fi
+
+    ## Record the timing and resources of each stage, uploaded on exit
+    stage_log=$scratch/stages.jsonl
+    trap upload_stage_log EXIT
+
+    ## Alignment outputs are written as CRAM with OUTPUT_CRAM_FORMAT
+    cram_write_options="--cram_write_options version=3.0,compressor=gzip+rans"
 
     ## Make gsutil more robust to timeouts - which may occur during streaming transfer
     if [[ ! -f ~/.boto ]]; then
@@ -134,8 +449,10 @@ gc_setup()
     ## Setup license information #
     cred=$license_dir/credentials.json
     project_file=$license_dir/credentials.json.project
-    python3 /opt/sentieon/gen_credentials.py ${EMAIL:+--email $EMAIL} $cred "$SENTIEON_KEY"
-    sleep 10
+    if [[ -z "$SHARED_DIR" || ! -s "$project_file" ]]; then
+        python3 /opt/sentieon/gen_credentials.py ${EMAIL:+--email $EMAIL} $cred "$SENTIEON_KEY"
+        sleep 10
+    fi
     if [[ -n $SENTIEON_KEY ]]; then
         export SENTIEON_AUTH_MECH=proxy_GOOGLE
     else
@@ -170,29 +487,52 @@ gc_setup()
 
 download_bams()
 {
+    # Start downloading BAM or CRAM files and their indices in the
+    # background. Call wait_for_bams before reading them
     bams=$1
     dest_arr=$2
     download_input_dir=$3
 
     IFS=',' read -r -a bams <<< "$bams"
     tmp_bam_dest=()
+    bam_transfers=$(mktemp)
     for bam in "${bams[@]}"; do
         local_bam=$download_input_dir/$(basename "$bam")
-        transfer "$bam" "$local_bam"
-        if $(test -e "${bam}".bai) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${bam}".bai); then
-            bai="${bam}".bai
-        elif $(test -e "${bam%%.bam}".bai) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${bam%%.bam}".bai); then
-            bai="${bam%%.bam}".bai
+        add_transfer "$bam_transfers" "$bam" "$local_bam"
+        if [[ "$bam" == *.cram ]]; then
+            idx_ext=crai
+            bam_base=${bam%%.cram}
+        else
+            idx_ext=bai
+            bam_base=${bam%%.bam}
+        fi
+        if stat_file "${bam}".${idx_ext}; then
+            bai="${bam}".${idx_ext}
+        elif stat_file "${bam_base}".${idx_ext}; then
+            bai="${bam_base}".${idx_ext}
         else
             echo "Cannot find the index file for $bam"
             exit 1
         fi
         local_bai=$download_input_dir/$(basename "$bai")
-        transfer "$bai" "$local_bai"
+        add_transfer "$bam_transfers" "$bai" "$local_bai"
         tmp_bam_dest+=("$local_bam")
     done
+    transfer_many "$bam_transfers" &
+    bam_download_pids+=($!)
 
-    eval "${dest_arr}=(${tmp_bam_dest})"
+    eval "${dest_arr}=(${tmp_bam_dest[@]})"
+}
+
+wait_for_bams()
+{
+    for pid in "${bam_download_pids[@]}"; do
+        if ! wait $pid; then
+            echo "Error downloading the input BAM files"
+            exit 1
+        fi
+    done
+    bam_download_pids=()
 }
 
 download_intervals()
@@ -214,36 +554,38 @@ download_intervals()
 download_reference()
 {
     ref=$ref_dir/$(basename "$REF")
-    transfer "$REF" "$ref"
-    transfer "${REF}".fai "${ref}".fai
-    if $(test -e "${REF}".dict) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF}".dict); then
-        transfer "${REF}".dict "${ref}".dict
-    elif $(test -e "${REF%%.fa}".dict) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF%%.fa}".dict); then
-        transfer "${REF%%.fa}".dict "${ref%%.fa}".dict
-    elif $(test -e "${REF%%.fasta}".dict) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF%%.fasta}".dict); then
-        transfer "${REF%%.fasta}".dict "${ref%%.fasta}".dict
+    ref_transfers=$(mktemp)
+    add_transfer "$ref_transfers" "$REF" "$ref"
+    add_transfer "$ref_transfers" "${REF}".fai "${ref}".fai
+    if stat_file "${REF}".dict; then
+        add_transfer "$ref_transfers" "${REF}".dict "${ref}".dict
+    elif stat_file "${REF%%.fa}".dict; then
+        add_transfer "$ref_transfers" "${REF%%.fa}".dict "${ref%%.fa}".dict
+    elif stat_file "${REF%%.fasta}".dict; then
+        add_transfer "$ref_transfers" "${REF%%.fasta}".dict "${ref%%.fasta}".dict
     else
         echo "Cannot find reference dictionary"
         exit 1
     fi
     if [[ -n "$FQ1" || -n "$TUMOR_FQ1" ]]; then
-        if $(test -e "${REF}".64.amb) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF}".64.amb); then
+        if stat_file "${REF}".64.amb; then
             middle=".64"
-        elif $(test -e "${REF}".amb) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF}".amb); then
+        elif stat_file "${REF}".amb; then
             middle=""
         else
             echo "Cannot file BWA index files"
             exit 1
         fi
-        transfer "${REF}"${middle}.amb "${ref}"${middle}.amb
-        transfer "${REF}"${middle}.ann "${ref}"${middle}.ann
-        transfer "${REF}"${middle}.bwt "${ref}"${middle}.bwt
-        transfer "${REF}"${middle}.pac "${ref}"${middle}.pac
-        transfer "${REF}"${middle}.sa  "${ref}"${middle}.sa
-        if $(test -e "${REF}"${middle}.alt) || $(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "${REF}"${middle}.alt); then
-            transfer "${REF}"${middle}.alt "${ref}"${middle}.alt
+        add_transfer "$ref_transfers" "${REF}"${middle}.amb "${ref}"${middle}.amb
+        add_transfer "$ref_transfers" "${REF}"${middle}.ann "${ref}"${middle}.ann
+        add_transfer "$ref_transfers" "${REF}"${middle}.bwt "${ref}"${middle}.bwt
+        add_transfer "$ref_transfers" "${REF}"${middle}.pac "${ref}"${middle}.pac
+        add_transfer "$ref_transfers" "${REF}"${middle}.sa "${ref}"${middle}.sa
+        if stat_file "${REF}"${middle}.alt; then
+            add_transfer "$ref_transfers" "${REF}"${middle}.alt "${ref}"${middle}.alt
         fi
     fi
+    transfer_many "$ref_transfers"
 }
 
 bwa_mem_align()
@@ -257,6 +599,7 @@ bwa_mem_align()
     fun_bwa_xargs=$1; shift
     fun_util_sort_xargs=$1; shift
     fun_run_samblaster=$1; shift
+    fun_part=${1:-}  # Optional "i/n", align every n-th read starting at i
     fun_bam_dest=()
 
     IFS=',' read -r -a fun_fq1 <<< "$fun_fq1"
@@ -268,24 +611,60 @@ bwa_mem_align()
         export bwt_max_mem="$((mem_kb / 1024 / 1024 - 2))g"
     fi
 
+    # Skip the lanes aligned by an earlier attempt
+    fun_aligned=()
+    for i in $(seq 1 ${#fun_fq1[@]}); do
+        i=$((i - 1))
+        if checkpoint_exists "${fun_base}align-${i}"; then
+            fun_aligned[$i]=true
+        fi
+    done
+
+    # Download the fastq of all lanes together, unless streaming them
+    if [[ -z "$fun_part" && -z "$STREAM_INPUT" ]]; then
+        fq_transfers=$(mktemp)
+        for i in "${!fun_fq1[@]}"; do
+            if [[ -z "${fun_aligned[$i]}" ]]; then
+                for fq in "${fun_fq1[$i]}" "${fun_fq2[$i]}"; do
+                    if [[ -n "$fq" ]]; then
+                        add_transfer "$fq_transfers" "$fq" "$input_dir/$(basename "$fq")"
+                    fi
+                done
+            fi
+        done
+        transfer_many "$fq_transfers"
+    fi
+
     for i in $(seq 1 ${#fun_fq1[@]}); do
         i=$((i - 1))
+        if [[ -n "${fun_aligned[$i]}" ]]; then
+            restore_checkpoint "${fun_base}align-${i}" fun_lane_bams
+            fun_bam_dest+=("${fun_lane_bams[@]}")
+            continue
+        fi
         fq1=${fun_fq1[$i]}
         fq2=${fun_fq2[$i]}
         readgroup=${fun_rgs[$i]}
         bwa_cmd="$release_dir/bin/bwa mem ${fun_bwa_xargs} -R \"${readgroup}\" -t $nt \"$ref\" "
-        if [[ -n "$STREAM_INPUT" ]]; then
+        if [[ -n "$fun_part" ]]; then
+            # Gzipped fastq cannot be split at byte offsets, so each part
+            # streams the whole file and keeps an interleaved subset of
+            # records. Mates stay paired as both files are filtered alike.
+            part_filter="gzip -dcf | awk -v i=${fun_part%/*} -v n=${fun_part#*/} 'int((NR - 1) / 4) % n == i'"
+            bwa_cmd="$bwa_cmd <(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fq1 - | $part_filter) "
+            if [[ -n "$fq2" ]]; then
+                bwa_cmd="$bwa_cmd <(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fq2 - | $part_filter) "
+            fi
+        elif [[ -n "$STREAM_INPUT" ]]; then
             bwa_cmd="$bwa_cmd <(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fq1 -) "
             if [[ -n "$fq2" ]]; then
                 bwa_cmd="$bwa_cmd <(gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fq2 -) "
             fi
         else
             local_fq1=$input_dir/$(basename "$fq1")
-            transfer "$fq1" "$local_fq1"
             bwa_cmd="$bwa_cmd \"$local_fq1\""
             if [[ -n "$fq2" ]]; then
                 local_fq2=$input_dir/$(basename "$fq2")
-                transfer "$fq2" "$local_fq2"
                 bwa_cmd="$bwa_cmd \"$local_fq2\""
             fi
         fi
@@ -298,6 +677,7 @@ bwa_mem_align()
         bwa_cmd="$bwa_cmd | $release_dir/bin/sentieon util sort ${fun_util_sort_xargs} --block_size 512M -o $local_bam -t $nt --sam2bam -i -"
         run "$bwa_cmd" "BWA-mem and sorting"
         gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $bwa_log "$out_bam"
+        save_checkpoint "${fun_base}align-${i}" $local_bam
         fun_bam_dest+=($local_bam)
     done
     echo "BWA ended"
@@ -340,117 +720,179 @@ build_metrics_cmd()
     eval "$fun_metrics_files=($mq $is $qd $gc $gc_summary $as $report)"
 }
 
-run_mark_duplicates() {
+plan_reset()
+{
+    # Start the plan of the driver passes of a run. Reads are declared with
+    # plan_stream, the stages reading them with plan_stage, and run_plan
+    # fuses the stages into passes and runs them
+    plan_spec=$work/plan_spec.tsv
+    : > "$plan_spec"
+}
+
+plan_stream()
+{
+    # Reads of the plan: their name, the stages writing them, whether their
+    # files are removed after the last pass reading them, and the files
+    fun_name=$1; shift
+    fun_producers=$1; shift
+    fun_temporary=$1; shift
+    printf 'stream\t%s\t%s\t%s\t%s\n' "$fun_name" "${fun_producers:--}" "${fun_temporary:-false}" "$*" >> "$plan_spec"
+}
+
+plan_stage()
+{
+    # A stage of the plan: its name and label, the reads it can take, the
+    # recalibration tables, interval and driver options it needs ("*" for
+    # any, empty for none), the stages it runs after, whether its pass can
+    # run in the background, its --algo arguments and a command run when
+    # its pass is done
+    printf 'stage\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' "$1" "$2" "$3" "${4:--}" "${5:--}" "${6:--}" "${7:--}" "${8:-false}" "$9" "${10}" >> "$plan_spec"
+}
+
+run_pass()
+{
+    # Run a driver pass of the plan and then the commands of its stages. A
+    # pass in the background waits for the tasks it queued itself
+    fun_pass_label=$1; shift
+    fun_pass_background=$1; shift
+    fun_pass_cmd=$1; shift
+    fun_pass_after=$1; shift
+    if [[ "$fun_pass_background" == "true" ]]; then
+        upload_pids=()
+        upload_names=()
+    fi
+    run "$fun_pass_cmd" "$fun_pass_label"
+    eval "$fun_pass_after"
+    if [[ "$fun_pass_background" == "true" ]]; then
+        upload_barrier
+    fi
+}
+
+run_plan()
+{
+    # Fuse the planned stages into the fewest driver passes over the reads
+    # and run the passes in order
+    fun_plan=$work/plan.tsv
+    python3 /opt/sentieon/plan_passes.py --driver "$release_dir/bin/sentieon driver" --threads $nt --reference "$ref" "$plan_spec" "$fun_plan"
+    while IFS=$'\t' read -r -u 3 fun_plan_kind fun_plan_label fun_plan_background fun_plan_cmd fun_plan_after; do
+        if [[ "$fun_plan_kind" == "release" ]]; then
+            for fun_plan_file in $fun_plan_label; do
+                rm -f "$fun_plan_file" "${fun_plan_file}".bai "${fun_plan_file}".crai &
+            done
+        elif [[ "$fun_plan_background" == "true" ]]; then
+            queue_task "$fun_plan_label" run_pass "$fun_plan_label" true "$fun_plan_cmd" "$fun_plan_after"
+        else
+            run_pass "$fun_plan_label" false "$fun_plan_cmd" "$fun_plan_after"
+        fi
+    done 3< "$fun_plan"
+}
+
+plan_mark_duplicates()
+{
+    # Plan the deduplication of the reads of a sample, declaring the
+    # ${base}deduped reads. The after command runs once they are written
     fun_base=$1; shift
     fun_dedup=$1; shift
-    fun_metrics_cmd=$1; shift
-    fun_bam_str=$1; shift
-    fun_bam_str_dest=$1; shift
-    fun_bams_dest=$1; shift
     fun_dedup_xargs=$1; shift
     fun_output_ext=$1; shift
     fun_two_pass=$1; shift
+    fun_temporary=$1; shift
+    fun_after=$1; shift
+    fun_bams_dest=$1; shift
     fun_local_bams=("$@")
 
-    if [[ "$fun_dedup" == "nodup" || (-z "$fun_bam_str" || -z "${fun_local_bams[@]}") ]]; then
-        eval "${fun_bam_str_dest}=\"$fun_bam_str\""
-        eval "${fun_bams_dest}=(\"${fun_local_bams[@]}\")"
-    else
-        # LocusCollector
-        cmd="$release_dir/bin/sentieon driver --traverse_param=200000/10000 $fun_bam_str -t $nt -r \"$ref\" --algo LocusCollector $work/${fun_base}score.txt"
-        if [[ -n $(eval "echo \$$fun_metrics_cmd") ]]; then
-            eval "cmd+=\" \$$fun_metrics_cmd \""
-            eval "$fun_metrics_cmd=''"
-        fi
-        run "$cmd" "Locus collector"
+    if [[ "$fun_dedup" != "nodup" ]] && checkpoint_exists "${fun_base}dedup"; then
+        # Deduplicated by an earlier attempt
+        restore_checkpoint "${fun_base}dedup" fun_restored_files
+        fun_dedup_bam=${fun_restored_files[0]}
+        eval "${fun_bams_dest}=(${fun_dedup_bam})"
+        plan_stream "${fun_base}deduped" "" "$fun_temporary" $fun_dedup_bam
+        eval "$fun_after"
+        return
+    fi
+    if [[ -z "${fun_local_bams[*]}" ]]; then
+        eval "${fun_bams_dest}=()"
+        return
+    fi
+    if [[ "$fun_dedup" == "nodup" ]]; then
+        eval "${fun_bams_dest}=(\"\${fun_local_bams[@]}\")"
+        plan_stream "${fun_base}deduped" "" "$fun_temporary" "${fun_local_bams[@]}"
+        eval "$fun_after"
+        return
+    fi
 
-        # Dedup pre-pass
-        if [[ "$fun_two_pass" == "true" ]]; then
-            cmd="$release_dir/bin/sentieon driver --traverse_param=200000/10000 $fun_bam_str -t $nt -r \"$ref\" --algo Dedup --score_info $work/${fun_base}score.txt --metrics $metrics_dir/${fun_base}dedup_metrics.txt --output_dup_read_name $work/${fun_base}dedup_qname.txt.gz"
-            run "$cmd" "Dedup pre-pass"
-            fun_dedup_xargs="${fun_dedup_xargs} --dup_read_name $work/${fun_base}dedup_qname.txt.gz"
-        else
-            fun_dedup_xargs="${fun_dedup_xargs} --score_info $work/${fun_base}score.txt --metrics $metrics_dir/${fun_base}dedup_metrics.txt"
-        fi
+    plan_stream "${fun_base}sorted" "" true "${fun_local_bams[@]}"
+    fun_traverse="--traverse_param=200000/10000"
 
-        # Dedup
-        dedup_bam=$work/${fun_base}dedup.${fun_output_ext}
-        if [[ "$fun_dedup" != "markdup" ]]; then
-            fun_dedup_xargs="${fun_dedup_xargs} --rmdup "
-        fi
-        cmd="$release_dir/bin/sentieon driver -r \"$ref\" --traverse_param=200000/10000 $fun_bam_str -t $nt --algo Dedup ${fun_dedup_xargs} $dedup_bam"
-        run "$cmd" $fun_dedup
-        eval "${fun_bam_str_dest}=\" -i $dedup_bam \""
-        eval "${fun_bams_dest}=(${dedup_bam})"
+    # LocusCollector
+    if checkpoint_exists "${fun_base}score"; then
+        restore_checkpoint "${fun_base}score" fun_restored_files
+    else
+        plan_stage "${fun_base}locus_collector" "Locus collector" "${fun_base}sorted" "" "" "$fun_traverse" "" false \
+            "--algo LocusCollector $work/${fun_base}score.txt" "save_checkpoint ${fun_base}score $work/${fun_base}score.txt"
+    fi
+    fun_needs="${fun_base}locus_collector"
+
+    # Dedup pre-pass
+    if [[ "$fun_two_pass" == "true" ]]; then
+        plan_stage "${fun_base}dedup_prepass" "Dedup pre-pass" "${fun_base}sorted" "" "" "$fun_traverse" "$fun_needs" false \
+            "--algo Dedup --score_info $work/${fun_base}score.txt --metrics $metrics_dir/${fun_base}dedup_metrics.txt --output_dup_read_name $work/${fun_base}dedup_qname.txt.gz" ""
+        fun_dedup_xargs="${fun_dedup_xargs} --dup_read_name $work/${fun_base}dedup_qname.txt.gz"
+        fun_needs="${fun_base}dedup_prepass"
+    else
+        fun_dedup_xargs="${fun_dedup_xargs} --score_info $work/${fun_base}score.txt --metrics $metrics_dir/${fun_base}dedup_metrics.txt"
+    fi
+
+    # Dedup
+    fun_dedup_bam=$work/${fun_base}dedup.${fun_output_ext}
+    if [[ "$fun_dedup" != "markdup" ]]; then
+        fun_dedup_xargs="${fun_dedup_xargs} --rmdup "
     fi
+    if [[ "$fun_output_ext" == "cram" ]]; then
+        fun_dedup_xargs="${fun_dedup_xargs} $cram_write_options"
+    fi
+    # The dedup BAM is checkpointed first, as restore_checkpoint keeps the
+    # order
+    plan_stage "${fun_base}dedup" "$fun_dedup" "${fun_base}sorted" "" "" "$fun_traverse" "$fun_needs" false \
+        "--algo Dedup ${fun_dedup_xargs} $fun_dedup_bam" "save_checkpoint ${fun_base}dedup $fun_dedup_bam $metrics_dir/${fun_base}dedup_metrics.txt; $fun_after"
+    plan_stream "${fun_base}deduped" "${fun_base}dedup" "$fun_temporary" $fun_dedup_bam
+    eval "${fun_bams_dest}=(${fun_dedup_bam})"
 }
 
-run_bqsr()
+plan_bqsr()
 {
+    # Plan the recalibration of the reads of a sample with the bqsr_sites,
+    # and with metrics, the table after recalibration for the BQSR plot
     fun_base=$1; shift
-    fun_bam_str=$1; shift
-    fun_metrics_cmd=$1; shift
-    fun_bqsr2=$1; shift
-    fun_bqsr3=$1; shift
-    fun_bqsr4=$1; shift
-    fun_table=$1; shift
-    fun_plot=$1; shift
-
-    fun_bqsr_cmd2=
-    fun_bqsr_cmd3=
-    fun_bqsr_cmd4=
-    csv=$work/${fun_base}recal.csv
-    plot=$work/${fun_base}bqsr_report.pdf
+    fun_stream=$1; shift
+    fun_table_dest=$1; shift
+
     fun_bqsr_table=
-    if [[ -n "$bqsr_sites" && -n "$fun_bam_str" ]]; then
+    if [[ -n "$bqsr_sites" ]]; then
         fun_bqsr_table=$work/${fun_base}recal_data.table
-        fun_bqsr_post=$work/${fun_base}recal_data.table.post
-        cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} -t $nt -r \"$ref\" $fun_bam_str --algo QualCal $bqsr_sites $fun_bqsr_table"
-        if [[ -n $(eval "echo \$$fun_metrics_cmd") ]]; then
-            eval "cmd+=\" \$$fun_metrics_cmd \""
-            eval "$fun_metrics_cmd=''"
+        if checkpoint_exists "${fun_base}bqsr"; then
+            restore_checkpoint "${fun_base}bqsr" fun_restored_files
+        else
+            plan_stage "${fun_base}qualcal" "BQSR" "$fun_stream" "" "$interval" "" "" false \
+                "--algo QualCal $bqsr_sites $fun_bqsr_table" "save_checkpoint ${fun_base}bqsr $fun_bqsr_table"
         fi
-        run "$cmd" "BQSR"
         if [[ -z "$NO_METRICS" ]]; then
-            fun_bqsr_cmd2="--algo QualCal $bqsr_sites $fun_bqsr_post"
-            fun_bqsr_cmd3="$release_dir/bin/sentieon driver --algo QualCal --plot --before $fun_bqsr_table --after $fun_bqsr_post $csv"
-            fun_bqsr_cmd4="$release_dir/bin/sentieon plot bqsr -o $plot $csv"
+            plan_stage "${fun_base}qualcal_post" "BQSR post" "$fun_stream" "$fun_bqsr_table" "*" "*" "${fun_base}qualcal" false \
+                "--algo QualCal $bqsr_sites ${fun_bqsr_table}.post" "plot_bqsr '${fun_base}'"
         fi
     fi
-
-    eval "$fun_bqsr2='$fun_bqsr_cmd2'"
-    eval "$fun_bqsr3='$fun_bqsr_cmd3'"
-    eval "$fun_bqsr4='$fun_bqsr_cmd4'"
-    eval "$fun_table='$fun_bqsr_table'"
-    eval "$fun_plot='$plot'"
+    eval "$fun_table_dest='$fun_bqsr_table'"
 }
 
-run_bqsr_post()
+plot_bqsr()
 {
-    fun_bam_str=$1; shift
-    fun_bqsr2=$1; shift
-    fun_bqsr3=$1; shift
-    fun_bqsr4=$1; shift
-    fun_table=$1; shift
-    fun_plot=$1; shift
-    fun_upload_pid=$1; shift
-
-    eval "fun_bqsr_cmd2=\$$fun_bqsr2"
-    eval "fun_bqsr_cmd3=\$$fun_bqsr3"
-    eval "fun_bqsr_cmd4=\$$fun_bqsr4"
-
-    if [[ -n "$fun_bqsr_cmd2" && -n "$fun_bam_str" && -f "$fun_table" ]]; then
-        cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} -t $nt -r $ref $fun_bam_str -q $fun_table $fun_bqsr_cmd2"
-        run "$cmd" "BQSR post"
-        run "$fun_bqsr_cmd3" "BQSR CSV"
-        run "$fun_bqsr_cmd4" "BQSR plot"
-        gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fun_plot "$out_metrics" &
-        eval "$fun_upload_pid=$1 "
-    fi
-
-    eval "$fun_bqsr2=\"\""
-    eval "$fun_bqsr3=\"\""
-    eval "$fun_bqsr4=\"\""
+    # Plot the base qualities of a sample before and after recalibration
+    fun_base=$1
+    fun_csv=$work/${fun_base}recal.csv
+    fun_plot=$work/${fun_base}bqsr_report.pdf
+    run "$release_dir/bin/sentieon driver --algo QualCal --plot --before $work/${fun_base}recal_data.table --after $work/${fun_base}recal_data.table.post $fun_csv" "BQSR CSV"
+    run "$release_dir/bin/sentieon plot bqsr -o $fun_plot $fun_csv" "BQSR plot"
+    queue_task "BQSR plot upload" upload "$fun_plot" "$out_metrics"
 }
 
 generate_nondecoy_bed()
@@ -458,6 +900,8 @@ generate_nondecoy_bed()
     fun_reference_fai=$1; shift
     fun_output_dest=$1; shift
 
-    grep -v "hs37d5\|chrEBV\|hs38d1\|decoy" "$fun_reference_fai" | awk 'BEGIN{OFS="\t"} {print $1,0,$2}' > "$fun_output_dest"
+    # Written to a temporary file, as the samples of a packed job share it
+    grep -v "hs37d5\|chrEBV\|hs38d1\|decoy" "$fun_reference_fai" | awk 'BEGIN{OFS="\t"} {print $1,0,$2}' > "${fun_output_dest}.$$"
+    mv "${fun_output_dest}.$$" "$fun_output_dest"
 }
 
@@ -4,8 +4,8 @@ set -xveo pipefail
 set +H
 
 BASEDIR=$(dirname "$0")
-scratch=/mnt/work
-nt=$(nproc)
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=${THREADS:-$(nproc)}
 source $BASEDIR/gc_functions.sh
 
 # Set "None" variables to an empty string
@@ -13,14 +13,22 @@ environmental_variables=(FQ1 FQ2 BAM OUTPUT_BUCKET REF READGROUP DEDUP \
     BQSR_SITES DBSNP INTERVAL INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT \
     NO_HAPLOTYPER GVCF_OUTPUT STREAM_INPUT PIPELINE OUTPUT_CRAM_FORMAT \
     SENTIEON_KEY RECALIBRATED_OUTPUT EMAIL SENTIEON_VERSION CALLING_ARGS \
-    DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT)
+    DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT REFERENCE_BUNDLE \
+    CHECKPOINTS START_FROM RECAL_TABLE ARTIFACT_CACHE)
 unset_none_variables ${environmental_variables[@]}
-OUTPUT_CRAM_FORMAT="" # Not yet supported
+
+# Calling from the outputs of an earlier run repeats no other stages
+if [[ "$START_FROM" == "CALLING" ]]; then
+    NO_METRICS=true
+    NO_BAM_OUTPUT=true
+    BQSR_SITES=""
+fi
 
 readonly FQ1 FQ2 BAM OUTPUT_BUCKET REF READGROUP DEDUP BQSR_SITES DBSNP \
     INTERVAL INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT NO_HAPLOTYPER GVCF_OUTPUT \
     STREAM_INPUT PIPELINE OUTPUT_CRAM_FORMAT SENTIEON_KEY RECALIBRATED_OUTPUT \
-    EMAIL SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT
+    EMAIL SENTIEON_VERSION CALLING_ARGS DNASCOPE_MODEL CALLING_ALGO REQUESTER_PROJECT \
+    REFERENCE_BUNDLE CHECKPOINTS START_FROM RECAL_TABLE ARTIFACT_CACHE
 
 release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
 
@@ -35,6 +43,11 @@ if [[ -n "$INTERVAL" && -n "$INTERVAL_FILE" ]]; then
     exit 1
 fi
 
+if [[ -n "$START_FROM" && -z "$BAM" ]]; then
+    echo "START_FROM requires the deduplicated BAM of an earlier run"
+    exit 1
+fi
+
 if [[ -n "$NO_BAM_OUTPUT" && -n "$NO_HAPLOTYPER" && -n "$NO_METRICS" ]]; then
     echo "Nothing to do"
     exit 1
@@ -47,8 +60,21 @@ gc_setup
 export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
 export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
 
+## The BAM input of a run starting from an intermediate stage is
+## already deduplicated
+dedup=$DEDUP
+if [[ -n "$START_FROM" ]]; then
+    dedup="nodup"
+fi
+
+## Reads deduplicated by an earlier attempt need no alignment
+dedup_done=
+if [[ "$dedup" != "nodup" ]] && checkpoint_exists dedup; then
+    dedup_done=true
+fi
+
 ## Download input files
-if [[ -n "$BAM" ]]; then
+if [[ -n "$BAM" && -z "$dedup_done" ]]; then
     download_bams "$BAM" local_bams $input_dir
 else
     local_bams=()
@@ -57,7 +83,7 @@ fi
 download_intervals
 download_reference
 if [[ $CALLING_ALGO == "DNAscope" && -n "$DNASCOPE_MODEL" ]]; then
-    curl -L -o ${input_dir}/dnascope.model "$DNASCOPE_MODEL"
+    fetch_artifact "$DNASCOPE_MODEL" ${input_dir}/dnascope.model
 fi
 
 ## Handle the sites files
@@ -71,19 +97,22 @@ if [[ -n "$DBSNP" ]]; then
     dbsnp="${local_sites[0]}"
 fi
 
+if [[ -n "$RECAL_TABLE" ]]; then
+    recal_table=$input_dir/$(basename "$RECAL_TABLE")
+    transfer "$RECAL_TABLE" "$recal_table"
+fi
+
+## Wait for the input BAM files downloading in the background
+wait_for_bams
+
 # ******************************************
 # 1. Mapping reads with BWA-MEM, sorting
 # ******************************************
 output_ext="bam"
-if [[ -n $FQ1 ]]; then
+if [[ -n $FQ1 && -z "$dedup_done" ]]; then
     bwa_mem_align "" "$FQ1" "$FQ2" "$READGROUP" local_bams $output_ext "-M -K 10000000" "$util_sort_xargs" "false"
 fi
 
-local_bams_str=""
-for bam in "${local_bams[@]}"; do
-    local_bams_str+=" -i \"$bam\" "
-done
-
 # ******************************************
 # 2. Metrics command
 # ******************************************
@@ -94,69 +123,72 @@ if [[ -z "$NO_METRICS" ]]; then
     build_metrics_cmd "" metrics_cmd1 metrics_cmd2 metrics_files
 fi
 
+## The driver passes of the following stages are planned together, so
+## that stages reading the same reads share a pass
+plan_reset
+
 # ******************************************
 # 3. Remove duplicates
 # ******************************************
 output_ext="bam"
-
-run_mark_duplicates "" "$DEDUP" metrics_cmd1 "$local_bams_str" dedup_bam_str dedup_bams "$dedup_xargs" $output_ext "false" "${local_bams[@]}"
-if [[ "$DEDUP" != "nodup" ]]; then
-    if [[ -z "$NO_METRICS" ]]; then
-        (gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $metrics_dir/dedup_metrics.txt "$out_metrics" &&
-            rm $metrics_dir/dedup_metrics.txt) &
-        upload_dedup_pid=$!
-    else
-        rm $metrics_dir/dedup_metrics.txt &
-    fi
-    for bam in "${local_bams[@]}"; do
-        if [[ -f "$bam" ]]; then
-            rm "$bam" &
-        fi
-        if [[ -f "${bam}".bai ]]; then
-            rm "${bam}".bai &
-        fi
-        if [[ -f "${bam}".crai ]]; then
-            rm "${bam}".crai &
-        fi
-    done
+if [[ -n "$OUTPUT_CRAM_FORMAT" ]]; then
+    output_ext="cram"
 fi
 
-if [[ -z "$NO_BAM_OUTPUT" && (-z "$bqsr_sites" || -z "$RECALIBRATED_OUTPUT" ) ]]; then
-    upload_list=""
-    for bam in "${dedup_bams[@]}"; do
-        upload_list+=" \"$bam\" "
-        if [[ -f "${bam}.bai" ]]; then
-            upload_list+=" \"${bam}.bai\" "
-        elif [[ -f "${bam}.crai" ]]; then
-            upload_list+=" \"${bam}.crai\" "
+dedup_finished()
+{
+    if [[ "$dedup" != "nodup" ]]; then
+        if [[ -z "$NO_METRICS" ]]; then
+            queue_task "Dedup metrics upload" upload_and_remove $metrics_dir/dedup_metrics.txt "$out_metrics"
+        else
+            rm $metrics_dir/dedup_metrics.txt &
         fi
-    done
-    eval gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $upload_list "$out_bam" &
-    upload_deduped_pid=$!
-fi
+    fi
+    if [[ -z "$NO_BAM_OUTPUT" && -z "$START_FROM" && (-z "$bqsr_sites" || -z "$RECALIBRATED_OUTPUT" ) ]]; then
+        upload_list=()
+        for bam in "${dedup_bams[@]}"; do
+            upload_list+=("$bam")
+            if [[ -f "${bam}.bai" ]]; then
+                upload_list+=("${bam}.bai")
+            elif [[ -f "${bam}.crai" ]]; then
+                upload_list+=("${bam}.crai")
+            fi
+        done
+        queue_task "Deduped BAM upload" upload "${upload_list[@]}" "$out_bam"
+    fi
+}
+
+plan_mark_duplicates "" "$dedup" "$dedup_xargs" $output_ext "false" "false" dedup_finished dedup_bams "${local_bams[@]}"
 
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
+metrics_finished()
+{
+    queue_task "Metrics upload" plot_and_upload_metrics "$metrics_cmd2" "${metrics_files[@]}"
+}
+
+if [[ -n "$metrics_cmd1" ]]; then
+    plan_stage metrics "Metrics collection" "deduped,sorted" "*" "*" "*" "" false "$metrics_cmd1" metrics_finished
+fi
 
 # ******************************************
 # 4. Base recalibration
 # ******************************************
-run_bqsr "" "$dedup_bam_str" metrics_cmd1 bqsr_cmd2 bqsr_cmd3 bqsr_cmd4 bqsr_table bqsr_plot
-
-if [[ -n "$bqsr_sites" && -z "$NO_BAM_OUTPUT" && -n "$RECALIBRATED_OUTPUT" ]]; then
-    outrecal=$work/recalibrated.bam
-    cmd="$release_dir/bin/sentieon driver $dedup_bam_str -q $bqsr_table --algo ReadWriter $outrecal"
-    (run "$cmd" "ReadWriter";
-        gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $outrecal ${outrecal}.bai "$out_bam") &
-    upload_recal_pid=$!
+if [[ -n "$RECAL_TABLE" ]]; then
+    # Apply the table of an earlier run instead of recalibrating
+    bqsr_table=$recal_table
+else
+    plan_bqsr "" deduped bqsr_table
 fi
 
-if [[ -n "$bqsr_sites" && -z "$NO_BAM_OUTPUT" && -z "$RECALIBRATED_OUTPUT" ]]; then
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $bqsr_table "$out_bam" &
-    upload_bqsr_pid=$!
+if [[ -n "$bqsr_table" && -z "$NO_BAM_OUTPUT" && -n "$RECALIBRATED_OUTPUT" ]]; then
+    outrecal=$work/recalibrated.${output_ext}
+    outrecal_idx=${outrecal}.bai
+    if [[ "$output_ext" == "cram" ]]; then
+        outrecal_idx=${outrecal}.crai
+    fi
+    plan_stage read_writer "ReadWriter" deduped "$bqsr_table" "" "" qualcal true \
+        "--algo ReadWriter ${OUTPUT_CRAM_FORMAT:+$cram_write_options} $outrecal" "queue_task \"Recalibrated BAM upload\" upload $outrecal $outrecal_idx \"$out_bam\""
 fi
 
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
-
 
 # ******************************************
 # 5. Variant Calling
@@ -184,24 +216,8 @@ if [[ $CALLING_ALGO == "DNAscope" ]]; then
     tmpvcf=$work/tmp.vcf.gz
 fi
 
-if [[ -z $NO_HAPLOTYPER ]]; then
-    if [[ -n "$GVCF_OUTPUT" ]]; then
-        cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" $dedup_bam_str ${bqsr_table:+-q $bqsr_table} --algo $algo $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} --emit_mode gvcf ${outgvcf}"
-        outfile=$outgvcf
-    else
-        cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" $dedup_bam_str ${bqsr_table:+-q $bqsr_table} --algo $algo $CALLING_ARGS $extra_vcf_args ${dbsnp:+-d \"$dbsnp\"} ${outvcf}"
-        outfile=$outvcf
-    fi
-    if [[ -n $metrics_cmd1 ]]; then
-        cmd+=" $metrics_cmd1"
-        metrics_cmd1=
-    fi
-    if [[ -n $bqsr_cmd2 ]]; then
-        cmd+=" $bqsr_cmd2"
-        bqsr_cmd2=
-    fi
-    run "$cmd" "Variant calling"
-
+calling_finished()
+{
     # DNAscope SV calling
     if [[ $CALLING_ALGO == "DNAscope" && -z "$GVCF_OUTPUT" && -z "$DNASCOPE_MODEL" ]]; then
         mv $outvcf $tmpvcf
@@ -218,53 +234,30 @@ if [[ -z $NO_HAPLOTYPER ]]; then
         run "$cmd" "DNAscope model apply"
     fi
 
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $outfile ${outfile}.tbi "$out_variants" &
-    upload_vcf_pid=$!
-fi
+    queue_task "VCF upload" upload $outfile ${outfile}.tbi "$out_variants"
+}
 
-if [[ -n $metrics_cmd1 ]]; then
-    cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} -t $nt -r \"$ref\" $dedup_bam_str ${bqsr_table:+-q $bqsr_table}"
-    cmd+=" $metrics_cmd1"
-    run "$cmd" "Metrics collection"
+if [[ -z $NO_HAPLOTYPER ]]; then
+    if [[ -n "$GVCF_OUTPUT" ]]; then
+        calling_args="--algo $algo $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} --emit_mode gvcf ${outgvcf}"
+        outfile=$outgvcf
+    else
+        calling_args="--algo $algo $CALLING_ARGS $extra_vcf_args ${dbsnp:+-d \"$dbsnp\"} ${outvcf}"
+        outfile=$outvcf
+    fi
+    plan_stage calling "Variant calling" deduped "$bqsr_table" "$call_interval" "" qualcal false "$calling_args" calling_finished
 fi
 
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
-
-
-if [[ -n $bqsr_cmd2 ]]; then
-    cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} -t $nt -r \"$ref\" $dedup_bam_str -q $bqsr_table $bqsr_cmd2"
-    bqsr_cmd2=
-    run "$cmd" "BQSR Post"
-fi
+# ******************************************
+# 6. Run the planned passes
+# ******************************************
+run_plan
 
-if [[ -n $bqsr_cmd3 ]]; then
-    run "$bqsr_cmd3" "BQSR CSV"
-    run "$bqsr_cmd4" "BQSR plot"
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $plot "$out_metrics" &
-    upload_bqsr_metrics_pid=$!
+if [[ -n "$bqsr_sites" && -z "$RECAL_TABLE" && -z "$NO_BAM_OUTPUT" && -z "$RECALIBRATED_OUTPUT" ]]; then
+    queue_task "BQSR table upload" upload $bqsr_table "$out_bam"
 fi
 
-# Wait for all running uploads to finish
-set +e
-if [[ -n $upload_recal_pid ]]; then
-    wait $upload_recal_pid
-fi
-if [[ -n $upload_metrics_pid ]]; then
-    wait $upload_metrics_pid
-fi
-if [[ -n $upload_dedup_pid ]]; then
-    wait $upload_dedup_pid
-fi
-if [[ -n $upload_deduped_pid ]]; then
-    wait $upload_deduped_pid
-fi
-if [[ -n $upload_bqsr_pid ]]; then
-    wait $upload_bqsr_pid
-fi
-if [[ -n $upload_vcf_pid ]]; then
-    wait $upload_vcf_pid
-fi
-if [[ -n $upload_bqsr_metrics_pid ]]; then
-    wait $upload_bqsr_metrics_pid
-fi
+# Wait for all queued uploads to finish
+upload_barrier
+remove_checkpoints
 exit 0
@@ -0,0 +1,171 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=$(nproc)
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(GVCFS GVCF_MANIFEST OUTPUT_BUCKET REF DBSNP \
+    INTERVAL INTERVAL_FILE SHARD SHARD_OUTPUTS PIPELINE SENTIEON_KEY EMAIL \
+    SENTIEON_VERSION CALLING_ARGS REQUESTER_PROJECT REFERENCE_BUNDLE \
+    ARTIFACT_CACHE)
+unset_none_variables ${environmental_variables[@]}
+
+readonly GVCFS GVCF_MANIFEST OUTPUT_BUCKET REF DBSNP INTERVAL INTERVAL_FILE \
+    SHARD SHARD_OUTPUTS PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION \
+    CALLING_ARGS REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE
+
+release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
+
+# GVCFs are read in batches, with a fresh access token for each
+slice_batch_size=1000
+
+# Basic error handling #
+if [[ -z "$GVCFS" && -z "$GVCF_MANIFEST" && -z "$SHARD_OUTPUTS" ]]; then
+    echo "Please supply the GVCFS or GVCF_MANIFEST to genotype, or the SHARD_OUTPUTS to merge"
+    exit 1
+fi
+
+if [[ -n "$INTERVAL" && -n "$INTERVAL_FILE" ]]; then
+    echo "Please supply either an INTERVAL or INTERVAL_FILE, not both"
+    exit 1
+fi
+
+slice_gvcf()
+{
+    # Stream the slice_regions of a remote GVCF into a local file. Only the
+    # blocks that the tabix index lists for the regions are read
+    set -eo pipefail
+    fun_n=$1
+    fun_src=$2
+    fun_dst=$slice_dir/${fun_n}.g.vcf.gz
+    # htslib saves the remote index in the working directory, and the
+    # GVCFs of different samples often share a file name
+    fun_dir=$slice_dir/idx-${fun_n}
+    mkdir -p "$fun_dir"
+    for fun_try in 1 2 3; do
+        if (cd "$fun_dir" && tabix -h "$fun_src" $slice_regions | bgzip -c > "$fun_dst"); then
+            tabix -f -p vcf "$fun_dst"
+            rm -rf "$fun_dir"
+            return 0
+        fi
+        echo "Reading $fun_src failed (try $fun_try)"
+        sleep $((fun_try * 10))
+    done
+    return 1
+}
+
+# **********************************
+# 0. Setup
+# **********************************
+gc_setup
+export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
+export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
+
+# GVCFtyper keeps every input of the cohort open
+ulimit -n $(ulimit -Hn)
+
+## Download input files
+download_reference
+
+# ******************************************
+# Merge the genotyped shards
+# ******************************************
+if [[ -n "$SHARD_OUTPUTS" ]]; then
+    # Shards are merged in the order they are supplied (reference order)
+    IFS=',' read -r -a shard_outputs <<< "$SHARD_OUTPUTS"
+    shard_transfers=$(mktemp)
+    local_shards=()
+    for i in "${!shard_outputs[@]}"; do
+        local_shard=$input_dir/shard-${i}.$(basename "${shard_outputs[$i]}")
+        add_transfer "$shard_transfers" "${shard_outputs[$i]}" "$local_shard"
+        add_transfer "$shard_transfers" "${shard_outputs[$i]}".tbi "${local_shard}".tbi
+        local_shards+=("$local_shard")
+    done
+    transfer_many "$shard_transfers"
+
+    outfile=$work/joint.vcf.gz
+    cmd="$release_dir/bin/sentieon driver --passthru -t $nt --algo GVCFtyper --merge $outfile ${local_shards[@]}"
+    run "$cmd" "Merge shards"
+
+    upload $outfile ${outfile}.tbi "$out_variants"
+    exit 0
+fi
+
+download_intervals
+if [[ -n "$DBSNP" ]]; then
+    transfer_all_sites $dbsnp_dir "$DBSNP"
+    dbsnp="${local_sites[0]}"
+fi
+
+## The GVCFs of the cohort, one per line
+gvcf_list=$input_dir/gvcfs.txt
+if [[ -n "$GVCF_MANIFEST" ]]; then
+    transfer "$GVCF_MANIFEST" "$gvcf_list"
+else
+    tr ',' '\n' <<< "$GVCFS" > "$gvcf_list"
+fi
+sed -i -e 's/[[:space:]]*$//' -e '/^$/d' -e '/^#/d' "$gvcf_list"
+echo "Genotyping $(wc -l < "$gvcf_list") GVCF files"
+
+slice_dir=$input_dir/gvcfs
+mkdir -p $slice_dir
+local_list=$work/local_gvcfs.txt
+awk -v dir="$slice_dir" '{print dir "/" NR ".g.vcf.gz"}' "$gvcf_list" > "$local_list"
+
+shard_str=""
+if [[ -n "$SHARD" ]]; then
+    # Read only the regions of the shard from each GVCF
+    IFS=',' read -r -a shard_regions <<< "$SHARD"
+    for region in "${shard_regions[@]}"; do
+        shard_str+=" --shard $region "
+    done
+    export slice_dir slice_regions="${shard_regions[*]}"
+    export -f slice_gvcf
+    if [[ -n "$REQUESTER_PROJECT" ]]; then
+        export GCS_REQUESTER_PAYS_PROJECT=$REQUESTER_PROJECT
+    fi
+    awk '{print NR "\t" $0}' "$gvcf_list" | split -l $slice_batch_size - $work/slices-
+    for batch in $work/slices-*; do
+        # htslib reads gs:// paths with this token, which is kept out of
+        # the log
+        set +x
+        GCS_OAUTH_TOKEN=$(gcloud auth print-access-token)
+        export GCS_OAUTH_TOKEN
+        set -x
+        run "xargs -P $nt -L 1 bash -c 'slice_gvcf \"\$0\" \"\$1\"' < $batch" "Read the shard of $(wc -l < "$batch") GVCF files"
+        rm $batch
+    done
+else
+    gvcf_transfers=$(mktemp)
+    n=0
+    while read -r gvcf; do
+        n=$((n + 1))
+        add_transfer "$gvcf_transfers" "$gvcf" "$slice_dir/${n}.g.vcf.gz"
+        add_transfer "$gvcf_transfers" "${gvcf}.tbi" "$slice_dir/${n}.g.vcf.gz.tbi"
+    done < "$gvcf_list"
+    transfer_many "$gvcf_transfers"
+fi
+
+# ******************************************
+# 1. Joint genotyping
+# ******************************************
+if [[ -n "$SHARD" ]]; then
+    outfile=$work/shard.vcf.gz
+else
+    outfile=$work/joint.vcf.gz
+fi
+# The inputs are read from stdin, as a cohort can exceed the command line
+cmd="$release_dir/bin/sentieon driver ${interval:+--interval \"$interval\"} $shard_str -t $nt -r \"$ref\" --algo GVCFtyper $CALLING_ARGS ${dbsnp:+-d \"$dbsnp\"} $outfile - < $local_list"
+run "$cmd" "Joint genotyping"
+
+if [[ -n "$SHARD" ]]; then
+    upload $outfile ${outfile}.tbi "$OUTPUT_BUCKET/"
+else
+    upload $outfile ${outfile}.tbi "$out_variants"
+fi
+exit 0
@@ -0,0 +1,140 @@
+#!/usr/bin/env bash
+
+set -xveo pipefail
+set +H
+
+BASEDIR=$(dirname "$0")
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=$(nproc)
+source $BASEDIR/gc_functions.sh
+
+# Set "None" variables to an empty string
+environmental_variables=(PACK_JOBS PACK_PIPELINE PACK_CONCURRENCY \
+    OUTPUT_BUCKET PIPELINE SENTIEON_KEY EMAIL SENTIEON_VERSION \
+    REQUESTER_PROJECT REFERENCE_BUNDLE ARTIFACT_CACHE)
+unset_none_variables ${environmental_variables[@]}
+
+readonly PACK_JOBS PACK_PIPELINE PACK_CONCURRENCY OUTPUT_BUCKET PIPELINE \
+    SENTIEON_KEY EMAIL SENTIEON_VERSION REQUESTER_PROJECT REFERENCE_BUNDLE \
+    ARTIFACT_CACHE
+
+release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
+
+# Basic error handling #
+if [[ -z "$PACK_JOBS" ]]; then
+    echo "Please supply the PACK_JOBS to run"
+    exit 1
+fi
+
+case "$PACK_PIPELINE" in
+    GERMLINE) sample_script=$BASEDIR/gc_germline.sh ;;
+    CCDG) sample_script=$BASEDIR/gc_ccdg_germline.sh ;;
+    SOMATIC) sample_script=$BASEDIR/gc_somatic.sh ;;
+    *)
+        echo "The $PACK_PIPELINE pipeline cannot be packed"
+        exit 1
+        ;;
+esac
+
+run_sample()
+{
+    # Run the pipeline script of one sample in its own scratch space,
+    # skipping a sample completed by an earlier attempt
+    fun_n=$1
+    fun_done=$2
+    fun_output=$3
+    if gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} -q stat "$fun_done"; then
+        echo "Sample $fun_n was completed by an earlier attempt"
+        return 0
+    fi
+    fun_scratch=$scratch/sample-$fun_n
+    fun_log=$sample_dir/${fun_n}.log
+    mkdir -p $fun_scratch
+    fun_status=0
+    SCRATCH_DIR=$fun_scratch THREADS=$sample_threads bwt_max_mem=$sample_bwt_mem \
+        bash -c "source $sample_dir/${fun_n}.env && exec bash $sample_script" \
+        > $fun_log 2>&1 || fun_status=$?
+    echo "Sample $fun_n ($fun_output) exited with status $fun_status"
+    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $fun_log "$fun_output/worker_logs/packed.log" || true
+    rm -rf $fun_scratch
+    if [[ $fun_status -ne 0 ]]; then
+        return $fun_status
+    fi
+    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $sample_dir/empty "$fun_done"
+}
+
+# **********************************
+# 0. Setup, shared by all samples
+# **********************************
+export SHARED_DIR=$scratch/shared
+mkdir -p $SHARED_DIR
+## The BWA index of the reference bundle is unpacked if any sample aligns
+## FASTQ
+pack_fastq=$(python3 -c 'import json, os; jobs = json.loads(os.environ["PACK_JOBS"]); print("true" if any(x.get(k) not in (None, "", "None") for x in jobs for k in ("FQ1", "TUMOR_FQ1")) else "")')
+gc_setup
+
+## The environment of each sample, and the samples in order
+sample_dir=$scratch/samples
+mkdir -p $sample_dir
+touch $sample_dir/empty
+python3 - "$sample_dir" <<'EOF'
+import json
+import os
+import sys
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+sample_dir = sys.argv[1]
+with open(os.path.join(sample_dir, "samples.tsv"), "w") as samples:
+    for i, env in enumerate(json.loads(os.environ["PACK_JOBS"])):
+        with open(os.path.join(sample_dir, "{}.env".format(i)), "w") as f:
+            for key, value in sorted(env.items()):
+                f.write("export {}={}\n".format(key, quote(value)))
+        samples.write(
+            "{}\t{}\t{}\n".format(i, env["PACK_DONE"], env["OUTPUT_BUCKET"])
+        )
+EOF
+n_samples=$(wc -l < $sample_dir/samples.tsv)
+
+## Split the threads and memory between the samples running together
+concurrency=${PACK_CONCURRENCY:-1}
+if [[ $concurrency -gt $n_samples ]]; then
+    concurrency=$n_samples
+fi
+sample_threads=$((nt / concurrency))
+if [[ $sample_threads -lt 1 ]]; then
+    sample_threads=1
+fi
+mem_kb=$(grep "MemTotal" /proc/meminfo | awk '{print $2}')
+sample_bwt_mem=$((mem_kb / 1024 / 1024 / concurrency - 2))
+if [[ $sample_bwt_mem -lt 1 ]]; then
+    sample_bwt_mem=1
+fi
+sample_bwt_mem=${sample_bwt_mem}g
+
+# ******************************************
+# 1. Run the samples
+# ******************************************
+failed=0
+running=0
+while IFS=$'\t' read -r n done_marker sample_output; do
+    if [[ $running -ge $concurrency ]]; then
+        wait -n || failed=$((failed + 1))
+        running=$((running - 1))
+    fi
+    run_sample "$n" "$done_marker" "$sample_output" < /dev/null &
+    running=$((running + 1))
+done < $sample_dir/samples.tsv
+while [[ $running -gt 0 ]]; do
+    wait -n || failed=$((failed + 1))
+    running=$((running - 1))
+done
+
+if [[ $failed -gt 0 ]]; then
+    echo "$failed of $n_samples samples failed"
+    exit 1
+fi
+exit 0
@@ -4,8 +4,8 @@ set -xveo pipefail
 set +H
 
 BASEDIR=$(dirname "$0")
-scratch=/mnt/work
-nt=$(nproc)
+scratch=${SCRATCH_DIR:-/mnt/work}
+nt=${THREADS:-$(nproc)}
 source $BASEDIR/gc_functions.sh
 
 # Set "None" varibles to an empty string
@@ -13,9 +13,9 @@ environmental_variables=(FQ1 FQ2 TUMOR_FQ1 TUMOR_FQ2 BAM TUMOR_BAM \
     OUTPUT_BUCKET REF READGROUP TUMOR_READGROUP DEDUP BQSR_SITES DBSNP \
     INTERVAL INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT NO_VCF RUN_TNSNV \
     STREAM_INPUT PIPELINE REALIGN_SITES OUTPUT_CRAM_FORMAT SENTIEON_KEY \
-    EMAIL SENTIEON_VERSION CALLING_ARGS CALLING_ALGO REQUESTER_PROJECT)
+    EMAIL SENTIEON_VERSION CALLING_ARGS CALLING_ALGO REQUESTER_PROJECT \
+    REFERENCE_BUNDLE CHECKPOINTS ARTIFACT_CACHE)
 unset_none_variables ${environmental_variables[@]}
-OUTPUT_CRAM_FORMAT="" # Not yet supported
 
 # Basic error handling #
 if [[ -n "$TUMOR_FQ1" && -n "$TUMOR_BAM" ]]; then
@@ -57,7 +57,8 @@ readonly FQ1 FQ2 TUMOR_FQ1 TUMOR_FQ2 BAM TUMOR_BAM \
     OUTPUT_BUCKET REF READGROUP TUMOR_READGROUP DEDUP BQSR_SITES DBSNP \
     INTERVAL INTERVAL_FILE NO_METRICS NO_BAM_OUTPUT NO_VCF RUN_TNSNV \
     STREAM_INPUT PIPELINE REALIGN_SITES OUTPUT_CRAM_FORMAT EMAIL \
-    SENTIEON_VERSION CALLING_ARGS CALLING_ALGO
+    SENTIEON_VERSION CALLING_ARGS CALLING_ALGO REFERENCE_BUNDLE CHECKPOINTS \
+    ARTIFACT_CACHE
 
 release_dir="/opt/sentieon/sentieon-genomics-${SENTIEON_VERSION}/"
 
@@ -68,14 +69,26 @@ gc_setup
 export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libjemalloc.so.2
 export MALLOC_CONF="metadata_thp:auto,background_thread:true,dirty_decay_ms:30000,muzzy_decay_ms:30000"
 
+## Samples deduplicated by an earlier attempt need no alignment
+normal_dedup_done=
+tumor_dedup_done=
+if [[ "$DEDUP" != "nodup" ]]; then
+    if [[ -n "$FQ1$BAM" ]] && checkpoint_exists normal_dedup; then
+        normal_dedup_done=true
+    fi
+    if checkpoint_exists tumor_dedup; then
+        tumor_dedup_done=true
+    fi
+fi
+
 ## Download input files
-if [[ -n "$BAM" ]]; then
+if [[ -n "$BAM" && -z "$normal_dedup_done" ]]; then
     download_bams "$BAM" local_bams $input_dir
 else
     local_bams=()
 fi
 
-if [[ -n "$TUMOR_BAM" ]]; then
+if [[ -n "$TUMOR_BAM" && -z "$tumor_dedup_done" ]]; then
     download_bams "$TUMOR_BAM" tumor_bams $input_dir
 else
     tumor_bams=()
@@ -100,34 +113,38 @@ if [[ -n "$DBSNP" ]]; then
     dbsnp="${local_sites[0]}"
 fi
 
+## Wait for the input BAM files downloading in the background
+wait_for_bams
+
 # ******************************************
 # 1. Mapping reads with BWA-MEM, sorting
 # ******************************************
 output_ext="bam"
-if [[ -n "$FQ1" ]]; then
+if [[ -n "$FQ1" && -z "$normal_dedup_done" ]]; then
     bwa_mem_align "normal_" "$FQ1" "$FQ2" "$READGROUP" local_bams $output_ext "-M -K 10000000" "$util_sort_xargs" "false"
 fi
 
-local_bams_str=""
-for bam in "${local_bams[@]}"; do
-    local_bams_str+=" -i \"$bam\" "
-done
-
-if [[ -n "$TUMOR_FQ1" ]]; then
+if [[ -n "$TUMOR_FQ1" && -z "$tumor_dedup_done" ]]; then
     bwa_mem_align "tumor_" "$TUMOR_FQ1" "$TUMOR_FQ2" "$TUMOR_READGROUP" tumor_bams $output_ext "-M -K 10000000" "$util_sort_xargs" "false"
 fi
 
-tumor_bams_str=""
-for bam in "${tumor_bams[@]}"; do
-    tumor_bams_str+=" -i \"$bam\" "
-done
-
-# Detect the tumor and normal sample names
+# Detect the tumor and normal sample names, from the deduplicated BAM of
+# a sample restored from a checkpoint
+normal_sample_bam=${local_bams[0]}
+if [[ -n "$normal_dedup_done" ]]; then
+    restore_checkpoint normal_dedup restored_files
+    normal_sample_bam=${restored_files[0]}
+fi
+tumor_sample_bam=${tumor_bams[0]}
+if [[ -n "$tumor_dedup_done" ]]; then
+    restore_checkpoint tumor_dedup restored_files
+    tumor_sample_bam=${restored_files[0]}
+fi
 normal_sample=""
-if [[ -f ${local_bams[0]} ]]; then
-    normal_sample=$(samtools view -H ${local_bams[0]} | grep "^@RG" | head -n 1 | sed 's/^.*SM:\([^	]*\).*$/\1/')
+if [[ -f ${normal_sample_bam} ]]; then
+    normal_sample=$(samtools view -H ${normal_sample_bam} | grep "^@RG" | head -n 1 | sed 's/^.*SM:\([^	]*\).*$/\1/')
 fi
-tumor_sample=$(samtools view -H ${tumor_bams[0]} | grep "^@RG" | head -n 1 | sed 's/^.*SM:\([^	]*\).*$/\1/')
+tumor_sample=$(samtools view -H ${tumor_sample_bam} | grep "^@RG" | head -n 1 | sed 's/^.*SM:\([^	]*\).*$/\1/')
 
 # ******************************************
 # 2. Metrics command
@@ -145,179 +162,151 @@ if [[ -z "$NO_METRICS" ]]; then
     build_metrics_cmd "tumor_" tumor_metrics_cmd1 tumor_metrics_cmd2 tumor_metrics_files
 fi
 
+## The driver passes of the following stages are planned together, so
+## that stages reading the same reads share a pass
+plan_reset
+
 # ******************************************
 # 3. Remove duplicates
 # ******************************************
 output_ext="bam"
+if [[ -n "$OUTPUT_CRAM_FORMAT" ]]; then
+    output_ext="cram"
+fi
 
-run_mark_duplicates "normal_" "$DEDUP" metrics_cmd1 "$local_bams_str" dedup_bam_str dedup_bams "$dedup_xargs" $output_ext "false" "${local_bams[@]}"
-run_mark_duplicates "tumor_" "$DEDUP" tumor_metrics_cmd1 "$tumor_bams_str" tumor_dedup_bam_str tumor_dedup_bams "$dedup_xargs" $output_ext "false" "${tumor_bams[@]}"
-
-if [[ "$DEDUP" != "nodup" ]]; then
-    if [[ -z "$NO_METRICS" ]]; then
-        to_upload="$metrics_dir/tumor_dedup_metrics.txt"
-        if [[ -n "$dedup_bam_str" ]]; then
-            to_upload+=" $metrics_dir/normal_dedup_metrics.txt"
+## With realignment, the deduplicated reads are removed once realigned
+realign=
+if [[ -n "$REALIGN_SITES" && -n "$RUN_TNSNV" ]]; then
+    realign=true
+fi
+
+dedup_finished()
+{
+    # The outputs of the deduplication of the normal_ or tumor_ sample
+    fun_sample=$1
+    if [[ "$DEDUP" != "nodup" ]]; then
+        if [[ -z "$NO_METRICS" ]]; then
+            queue_task "Dedup metrics upload" upload_and_remove $metrics_dir/${fun_sample}dedup_metrics.txt "$out_metrics"
+        else
+            rm $metrics_dir/${fun_sample}dedup_metrics.txt &
         fi
-        (gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $to_upload "$out_metrics" &&
-            rm $metrics_dir/*_dedup_metrics.txt) &
-        upload_dedup_pid=$!
-    else
-        rm $metrics_dir/*_dedup_metrics.txt &
     fi
-    for bam in "${local_bams[@]}" "${tumor_bams[@]}"; do
-        if [[ -f "$bam" ]]; then
-            rm "$bam" &
-        fi
-        if [[ -f "${bam}".bai ]]; then
-            rm "${bam}".bai &
-        fi
-        if [[ -f "${bam}".crai ]]; then
-            rm "${bam}".crai &
-        fi
-    done
-fi
+    if [[ -z "$NO_BAM_OUTPUT" && -z "$REALIGN_SITES" ]]; then
+        upload_list=()
+        eval "fun_sample_bams=(\"\${${fun_sample}dedup_bams[@]}\")"
+        for bam in "${fun_sample_bams[@]}"; do
+            upload_list+=("$bam")
+            if [[ -f "${bam}.bai" ]]; then
+                upload_list+=("${bam}.bai")
+            elif [[ -f "${bam}.crai" ]]; then
+                upload_list+=("${bam}.crai")
+            fi
+        done
+        queue_task "Deduped BAM upload" upload "${upload_list[@]}" "$out_bam"
+    fi
+}
 
-if [[ -z "$NO_BAM_OUTPUT" && -z "$REALIGN_SITES" ]]; then
-    upload_list=""
-    for bam in "${dedup_bams[@]}" "${tumor_dedup_bams[@]}"; do
-        upload_list+=" \"$bam\" "
-        if [[ -f "${bam}.bai" ]]; then
-            upload_list+=" \"${bam}.bai\" "
-        elif [[ -f "${bam}.crai" ]]; then
-            upload_list+=" \"${bam}.crai\" "
-        fi
-    done
-    eval gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $upload_list "$out_bam" &
-    upload_deduped_pid=$!
+plan_mark_duplicates "normal_" "$DEDUP" "$dedup_xargs" $output_ext "false" "$realign" "dedup_finished normal_" normal_dedup_bams "${local_bams[@]}"
+plan_mark_duplicates "tumor_" "$DEDUP" "$dedup_xargs" $output_ext "false" "$realign" "dedup_finished tumor_" tumor_dedup_bams "${tumor_bams[@]}"
+normal_reads=
+if [[ -n "${normal_dedup_bams[*]}" ]]; then
+    normal_reads=normal_deduped
 fi
-
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
-upload_metrics tumor_metrics_cmd1 tumor_metrics_cmd2 tumor_upload_metrics_pid ${tumor_metrics_files[@]}
+tumor_reads=tumor_deduped
 
 # ******************************************
 # 4. Indel Realignment
 # ******************************************
-output_ext="bam"
-
-if [[ -n "$REALIGN_SITES" && -n "$RUN_TNSNV" ]]; then
+if [[ -n "$realign" ]]; then
     realigned_bam=$work/normal_realigned.${output_ext}
     tumor_realigned_bam=$work/tumor_realigned.${output_ext}
-    if [[ -n "$dedup_bam_str" ]]; then
-        cmd="$release_dir/bin/sentieon driver $dedup_bam_str -t $nt -r \"$ref\" --algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites $realigned_bam"
-        run "$cmd" "Indel Realign - Normal"
+    if [[ -n "$normal_reads" ]]; then
+        plan_stage normal_realign "Indel Realign - Normal" normal_deduped "" "" "" "" false \
+            "--algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites ${OUTPUT_CRAM_FORMAT:+$cram_write_options} $realigned_bam" ""
+        plan_stream normal_realigned normal_realign true $realigned_bam
+        normal_reads=normal_realigned
     fi
-    cmd="$release_dir/bin/sentieon driver $tumor_dedup_bam_str -t $nt -r \"$ref\" --algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites $tumor_realigned_bam"
-    run "$cmd" "Indel Realign - Tumor"
 
-    # Cleanup
-    for bam in "${dedup_bams[@]}" "${tumor_dedup_bams[@]}"; do
-        if [[ -f "$bam" ]]; then
-            rm "$bam" &
-        fi
-        if [[ -f "${bam}.bai" ]]; then
-            rm "${bam}".bai &
-        fi
-        if [[ -f "${bam}.crai" ]]; then
-            rm "${bam}".crai &
-        fi
-    done
-
-    if [[ -n "$dedup_bam_str" ]]; then
-        realigned_bams=($realigned_bam)
-        realigned_bam_str=" -i $realigned_bam "
-    else
-        realigned_bams=()
-        realigned_bam_str=""
+    # The realigned tumor reads are called and uploaded without a normal
+    tumor_realign_after=
+    if [[ -z "$normal_reads" ]]; then
+        tumor_realign_after=tumor_realigned_finished
     fi
-    tumor_realigned_bams=($tumor_realigned_bam)
-    tumor_realigned_bam_str=" -i $tumor_realigned_bam "
-else
-    realigned_bams="${dedup_bams[@]}"
-    realigned_bam_str=${dedup_bam_str}
-    tumor_realigned_bams="${tumor_dedup_bams[@]}"
-    tumor_realigned_bam_str=${tumor_dedup_bam_str}
+    tumor_realigned_finished()
+    {
+        upload_list=($tumor_realigned_bam)
+        if [[ -f "${tumor_realigned_bam}.bai" ]]; then
+            upload_list+=("${tumor_realigned_bam}.bai")
+        elif [[ -f "${tumor_realigned_bam}.crai" ]]; then
+            upload_list+=("${tumor_realigned_bam}.crai")
+        fi
+        queue_task "Realigned BAM upload" upload "${upload_list[@]}" "$out_bam"
+    }
+    plan_stage tumor_realign "Indel Realign - Tumor" tumor_deduped "" "" "" "" false \
+        "--algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites ${OUTPUT_CRAM_FORMAT:+$cram_write_options} $tumor_realigned_bam" "$tumor_realign_after"
+    plan_stream tumor_realigned tumor_realign "${normal_reads:+true}" $tumor_realigned_bam
+    tumor_reads=tumor_realigned
 fi
 
+metrics_finished()
+{
+    queue_task "Metrics upload" plot_and_upload_metrics "$metrics_cmd2" "${metrics_files[@]}"
+}
 
-# ******************************************
-# 5. Base recalibration
-# ******************************************
-run_bqsr "normal_" "$realigned_bam_str" metrics_cmd1 bqsr_cmd2 bqsr_cmd3 bqsr_cmd4 bqsr_table bqsr_plot
-# For paired samples, BQSR-post has to be run separately
-if [[ -n "$realigned_bam_str" ]]; then
-    run_bqsr_post "$realigned_bam_str" bqsr_cmd2 bqsr_cmd3 bqsr_cmd4 "$bqsr_table" "$bqsr_plot" upload_normal_bqsr_plot_pid
+tumor_metrics_finished()
+{
+    queue_task "Tumor metrics upload" plot_and_upload_metrics "$tumor_metrics_cmd2" "${tumor_metrics_files[@]}"
+}
+
+if [[ -n "$metrics_cmd1" && -n "$normal_reads" ]]; then
+    plan_stage normal_metrics "Metrics collection - Normal" "${normal_reads},normal_deduped,normal_sorted" "*" "*" "*" "" false "$metrics_cmd1" metrics_finished
 fi
-run_bqsr "tumor_" "$tumor_realigned_bam_str" tumor_metrics_cmd1 tumor_bqsr_cmd2 tumor_bqsr_cmd3 tumor_bqsr_cmd4 tumor_bqsr_table tumor_bqsr_plot
-if [[ -n "$realigned_bam_str" ]]; then
-    run_bqsr_post "$tumor_realigned_bam_str" tumor_bqsr_cmd2 tumor_bqsr_cmd3 tumor_bqsr_cmd4 "$tumor_bqsr_table" "$tumor_bqsr_plot" tumor_upload_normal_bqsr_plot_pid
+if [[ -n "$tumor_metrics_cmd1" ]]; then
+    plan_stage tumor_metrics "Metrics collection - Tumor" "${tumor_reads},tumor_deduped,tumor_sorted" "*" "*" "*" "" false "$tumor_metrics_cmd1" tumor_metrics_finished
 fi
 
-if [[ -n "$bqsr_sites" && -z "$NO_BAM_OUTPUT" ]]; then
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $bqsr_table $tumor_bqsr_table "$out_bam" &
-    upload_bqsr_pid=$!
+# ******************************************
+# 5. Base recalibration
+# ******************************************
+bqsr_table=
+if [[ -n "$normal_reads" ]]; then
+    plan_bqsr "normal_" $normal_reads bqsr_table
 fi
-
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
-upload_metrics tumor_metrics_cmd1 tumor_metrics_cmd2 tumor_upload_metrics_pid ${tumor_metrics_files[@]}
+plan_bqsr "tumor_" $tumor_reads tumor_bqsr_table
 
 # ******************************************
 # 6. Indel corealignment
 # ******************************************
-output_ext="bam"
-
-if [[ -n "$REALIGN_SITES" && -n "$RUN_TNSNV" && -n "$realigned_bam_str" ]]; then
+if [[ -n "$realign" && -n "$normal_reads" ]]; then
     corealigned_bam=$work/corealigned.${output_ext}
-    cmd="$release_dir/bin/sentieon driver $realigned_bam_str $tumor_realigned_bam_str -t $nt -r \"$ref\" --algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites $corealigned_bam"
-    run "$cmd" "Indel co-realignment"
-
-    # Cleanup
-    for bam in "${realigned_bams[@]}" "${tumor_realigned_bams[@]}"; do
-        if [[ -f "$bam" ]]; then
-            rm "$bam" &
-        fi
-        if [[ -f "${bam}".bai ]]; then
-            rm "${bam}".bai &
-        fi
-        if [[ -f "${bam}".crai ]]; then
-            rm "${bam}".crai &
-        fi
-    done
-    for site_file in "${local_realign_sites[@]}"; do
-        if [[ -f "$site_file" ]]; then
-            rm "$site_file" &
+    corealign_finished()
+    {
+        for site_file in "${local_realign_sites[@]}"; do
+            if [[ -f "$site_file" ]]; then
+                rm "$site_file" &
+            fi
+        done
+
+        # Upload
+        upload_list=" $corealigned_bam "
+        if [[ -f "${corealigned_bam}.bai" ]]; then
+            upload_list+=" ${corealigned_bam}.bai "
+        elif [[ -f "${corealigned_bam}.crai" ]]; then
+            upload_list+=" ${corealigned_bam}.crai "
         fi
-    done
-
-    # Upload
-    upload_list=" $corealigned_bam "
-    if [[ -f "${corealigned_bam}.bai" ]]; then
-        upload_list+=" ${corealigned_bam}.bai "
-    elif [[ -f "${corealigned_bam}.crai" ]]; then
-        upload_list+=" ${corealigned_bam}.crai "
-    fi
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $upload_list "$out_bam" &
-    upload_corealigned_pid=$!
-
-    corealigned_bam_str=" -i $corealigned_bam "
-elif [[ -n "$REALIGN_SITES" && -n "$RUN_TNSNV" ]]; then
-    upload_list=""
-    for bam in "${tumor_realigned_bams[@]}"; do
-        upload_list+=" \"$bam\" "
-        if [[ -f "${bam}.bai" ]]; then
-            upload_list+=" \"${bam}.bai\" "
-        elif [[ -f "${bam}.crai" ]]; then
-            upload_list+=" \"${bam}.crai\" "
-        fi
-    done
-    eval gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $upload_list "$out_bam" &
-    upload_corealigned_pid=$!
-
-    corealigned_bam_str=" $tumor_realigned_bam_str "
+        queue_task "Corealigned BAM upload" upload $upload_list "$out_bam"
+    }
+    plan_stream realigned normal_realign,tumor_realign true $realigned_bam $tumor_realigned_bam
+    plan_stage corealign "Indel co-realignment" realigned "" "" "" "" false \
+        "--algo Realigner ${interval_list:+--interval_list \"$interval_list\"} $realign_sites ${OUTPUT_CRAM_FORMAT:+$cram_write_options} $corealigned_bam" corealign_finished
+    plan_stream corealigned corealign false $corealigned_bam
+    calling_reads=corealigned
+elif [[ -n "$normal_reads" ]]; then
+    plan_stream paired normal_dedup,tumor_dedup false "${normal_dedup_bams[@]}" "${tumor_dedup_bams[@]}"
+    calling_reads=paired
 else
-    corealigned_bam_str="$realigned_bam_str $tumor_realigned_bam_str "
+    calling_reads=$tumor_reads
 fi
-corealigned_bqsr_str=" ${tumor_bqsr_table:+-q $tumor_bqsr_table} ${bqsr_table:+-q $bqsr_table}"
 
 # *******************************************
 # 7. Variant Calling
@@ -329,93 +318,27 @@ call_interval="$interval"
 call_interval=${call_interval:-"${ref}"_nondecoy.bed}
 
 if [[ -z "$NO_VCF" ]]; then
-    extra_calling_args=""
     algo="$CALLING_ALGO"
     vcf="$work"/"$CALLING_ALGO".vcf.gz
-
-    cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" $corealigned_bam_str $corealigned_bqsr_str -t $nt -r \"$ref\" --algo $algo $CALLING_ARGS ${normal_sample:+--normal_sample $normal_sample} --tumor_sample $tumor_sample ${dbsnp:+--dbsnp \"$dbsnp\"} $vcf"
-
-    if [[ -n $tumor_metrics_cmd1 ]]; then
-        cmd+=" $metrics_cmd1 "
-        cmd+=" $tumor_metrics_cmd1 "
-        metrics_cmd1=
-        tumor_metrics_cmd1=
+    calling_tables=$tumor_bqsr_table
+    if [[ -n "$bqsr_table" ]]; then
+        calling_tables+=",$bqsr_table"
     fi
-
-    if [[ -n $tumor_bqsr_cmd2 ]]; then
-        # cmd+=" $bqsr_cmd2 " Only 1 output file
-        cmd+=" $tumor_bqsr_cmd2 "
-        bqsr_cmd2=
-        tumor_bqsr_cmd2=
-    fi
-
-    run "$cmd" "Variant calling"
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $vcf ${vcf}.tbi "$out_variants" &
-    upload_vcf_pid=$!
+    plan_stage calling "Variant calling" $calling_reads "$calling_tables" "$call_interval" "" normal_qualcal,tumor_qualcal false \
+        "--algo $algo $CALLING_ARGS ${normal_sample:+--normal_sample $normal_sample} --tumor_sample $tumor_sample ${dbsnp:+--dbsnp \"$dbsnp\"} $vcf" \
+        "queue_task \"VCF upload\" upload $vcf ${vcf}.tbi \"$out_variants\""
 fi
 
-if [[ -n $tumor_metrics_cmd1 ]]; then
-    cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" $corealigned_bam_str $corealigned_bqsr_str"
-    cmd+=" $metrics_cmd1 "
-    cmd+=" $tumor_metrics_cmd1 "
-    metrics_cmd1=
-    tumor_metrics_cmd1=
-    run "$cmd" "Metrics collection"
-fi
-
-upload_metrics metrics_cmd1 metrics_cmd2 upload_metrics_pid ${metrics_files[@]}
-upload_metrics tumor_metrics_cmd1 tumor_metrics_cmd2 tumor_upload_metrics_pid ${tumor_metrics_files[@]}
-
-if [[ -n $bqsr_cmd2 ]]; then
-    cmd="$release_dir/bin/sentieon driver --interval \"$call_interval\" -t $nt -r \"$ref\" $corealigned_bam_str $corealigned_bqsr_str $bqsr_cmd2 $tumor_bqsr_cmd2"
-    bqsr_cmd2=
-    tumor_bqsr_cmd2=
-    run "$cmd" "BQSR Post"
-fi
+# *******************************************
+# 8. Run the planned passes
+# *******************************************
+run_plan
 
-if [[ -n $tumor_bqsr_cmd3 ]]; then
-    upload_list=""
-    if [[ -n $bqsr_cmd3 ]]; then
-        run "$bqsr_cmd3" "BQSR CSV"
-        run "$bqsr_cmd4" "BQSR plot"
-        upload_list+=" $bqsr_plot "
-    fi
-    run "$tumor_bqsr_cmd3" "Tumor BQSR CSV"
-    run "$tumor_bqsr_cmd4" "Tumor BQSR plot"
-    gsutil ${REQUESTER_PROJECT:+-u $REQUESTER_PROJECT} cp $upload_list $tumor_bqsr_plot "$out_metrics" &
-    upload_bqsr_metrics_pid=$!
+if [[ -n "$bqsr_sites" && -z "$NO_BAM_OUTPUT" ]]; then
+    queue_task "BQSR table upload" upload $bqsr_table $tumor_bqsr_table "$out_bam"
 fi
 
-# Wait for all running uploads to finish
-set +e
-if [[ -n $upload_normal_bqsr_plot_pid ]]; then
-    wait $upload_normal_bqsr_plot_pid
-fi
-if [[ -n $tumor_upload_normal_bqsr_plot_pid ]]; then
-    wait $tumor_upload_normal_bqsr_plot_pid
-fi
-if [[ -n $upload_dedup_pid ]]; then
-    wait $upload_dedup_pid
-fi
-if [[ -n $upload_deduped_pid ]]; then
-    wait $upload_deduped_pid
-fi
-if [[ -n $upload_metrics_pid ]]; then
-    wait $upload_metrics_pid
-fi
-if [[ -n $tumor_upload_metrics_pid ]]; then
-    wait $tumor_upload_metrics_pid
-fi
-if [[ -n $upload_bqsr_pid ]]; then
-    wait $upload_bqsr_pid
-fi
-if [[ -n $upload_corealigned_pid ]]; then
-    wait $upload_corealigned_pid
-fi
-if [[ -n $upload_vcf_pid ]]; then
-    wait $upload_vcf_pid
-fi
-if [[ -n $upload_bqsr_metrics_pid ]]; then
-    wait $upload_bqsr_metrics_pid
-fi
+# Wait for all queued uploads to finish
+upload_barrier
+remove_checkpoints
 exit 0
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import heapq
+import os
+import sys
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# A stage that runs with any value of a key, and a stage that runs without it
+ANY = "*"
+NONE = "-"
+# The settings of a driver pass other than its reads. A stage only joins a
+# pass with the same settings
+PASS_KEYS = ("table", "interval", "options")
+
+
+def process_args():
+    parser = argparse.ArgumentParser(
+        description="Fuse the stages of a pipeline into the fewest sentieon "
+        "driver passes over the reads, and report the passes and bytes read"
+    )
+    parser.add_argument(
+        "spec",
+        help="The reads and stages to plan, from plan_stream and plan_stage",
+    )
+    parser.add_argument(
+        "plan",
+        nargs="?",
+        help="The plan to write for run_plan. Without it, only the report "
+        "is printed",
+    )
+    parser.add_argument(
+        "--driver", default="sentieon driver", help="The driver command"
+    )
+    parser.add_argument("--threads", default="1", help="The driver threads")
+    parser.add_argument("--reference", default="ref.fa", help="The reference")
+    return parser.parse_args()
+
+
+def split_list(value):
+    items = []
+    for x in value.split(","):
+        if x and x != NONE and x not in items:
+            items.append(x)
+    return items
+
+
+def read_spec(path):
+    """The streams and the stages of a plan spec, in order"""
+    streams, stages = {}, []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "stream" and len(fields) == 5:
+                streams[fields[1]] = {
+                    "name": fields[1],
+                    "producers": split_list(fields[2]),
+                    "temporary": fields[3] == "true",
+                    "files": fields[4].split(),
+                }
+            elif fields[0] == "stage" and len(fields) == 11:
+                stage = dict(
+                    zip(
+                        (
+                            "name",
+                            "label",
+                            "reads",
+                            "table",
+                            "interval",
+                            "options",
+                            "needs",
+                            "background",
+                            "args",
+                            "after",
+                        ),
+                        fields[1:],
+                    )
+                )
+                stage["reads"] = split_list(stage["reads"])
+                stage["needs"] = split_list(stage["needs"])
+                stage["background"] = stage["background"] == "true"
+                stage["index"] = len(stages)
+                stages.append(stage)
+            elif line.strip():
+                raise ValueError("Unexpected line in the plan spec: " + line)
+    return streams, stages
+
+
+def check_spec(streams, stages):
+    """Drop the reads and stages that are not planned, as a stage completed
+    by an earlier attempt, and check that every stage comes after the
+    stages it needs"""
+    all_names = set(x["name"] for x in stages)
+    declared = set()
+    for stage in stages:
+        stage["reads"] = [x for x in stage["reads"] if x in streams]
+        if not stage["reads"]:
+            raise ValueError("Stage {} reads nothing".format(stage["name"]))
+        for name in stage["reads"]:
+            for producer in streams[name]["producers"]:
+                if producer not in declared and producer in all_names:
+                    raise ValueError(
+                        "Stage {} reads {} before it is written".format(
+                            stage["name"], name
+                        )
+                    )
+        for name in stage["needs"]:
+            if name not in declared and name in all_names:
+                raise ValueError(
+                    "Stage {} comes before {}".format(stage["name"], name)
+                )
+        stage["needs"] = [x for x in stage["needs"] if x in declared]
+        declared.add(stage["name"])
+    for stream in streams.values():
+        stream["producers"] = [
+            x for x in stream["producers"] if x in declared
+        ]
+
+
+def merge_value(a, b):
+    """The value of a key for two stages in one pass, or None if they
+    conflict"""
+    if a == ANY:
+        return b
+    if b == ANY or a == b:
+        return a
+    return None
+
+
+def is_flexible(stage):
+    return len(stage["reads"]) > 1 or ANY in [stage[x] for x in PASS_KEYS]
+
+
+def stage_order(streams, stages):
+    """The order stages are placed in. Stages that fit many passes and that
+    no stage depends on, such as metrics, are placed last, so that they
+    join the passes of the other stages"""
+    needed = set()
+    for stage in stages:
+        needed.update(stage["needs"])
+    for stream in streams.values():
+        needed.update(stream["producers"])
+    deferred = [
+        x for x in stages if is_flexible(x) and x["name"] not in needed
+    ]
+    return [x for x in stages if x not in deferred] + deferred
+
+
+def stage_deps(stage, stream):
+    return set(stage["needs"]) | set(stream["producers"])
+
+
+def pass_edges(passes, placed, streams):
+    """The passes each pass must run before"""
+    edges = dict((p["index"], set()) for p in passes)
+    for p in passes:
+        for stage in p["stages"]:
+            for dep in stage_deps(stage, streams[p["stream"]]):
+                edges[placed[dep]].add(p["index"])
+    return edges
+
+
+def reaches(edges, src, dst):
+    seen, todo = set(), [src]
+    while todo:
+        node = todo.pop()
+        if node == dst:
+            return True
+        if node not in seen:
+            seen.add(node)
+            todo.extend(edges[node])
+    return False
+
+
+def is_background(p):
+    return all(x["background"] for x in p["stages"])
+
+
+def fuse(streams, stages):
+    """Place each stage in the first pass over its reads with the same
+    settings that runs after the stages it needs, or in a new pass. Passes
+    run in the background are only joined if no other pass fits"""
+    passes, placed = [], {}
+    for stage in stage_order(streams, stages):
+        for p in sorted(passes, key=lambda x: (is_background(x), x["index"])):
+            if p["stream"] not in stage["reads"]:
+                continue
+            values = [merge_value(p[x], stage[x]) for x in PASS_KEYS]
+            if None in values:
+                continue
+            deps = set(
+                placed[x] for x in stage_deps(stage, streams[p["stream"]])
+            )
+            edges = pass_edges(passes, placed, streams)
+            if p["index"] in deps or any(
+                reaches(edges, p["index"], x) for x in deps
+            ):
+                continue
+            p.update(zip(PASS_KEYS, values))
+            break
+        else:
+            p = {
+                "index": len(passes),
+                "stream": stage["reads"][0],
+                "stages": [],
+            }
+            p.update((x, stage[x]) for x in PASS_KEYS)
+            passes.append(p)
+        p["stages"].append(stage)
+        placed[stage["name"]] = p["index"]
+
+    # Run the passes in the order they were created, after the passes they
+    # depend on
+    edges = pass_edges(passes, placed, streams)
+    incoming = dict((p["index"], 0) for p in passes)
+    for successors in edges.values():
+        for x in successors:
+            incoming[x] += 1
+    ready = [x for x, n in incoming.items() if n == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        index = heapq.heappop(ready)
+        order.append(passes[index])
+        for x in edges[index]:
+            incoming[x] -= 1
+            if incoming[x] == 0:
+                heapq.heappush(ready, x)
+    for p in order:
+        p["stages"].sort(key=lambda x: x["index"])
+        p["background"] = is_background(p) and not edges[p["index"]]
+    return order
+
+
+def pass_command(p, streams, args):
+    words = [args.driver]
+    if p["interval"] not in (ANY, NONE):
+        words += ["--interval", quote(p["interval"])]
+    if p["options"] not in (ANY, NONE):
+        words.append(p["options"])
+    words += ["-t", str(args.threads), "-r", quote(args.reference)]
+    for path in streams[p["stream"]]["files"]:
+        words += ["-i", quote(path)]
+    if p["table"] != ANY:
+        for path in split_list(p["table"]):
+            words += ["-q", quote(path)]
+    words += [x["args"] for x in p["stages"]]
+    return " ".join(words)
+
+
+def releases(passes, streams):
+    """The files of temporary reads to remove after each pass, once no
+    later pass reads them. Files read in the background are kept"""
+    last, kept = {}, set()
+    for stream in streams.values():
+        if not stream["temporary"]:
+            kept.update(stream["files"])
+    for i, p in enumerate(passes):
+        for path in streams[p["stream"]]["files"]:
+            last[path] = i
+            if p["background"]:
+                kept.add(path)
+    after = [[] for _ in passes]
+    for path, i in sorted(last.items()):
+        if path not in kept:
+            after[i].append(path)
+    return after
+
+
+def stream_bytes(name, streams, stages, sizes):
+    """The bytes of a stream, estimated from the reads of the stages
+    writing it for files that are not written yet"""
+    if name not in sizes:
+        sizes[name] = (0, False)
+        stream = streams[name]
+        total, estimated = 0, False
+        if all(os.path.exists(x) for x in stream["files"]):
+            total = sum(os.path.getsize(x) for x in stream["files"])
+        else:
+            estimated = True
+            for stage in stages:
+                if stage["name"] in stream["producers"]:
+                    total += stream_bytes(
+                        stage["reads"][0], streams, stages, sizes
+                    )[0]
+        sizes[name] = (total, estimated)
+    return sizes[name]
+
+
+def report(passes, streams, stages):
+    sizes = {}
+    fused_bytes = 0
+    estimated = False
+    for i, p in enumerate(passes):
+        size, guess = stream_bytes(p["stream"], streams, stages, sizes)
+        fused_bytes += size
+        estimated = estimated or guess
+        print(
+            "Pass {}: {} reading {} ({} bytes{}){}".format(
+                i + 1,
+                " + ".join(x["label"] for x in p["stages"]),
+                p["stream"],
+                size,
+                ", estimated" if guess else "",
+                " in the background" if p["background"] else "",
+            )
+        )
+    unfused_bytes = 0
+    for stage in stages:
+        size, guess = stream_bytes(stage["reads"][0], streams, stages, sizes)
+        unfused_bytes += size
+        estimated = estimated or guess
+    print(
+        "Planned {} driver pass(es) reading {} bytes, for {} stage(s) that "
+        "would take {} pass(es) reading {} bytes without fusing{}".format(
+            len(passes),
+            fused_bytes,
+            len(stages),
+            len(stages),
+            unfused_bytes,
+            " (estimated)" if estimated else "",
+        )
+    )
+
+
+def write_plan(path, passes, streams, args):
+    with open(path, "w") as f:
+        for p, release in zip(passes, releases(passes, streams)):
+            f.write(
+                "pass\t{}\t{}\t{}\t{}\n".format(
+                    " + ".join(x["label"] for x in p["stages"]),
+                    "true" if p["background"] else "false",
+                    pass_command(p, streams, args),
+                    "; ".join(x["after"] for x in p["stages"] if x["after"]),
+                )
+            )
+            if release:
+                f.write("release\t{}\n".format(" ".join(release)))
+
+
+def main(args):
+    try:
+        streams, stages = read_spec(args.spec)
+        check_spec(streams, stages)
+    except ValueError as err:
+        print("Cannot plan the driver passes: {}".format(err))
+        return 1
+    passes = fuse(streams, stages)
+    report(passes, streams, stages)
+    if args.plan:
+        write_plan(args.plan, passes, streams, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(process_args()))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import fcntl
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def process_args():
+    parser = argparse.ArgumentParser(
+        description="Run a pipeline stage and append its timing and "
+        "resource usage to a JSON-lines stage log"
+    )
+    parser.add_argument("stage_log", help="The JSON-lines file to append to")
+    parser.add_argument("stage", help="The name of the stage")
+    parser.add_argument("command", help="The command line to run with bash")
+    return parser.parse_args()
+
+
+def io_counters():
+    """The I/O of this process and its waited-for children"""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def append_record(path, record):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def main(args):
+    io_start = io_counters()
+    start = time.time()
+    exit_code = subprocess.call(
+        ["/bin/bash", "-o", "pipefail", "-c", args.command]
+    )
+    end = time.time()
+    if exit_code < 0:
+        exit_code = 128 - exit_code
+    io_end = io_counters()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = {
+        "pipeline": os.environ.get("PIPELINE"),
+        "output_bucket": os.environ.get("OUTPUT_BUCKET"),
+        "stage": args.stage,
+        "command": args.command,
+        "start": round(start, 3),
+        "wall_s": round(end - start, 3),
+        "user_s": round(usage.ru_utime, 3),
+        "sys_s": round(usage.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+        "read_bytes": io_end.get("read_bytes", 0)
+        - io_start.get("read_bytes", 0),
+        "write_bytes": io_end.get("write_bytes", 0)
+        - io_start.get("write_bytes", 0),
+        "cpus": multiprocessing.cpu_count(),
+        "exit_code": exit_code,
+    }
+    try:
+        append_record(args.stage_log, record)
+    except (IOError, OSError) as err:
+        print("Cannot record stage {}: {}".format(args.stage, err))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(process_args()))
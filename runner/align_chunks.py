@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Align the reads of a large sample across many VMs before deduplication
+"""
+
+import copy
+import logging
+import os
+import sys
+
+from batch_scheduler import run_jobs, scheduler_args
+
+
+def fastq_lanes(job_vars, input_stats=None):
+    """The (fq1, fq2, readgroup, size) of each lane of a job
+
+    The size of a lane is the size of its fastq files where known, or 1.
+    """
+    input_stats = input_stats or {}
+    fq1s = job_vars["FQ1"].split(",")
+    fq2s = (job_vars["FQ2"] or "").split(",")
+    fq2s += [""] * (len(fq1s) - len(fq2s))
+    readgroups = job_vars["READGROUP"].split(",")
+    lanes = []
+    for fq1, fq2, readgroup in zip(fq1s, fq2s, readgroups):
+        size = sum(
+            (input_stats.get(x) or {}).get("size") or 0 for x in (fq1, fq2)
+        )
+        lanes.append((fq1, fq2, readgroup, size or 1))
+    return lanes
+
+
+def plan_chunks(lanes, n_chunks):
+    """Split lanes into about `n_chunks` alignment chunks of similar size
+
+    With fewer chunks than lanes, whole lanes are packed into the chunks,
+    largest lane first into the smallest chunk. Otherwise each lane is
+    split into parts, giving the next part to the lane with the largest
+    part size. Each chunk is a dict of (lanes, part, size) where part is
+    None or (i, n) to align every n-th read of the lane starting at i.
+    """
+    if not lanes or n_chunks < 1:
+        return []
+    if n_chunks <= len(lanes):
+        chunks = [
+            {"lanes": [], "part": None, "size": 0} for _ in range(n_chunks)
+        ]
+        for lane in sorted(lanes, key=lambda x: -x[3]):
+            chunk = min(chunks, key=lambda x: x["size"])
+            chunk["lanes"].append(lane)
+            chunk["size"] += lane[3]
+        for chunk in chunks:
+            chunk["lanes"].sort(key=lanes.index)
+        return [x for x in chunks if x["lanes"]]
+
+    parts = [1] * len(lanes)
+    for _ in range(n_chunks - len(lanes)):
+        j = max(
+            range(len(lanes)), key=lambda x: float(lanes[x][3]) / parts[x]
+        )
+        parts[j] += 1
+    chunks = []
+    for lane, n in zip(lanes, parts):
+        for i in range(n):
+            chunks.append(
+                {
+                    "lanes": [lane],
+                    "part": (i, n) if n > 1 else None,
+                    "size": float(lane[3]) / n,
+                }
+            )
+    return chunks
+
+
+def chunk_outputs(chunk_vars):
+    """The sorted BAM files of an alignment chunk, one per lane"""
+    prefix = chunk_vars["OUTPUT_BUCKET"]
+    return [
+        "{}/{}-sorted_bam-{}.bam".format(prefix, os.path.basename(prefix), i)
+        for i in range(len(chunk_vars["FQ1"].split(",")))
+    ]
+
+
+def chunk_job_vars(job_vars, chunks):
+    """The job_vars of the alignment operation for each chunk"""
+    all_vars = []
+    for i, chunk in enumerate(chunks):
+        fq1s, fq2s, readgroups, _ = zip(*chunk["lanes"])
+        chunk_vars = copy.deepcopy(job_vars)
+        chunk_vars.update(
+            PIPELINE="ALIGN_CHUNK",
+            CHUNK_PIPELINE=job_vars["PIPELINE"],
+            FQ1=",".join(fq1s),
+            FQ2=",".join(fq2s) if any(fq2s) else None,
+            READGROUP=",".join(readgroups),
+            CHUNK_PART="{}/{}".format(*chunk["part"])
+            if chunk["part"]
+            else None,
+            OUTPUT_BUCKET="{}/chunks/chunk-{:04d}".format(
+                job_vars["OUTPUT_BUCKET"], i
+            ),
+            ALIGNMENT_CHUNKS=None,
+        )
+        all_vars.append(chunk_vars)
+    return all_vars
+
+
+def merged_job_vars(job_vars, chunk_outputs):
+    """The job_vars of the main pipeline, reading the aligned chunks"""
+    merged_vars = copy.deepcopy(job_vars)
+    merged_vars.update(
+        FQ1=None,
+        FQ2=None,
+        BAM=",".join(chunk_outputs),
+        STREAM_INPUT=None,
+        ALIGNMENT_CHUNKS=None,
+    )
+    return merged_vars
+
+
+def run_chunked_alignment(
+    job_vars,
+    credentials,
+    input_stats=None,
+    polling_interval=30,
+    max_polling_interval=300,
+    dry_run=False,
+):
+    """Align the fastq of a job in ALIGNMENT_CHUNKS operations
+
+    Returns the job_vars of the main pipeline, which deduplicates and
+    merges the sorted BAM files of the chunks.
+    """
+    lanes = fastq_lanes(job_vars, input_stats)
+    chunks = plan_chunks(lanes, int(job_vars["ALIGNMENT_CHUNKS"]))
+    all_chunk_vars = chunk_job_vars(job_vars, chunks)
+    merged_vars = merged_job_vars(
+        job_vars, [bam for x in all_chunk_vars for bam in chunk_outputs(x)]
+    )
+    for chunk_vars, chunk in zip(all_chunk_vars, chunks):
+        logging.info(
+            "Chunk {}: {} lane(s){}{}".format(
+                os.path.basename(chunk_vars["OUTPUT_BUCKET"]),
+                len(chunk["lanes"]),
+                ", part " + chunk_vars["CHUNK_PART"]
+                if chunk["part"]
+                else "",
+                ", {:.0f} bytes".format(chunk["size"]) if input_stats else "",
+            )
+        )
+    if dry_run:
+        for chunk_vars in all_chunk_vars:
+            print(
+                "{}\t{}\t{}".format(
+                    chunk_vars["OUTPUT_BUCKET"],
+                    chunk_vars["FQ1"],
+                    chunk_vars["CHUNK_PART"] or "all",
+                )
+            )
+        return merged_vars
+
+    args = scheduler_args(
+        job_vars, credentials, polling_interval, max_polling_interval
+    )
+    if not run_jobs(all_chunk_vars, args):
+        logging.error("Alignment failed in one or more chunks")
+        sys.exit(4)
+    return merged_vars
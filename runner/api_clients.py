@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Google API clients built from cached discovery documents
+"""
+
+import json
+import logging
+import os
+import ssl
+import time
+
+CACHE_FORMAT = 1
+DEFAULT_TTL = 24 * 60 * 60
+DISCOVERY_URLS = (
+    "https://{api}.googleapis.com/$discovery/rest?version={version}",
+    "https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest",
+)
+
+
+def default_cache_dir():
+    return os.environ.get(
+        "SENTIEON_RUNNER_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "sentieon_runner"),
+    )
+
+
+def api_errors():
+    """API errors worth retrying. googleapiclient is imported on first use"""
+    import googleapiclient.errors
+
+    return (googleapiclient.errors.HttpError, ssl.SSLError)
+
+
+class DiscoveryCache(object):
+    """An on-disk store of discovery documents
+
+    Documents are kept under a directory for the cache format version, one
+    file per API and version, along with the time they were fetched.
+    Documents older than `ttl` seconds are refetched; if the refetch fails
+    the stale document is still used.
+    """
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL, clock=time.time):
+        self.cache_dir = os.path.join(
+            cache_dir or default_cache_dir(),
+            "discovery",
+            "v{}".format(CACHE_FORMAT),
+        )
+        self.ttl = ttl
+        self.clock = clock
+
+    def _path(self, api, version):
+        return os.path.join(self.cache_dir, "{}.{}.json".format(api, version))
+
+    def load(self, api, version):
+        """Return (document, fresh), or (None, False) if not cached"""
+        try:
+            with open(self._path(api, version)) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, False
+        fresh = self.clock() - cached.get("fetched", 0) < self.ttl
+        return cached["document"], fresh
+
+    def store(self, api, version, document):
+        path = self._path(api, version)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = path + ".{}.tmp".format(os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"fetched": self.clock(), "document": document}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logging.info("Could not cache discovery document: " + str(e))
+
+    def fetch(self, api, version):
+        import httplib2
+
+        http = httplib2.Http(timeout=60)
+        for url in DISCOVERY_URLS:
+            url = url.format(api=api, version=version)
+            try:
+                response, content = http.request(url)
+            except Exception as e:  # Catch all exceptions
+                logging.info("Error fetching {}: {}".format(url, e))
+                continue
+            if response.status < 400:
+                if isinstance(content, bytes):
+                    content = content.decode("utf-8")
+                return json.loads(content)
+        return None
+
+    def get(self, api, version):
+        document, fresh = self.load(api, version)
+        if fresh:
+            return document
+        fetched = self.fetch(api, version)
+        if fetched:
+            self.store(api, version, fetched)
+            return fetched
+        if document:
+            logging.warning(
+                "Using a stale discovery document for {} {}".format(
+                    api, version
+                )
+            )
+        return document
+
+
+def build_service(api, version, credentials, cache=None):
+    """Build an API client, preferring a cached discovery document"""
+    from googleapiclient.discovery import build, build_from_document
+
+    cache = cache or DiscoveryCache()
+    document = cache.get(api, version)
+    if document:
+        return build_from_document(document, credentials=credentials)
+    return build(api, version, credentials=credentials)
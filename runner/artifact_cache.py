@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Mirror the Sentieon software and models into an ARTIFACT_CACHE near the jobs
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from storage_check import StorageStat, split_gs_path
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+RELEASE_URL = (
+    "https://sentieon-release.s3.amazonaws.com/software/"
+    "sentieon-genomics-{}.tar.gz"
+)
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def required_artifacts(job_vars):
+    """The URLs of the files the pipeline scripts of a job download"""
+    urls = [RELEASE_URL.format(job_vars["SENTIEON_VERSION"])]
+    if job_vars["CALLING_ALGO"] == "DNAscope" and job_vars["DNASCOPE_MODEL"]:
+        urls.append(job_vars["DNASCOPE_MODEL"])
+    return urls
+
+
+def cached_path(cache, url):
+    """The path of a mirrored file, as read by fetch_artifact"""
+    return "{}/{}".format(cache.rstrip("/"), url.split("://", 1)[-1])
+
+
+def download(url, f):
+    """Stream a URL into a file object, returning its sha256"""
+    digest = hashlib.sha256()
+    response = urlopen(url)
+    try:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    finally:
+        response.close()
+    return digest.hexdigest()
+
+
+def mirror(url, path, client=None, user_project=None):
+    """Copy a URL and its sha256 to the cache. The checksum is written
+    last, so an interrupted copy is never used"""
+    with tempfile.NamedTemporaryFile() as f:
+        digest = download(url, f)
+        f.flush()
+        checksum_line = "{}  {}\n".format(digest, os.path.basename(path))
+        if path.startswith("gs://"):
+            bucket_name, name = split_gs_path(path)
+            bucket = client.bucket(bucket_name, user_project=user_project)
+            bucket.blob(name).upload_from_filename(f.name)
+            bucket.blob(name + ".sha256").upload_from_string(
+                checksum_line, content_type="text/plain"
+            )
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copyfile(f.name, path + ".tmp")
+            os.rename(path + ".tmp", path)
+            with open(path + ".sha256", "w") as checksum:
+                checksum.write(checksum_line)
+    logging.warning("Mirrored {} to {}".format(url, path))
+
+
+def ensure_artifacts(all_vars, credentials, user_project=None):
+    """Mirror the files of the jobs missing from their ARTIFACT_CACHE
+
+    A file that cannot be mirrored is only logged, as the jobs then
+    download it from its origin.
+    """
+    paths = {}
+    project = None
+    for job_vars in all_vars:
+        if not job_vars["ARTIFACT_CACHE"]:
+            continue
+        project = job_vars["PROJECT_ID"]
+        for url in required_artifacts(job_vars):
+            paths[cached_path(job_vars["ARTIFACT_CACHE"], url)] = url
+    if not paths:
+        return
+
+    client = None
+    gs_checksums = [x + ".sha256" for x in paths if x.startswith("gs://")]
+    if gs_checksums:
+        from google.cloud import storage
+
+        client = storage.Client(project=project, credentials=credentials)
+        stat = StorageStat(client, user_project=user_project)
+        stat.resolve(gs_checksums)
+    for path, url in sorted(paths.items()):
+        if path.startswith("gs://"):
+            cached = stat.exists(path + ".sha256")
+        else:
+            cached = os.path.exists(path + ".sha256")
+        if cached:
+            continue
+        try:
+            mirror(url, path, client, user_project)
+        except Exception as err:  # Catch all exceptions
+            logging.warning(
+                "Could not mirror {} to {}, jobs will download it from the "
+                "origin: {}".format(url, path, err)
+            )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Choose the machine type and local disk size of a job from its input size
+"""
+
+import math
+
+AUTO = "AUTO"
+GB = 1000 ** 3
+# Local SSDs are attached in partitions of 375 GB, up to 24 per VM
+LOCAL_SSD_GB = 375
+# The numbers of local SSD partitions a VM accepts, by machine family, as
+# (up to this many vCPUs, counts) in order. Other families use N1's counts
+N1_LOCAL_SSD_COUNTS = (1, 2, 3, 4, 5, 6, 7, 8, 16, 24)
+LOCAL_SSD_COUNTS = {
+    "n1": [(None, N1_LOCAL_SSD_COUNTS)],
+    "n2": [
+        (10, (1, 2, 4, 8, 16, 24)),
+        (20, (2, 4, 8, 16, 24)),
+        (40, (4, 8, 16, 24)),
+        (80, (8, 16, 24)),
+        (None, (16, 24)),
+    ],
+    "n2d": [
+        (16, (1, 2, 4, 8, 16, 24)),
+        (48, (2, 4, 8, 16, 24)),
+        (80, (4, 8, 16, 24)),
+        (None, (8, 16, 24)),
+    ],
+}
+DISK_HEADROOM_GB = 50
+READ_INPUTS = ("FQ1", "FQ2", "BAM", "TUMOR_FQ1", "TUMOR_FQ2", "TUMOR_BAM")
+
+# The first row matching the pipeline, calling algorithm (if given) and
+# read input size (up to max_input_gb, if given) of a job is used. The
+# disk_factor is the local disk needed per GB of read input, on top of
+# the reference and sites files.
+SIZING_TABLE = [
+    {
+        "pipeline": "GERMLINE",
+        "max_input_gb": 15,
+        "machine_type": "n1-highcpu-16",
+        "disk_factor": 3,
+    },
+    {
+        "pipeline": "GERMLINE",
+        "max_input_gb": 40,
+        "machine_type": "n1-highcpu-32",
+        "disk_factor": 3,
+    },
+    {
+        "pipeline": "GERMLINE",
+        "algo": "DNAscope",
+        "machine_type": "n1-standard-64",
+        "disk_factor": 3,
+    },
+    {
+        "pipeline": "GERMLINE",
+        "machine_type": "n1-highcpu-64",
+        "disk_factor": 3,
+    },
+    {
+        "pipeline": "CCDG",
+        "max_input_gb": 15,
+        "machine_type": "n1-highcpu-16",
+        "disk_factor": 2.5,
+    },
+    {
+        "pipeline": "CCDG",
+        "max_input_gb": 40,
+        "machine_type": "n1-highcpu-32",
+        "disk_factor": 2.5,
+    },
+    {"pipeline": "CCDG", "machine_type": "n1-highcpu-64", "disk_factor": 2.5},
+    {
+        "pipeline": "SOMATIC",
+        "max_input_gb": 15,
+        "machine_type": "n1-highcpu-32",
+        "disk_factor": 3,
+    },
+    {"pipeline": "SOMATIC", "machine_type": "n1-highcpu-64", "disk_factor": 3},
+]
+
+
+def is_auto(job_vars):
+    return AUTO in (job_vars["MACHINE_TYPE"], job_vars["DISK_SIZE"])
+
+
+def input_bytes(job_vars, input_stats):
+    """Split the size of the job inputs into (reads, other) bytes
+
+    Reads are the FASTQ, BAM and CRAM inputs. Other inputs are the
+    reference, sites files and indices found in `input_stats`.
+    """
+    read_paths = set()
+    for key in READ_INPUTS:
+        if job_vars[key]:
+            read_paths.update(job_vars[key].split(","))
+    reads, other = 0, 0
+    for path, stat in input_stats.items():
+        size = (stat or {}).get("size") or 0
+        if path in read_paths:
+            reads += size
+        else:
+            other += size
+    return reads, other
+
+
+def sizing_row(table, pipeline, algo, input_gb):
+    for row in table:
+        if row["pipeline"] != pipeline:
+            continue
+        if row.get("algo") and row["algo"] != algo:
+            continue
+        if row.get("max_input_gb") is not None and input_gb > float(
+            row["max_input_gb"]
+        ):
+            continue
+        return row
+    return None
+
+
+def local_ssd_counts(machine_type):
+    """The numbers of local SSD partitions a machine type accepts"""
+    parts = machine_type.split("-")
+    if parts[0] == "custom":
+        parts = ["n1"] + parts
+    vcpus = None
+    for part in parts[1:]:
+        if part.isdigit():
+            vcpus = int(part)
+            break
+    for max_vcpus, counts in LOCAL_SSD_COUNTS.get(parts[0], []):
+        if max_vcpus is None or vcpus is None or vcpus <= max_vcpus:
+            return counts
+    return N1_LOCAL_SSD_COUNTS
+
+
+def local_ssd_disk(needed_gb, machine_type):
+    """The number of local SSD partitions holding `needed_gb`, capped at
+    the most the machine type accepts, and their size in GB"""
+    counts = local_ssd_counts(machine_type)
+    partitions = int(math.ceil(needed_gb / LOCAL_SSD_GB))
+    count = min([x for x in counts if x >= partitions] or [counts[-1]])
+    return count, count * LOCAL_SSD_GB
+
+
+def choose_resources(job_vars, input_stats, table=None):
+    """Pick the MACHINE_TYPE and DISK_SIZE of the keys set to AUTO
+
+    Returns ({key: value}, [reason]). Raises ValueError if no row of the
+    sizing table matches the job.
+    """
+    table = table or SIZING_TABLE
+    reads, other = input_bytes(job_vars, input_stats)
+    reads_gb = float(reads) / GB
+    other_gb = float(other) / GB
+    row = sizing_row(
+        table, job_vars["PIPELINE"], job_vars["CALLING_ALGO"], reads_gb
+    )
+    if not row:
+        raise ValueError(
+            "No sizing table row for a {} pipeline with {:.1f} GB of "
+            "reads".format(job_vars["PIPELINE"], reads_gb)
+        )
+    chosen, reasons = {}, []
+    if job_vars["MACHINE_TYPE"] == AUTO:
+        chosen["MACHINE_TYPE"] = row["machine_type"]
+        reasons.append(
+            "MACHINE_TYPE {}: {:.1f} GB of reads for {}{}{}".format(
+                row["machine_type"],
+                reads_gb,
+                row["pipeline"],
+                " with " + row["algo"] if row.get("algo") else "",
+                " (up to {} GB)".format(row["max_input_gb"])
+                if row.get("max_input_gb") is not None
+                else "",
+            )
+        )
+    if job_vars["DISK_SIZE"] == AUTO:
+        factor = float(row["disk_factor"])
+        # Streamed FASTQ is never written to the local disk
+        if job_vars["STREAM_INPUT"] and not job_vars["BAM"]:
+            factor = max(1.0, factor - 1)
+        needed = reads_gb * factor + other_gb + DISK_HEADROOM_GB
+        machine_type = chosen.get("MACHINE_TYPE", job_vars["MACHINE_TYPE"])
+        counts = local_ssd_counts(machine_type)
+        count, size = local_ssd_disk(needed, machine_type)
+        chosen["DISK_SIZE"] = size
+        reasons.append(
+            "DISK_SIZE {}: {:.1f} GB of reads x {:g}, {:.1f} GB of "
+            "reference and sites files and {} GB of headroom, rounded up "
+            "to {} local SSD partitions of {} GB, as {} accepts {}{}".format(
+                size,
+                reads_gb,
+                factor,
+                other_gb,
+                DISK_HEADROOM_GB,
+                count,
+                LOCAL_SSD_GB,
+                machine_type,
+                ", ".join(str(x) for x in counts),
+                " (capped)" if needed > size else "",
+            )
+        )
+    return chosen, reasons
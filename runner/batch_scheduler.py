@@ -0,0 +1,810 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Run a cohort of Sentieon pipelines from a single process
+"""
+
+import argparse
+import copy
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+
+import sentieon_runner as runner
+
+from api_clients import api_errors
+from artifact_cache import ensure_artifacts
+from autosize import is_auto
+from executors import make_executor
+from packing import (
+    PACKABLE_PIPELINES,
+    done_markers,
+    pack_groups,
+    packed_job_vars,
+)
+from polling import run_action_failed
+from result_cache import cache_key, open_cache
+from storage_check import StorageStat, check_rules
+from timeline import attempt_timeline, summarize_timeline, write_timeline
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+CHECKING = "CHECKING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+# Run as part of a packed job
+PACKED = "PACKED"
+
+
+def parse_args(vargs=None):
+    parser = argparse.ArgumentParser(
+        prog="sentieon_runner.py batch",
+        description="Run one pipeline per row of a tab-separated file",
+    )
+    parser.add_argument(
+        "base_config", help="A json configuration shared by all jobs"
+    )
+    parser.add_argument(
+        "batch_tsv",
+        help="A tab-separated file with a header of json keys and one job "
+        "per row",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="count", help="Increase the runner verbosity"
+    )
+    parser.add_argument(
+        "--max_concurrent",
+        type=int,
+        default=2,
+        help="The maximum number of jobs running at one time",
+    )
+    parser.add_argument(
+        "--launch_rate",
+        type=float,
+        default=10,
+        help="The maximum number of job launches per minute",
+    )
+    parser.add_argument(
+        "--polling_interval",
+        type=float,
+        default=30,
+        help="Minimum seconds between polling each running operation",
+    )
+    parser.add_argument(
+        "--max_polling_interval",
+        type=float,
+        default=300,
+        help="Maximum seconds between polling each running operation",
+    )
+    parser.add_argument(
+        "--state_file",
+        default=None,
+        help="A json file holding the batch state. A killed batch is "
+        "resumed from this file. Defaults to '<batch_tsv>.state.json'",
+    )
+    parser.add_argument(
+        "--no_check_inputs_exist",
+        action="store_true",
+        help="Do not check that the input files exist before running the "
+        "pipelines",
+    )
+    parser.add_argument(
+        "--requester_project",
+        default=None,
+        help="A project to charge for local 'requester pays' requests",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run every job even if the RESULT_CACHE holds the outputs of "
+        "an identical run",
+    )
+    return parser.parse_args(vargs)
+
+
+def read_batch_tsv(batch_tsv):
+    """Read a batch tsv into a list of per-job configuration dicts
+
+    Empty cells are skipped, so the base configuration or defaults apply.
+    """
+    rows = []
+    with open(batch_tsv) as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            values = line.split("\t")
+            rows.append(dict((k, v) for k, v in zip(header, values) if v))
+    return rows
+
+
+class RateLimiter(object):
+    """A token bucket limiting the rate of API requests"""
+
+    def __init__(self, per_minute, burst=None, clock=time.time):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1, per_minute / 6)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.rate
+        )
+        self.last = now
+
+    def acquire(self):
+        """Take a token if one is available"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BatchState(object):
+    """Per-job state, written atomically to a json file
+
+    With no path, the state is only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.jobs = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)["jobs"]
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def job_id(config, row_number):
+    return config.get("OUTPUT_BUCKET") or "row-{}".format(row_number)
+
+
+def new_job(job_vars, seq, priority=0):
+    """A pending job for validated job_vars"""
+    attempts = runner.Attempts.from_job_vars(job_vars)
+    job = {
+        "seq": seq,
+        "priority": priority,
+        "state": PENDING,
+        "operation": None,
+        "counter": 0,
+        "message": None,
+        "job_vars": job_vars,
+        "attempts": attempts.to_dict(),
+    }
+    if not attempts.remaining():
+        job.update(state=FAILED, message="No attempts requested")
+    return job
+
+
+class Scheduler(object):
+    """Launch and track many pipeline operations
+
+    Pending jobs are kept in a priority queue (higher 'PRIORITY' first, then
+    batch order) and launched while fewer than `max_concurrent` jobs are
+    running, the executor has room for them and the launch rate limit
+    allows. Operation names are recorded in the batch state as soon as they
+    are launched, so a restarted scheduler polls the existing operations
+    instead of relaunching them. The state is saved once per step, when a
+    job was launched, finished or requeued. A job fails after `max_errors`
+    consecutive failed polls of its operation.
+    """
+
+    def __init__(
+        self,
+        state,
+        executor,
+        max_concurrent=2,
+        launch_rate=10,
+        preemption_deadline=300,
+        preemption_interval=15,
+        max_errors=6,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.state = state
+        self.executor = executor
+        if executor.max_jobs:
+            max_concurrent = min(max_concurrent, executor.max_jobs)
+        self.max_concurrent = max_concurrent
+        self.limiter = RateLimiter(launch_rate, clock=clock)
+        self.preemption_deadline = preemption_deadline
+        self.preemption_interval = preemption_interval
+        self.max_errors = max_errors
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = []
+        self.running = {}
+        self.checking = {}
+        self.errors = {}
+        self.pipeline_dicts = {}
+        self.checked = {}
+        # Whether the state changed since it was last saved
+        self.changed = False
+
+        for name, job in self.state.jobs.items():
+            if job["state"] == PENDING:
+                self._push(name)
+            elif job["state"] == RUNNING:
+                logging.warning(
+                    "Reattaching to {}: {}".format(name, job["operation"])
+                )
+                self.running[name] = 0
+            elif job["state"] == CHECKING:
+                self.checking[name] = 0
+
+    def _push(self, name):
+        job = self.state.jobs[name]
+        heapq.heappush(self.queue, (-job["priority"], job["seq"], name))
+
+    def _pipeline_dict(self, name):
+        if name not in self.pipeline_dicts:
+            job_vars = self.state.jobs[name]["job_vars"]
+            self.pipeline_dicts[name] = runner.check_job_vars(job_vars)
+        return self.pipeline_dicts[name]
+
+    def _finish(self, name, state, message):
+        job = self.state.jobs[name]
+        job["state"] = state
+        job["message"] = message
+        self.running.pop(name, None)
+        self.errors.pop(name, None)
+        self.changed = True
+        if state == SUCCEEDED:
+            logging.warning("{}: {}".format(name, message))
+        else:
+            logging.error("{}: {}".format(name, message))
+
+    def _launch(self, name):
+        job = self.state.jobs[name]
+        attempts = runner.Attempts.from_dict(job["attempts"])
+        if not self.executor.can_preempt:
+            attempts = attempts.single()
+        operation = self.executor.submit(
+            job["job_vars"], self._pipeline_dict(name), attempts.take()
+        )
+        if not operation:
+            self._finish(name, FAILED, "Failed to launch job")
+            return
+        job["attempts"] = attempts.to_dict()
+        job["operation"] = operation["name"]
+        job["state"] = RUNNING
+        job["counter"] += 1
+        self.changed = True
+        self.running[name] = self.clock() + self.executor.next_interval(
+            operation
+        )
+        logging.warning("Launched job {}: {}".format(name, operation["name"]))
+
+    def _poll(self, name):
+        job = self.state.jobs[name]
+        try:
+            operation = self.executor.fetch(job["operation"])
+        except api_errors() as e:
+            logging.warning("{}: {}".format(name, e))
+            self.errors[name] = self.errors.get(name, 0) + 1
+            if self.errors[name] > self.max_errors:
+                self._finish(
+                    name,
+                    FAILED,
+                    "Network error while polling running operation.",
+                )
+                return
+            self.running[name] = self.clock() + self.executor.error_delay(
+                self.errors[name]
+            )
+            return
+        self.errors.pop(name, None)
+        if not operation.get("done", False):
+            self.running[name] = self.clock() + self.executor.next_interval(
+                operation
+            )
+            return
+        del self.running[name]
+        self.changed = True
+        job.setdefault("timeline", []).append(attempt_timeline(operation))
+        if "error" not in operation:
+            self.executor.record(operation, False)
+            self._finish(name, SUCCEEDED, "Operation succeeded")
+            return
+        worker = self.executor.worker(operation)
+        if not worker:
+            self._finish(
+                name,
+                FAILED,
+                "Genomics operation failed before running: {}".format(
+                    operation["error"].get("message", "")
+                ),
+            )
+            return
+        if not runner.Attempts.from_dict(job["attempts"]).remaining():
+            self._finish(name, FAILED, "Final run failed.")
+            return
+        if not self.executor.can_preempt or run_action_failed(operation):
+            self.executor.record(operation, False)
+            self._finish(
+                name,
+                FAILED,
+                "Run {} failed, but not due to preemption".format(
+                    job["counter"]
+                ),
+            )
+            return
+        job["state"] = CHECKING
+        job["worker"] = list(worker)
+        job["check_deadline"] = self.clock() + self.preemption_deadline
+        self.checking[name] = self.clock()
+        self.checked[name] = operation
+
+    def _check_preemption(self, name):
+        job = self.state.jobs[name]
+        del self.checking[name]
+        try:
+            preempted = self.executor.was_preempted(
+                job["job_vars"], job["worker"]
+            )
+        except api_errors() as e:
+            logging.warning("{}: {}".format(name, e))
+            preempted = False
+        if not preempted and self.clock() < job["check_deadline"]:
+            # The preemption record may not have been written yet
+            self.checking[name] = self.clock() + self.preemption_interval
+            return
+        self.changed = True
+        operation = self.checked.pop(name, None)
+        if operation:
+            self.executor.record(operation, preempted)
+        if preempted:
+            job["timeline"][-1]["preempted"] = True
+            logging.warning(
+                "{}: run {} was preempted. Retrying...".format(
+                    name, job["counter"]
+                )
+            )
+            job["state"] = PENDING
+            self._push(name)
+        else:
+            self._finish(
+                name,
+                FAILED,
+                "Run {} failed, but not due to preemption".format(
+                    job["counter"]
+                ),
+            )
+
+    def step(self):
+        """Poll due operations and launch queued jobs, returning when the
+        next step is due"""
+        now = self.clock()
+        for name, due in list(self.running.items()):
+            if due <= now:
+                self._poll(name)
+        for name, due in list(self.checking.items()):
+            if due <= now:
+                self._check_preemption(name)
+        while self.queue and len(self.running) < self.max_concurrent:
+            if not self.limiter.acquire():
+                break
+            _, _, name = heapq.heappop(self.queue)
+            self._launch(name)
+        if self.changed:
+            self.state.save()
+            self.changed = False
+
+        due = list(self.running.values()) + list(self.checking.values())
+        if self.queue and len(self.running) < self.max_concurrent:
+            due.append(self.clock() + self.limiter.wait_time())
+        return min(due) if due else None
+
+    def run(self):
+        try:
+            while True:
+                next_due = self.step()
+                if next_due is None:
+                    break
+                self.sleep(max(0, next_due - self.clock()))
+        finally:
+            self.executor.close()
+        return dict(
+            (name, job["state"]) for name, job in self.state.jobs.items()
+        )
+
+
+def scheduler_args(
+    job_vars, credentials, polling_interval=30, max_polling_interval=300
+):
+    """The executor for a Scheduler of related jobs"""
+    return {
+        "executor": make_executor(
+            job_vars,
+            credentials,
+            polling_interval=polling_interval,
+            max_polling_interval=max_polling_interval,
+        )
+    }
+
+
+def run_jobs(all_vars, args, launch_rate=60):
+    """Run related jobs concurrently, returning whether all succeeded"""
+    state = BatchState()
+    for i, job_vars in enumerate(all_vars):
+        runner.check_job_vars(job_vars)
+        name = job_vars["OUTPUT_BUCKET"] + ":" + job_vars["PIPELINE"]
+        state.jobs[name] = new_job(job_vars, i)
+    scheduler = Scheduler(
+        state, max_concurrent=len(all_vars), launch_rate=launch_rate, **args
+    )
+    states = scheduler.run()
+    return all(x == SUCCEEDED for x in states.values())
+
+
+def add_jobs(
+    state,
+    configs,
+    check_inputs_exist,
+    credentials,
+    user_project,
+    force=False,
+    client=None,
+):
+    """Validate the batch configurations and add new jobs to the state
+
+    Jobs already in the state (from an earlier run of the batch) are kept
+    as they are. Rows sharing an OUTPUT_BUCKET fail. Jobs whose outputs are
+    in their RESULT_CACHE succeed without running, unless `force` is set.
+    """
+    rows = {}
+    for i, config in enumerate(configs):
+        rows.setdefault(job_id(config, i + 1), []).append(i + 1)
+    new_jobs = {}
+    for i, config in enumerate(configs):
+        name = job_id(config, i + 1)
+        if name in state.jobs:
+            continue
+        config = copy.deepcopy(config)
+        priority = int(config.pop("PRIORITY", 0) or 0)
+        if len(rows[name]) > 1:
+            message = "The OUTPUT_BUCKET is shared by rows " + ", ".join(
+                str(x) for x in rows[name]
+            )
+            logging.error("{}: {}".format(name, message))
+            state.jobs[name] = {
+                "seq": i,
+                "priority": priority,
+                "state": FAILED,
+                "message": message,
+            }
+            continue
+        try:
+            job_vars = runner.load_job_vars(config)
+            runner.check_job_vars(job_vars)
+        except SystemExit:
+            state.jobs[name] = {
+                "seq": i,
+                "priority": priority,
+                "state": FAILED,
+                "message": "Invalid job configuration",
+            }
+            continue
+        job = new_job(job_vars, i, priority)
+        if int(job_vars["CALLING_SHARDS"] or 1) > 1:
+            job.update(
+                state=FAILED,
+                message="Sharded variant calling is not supported in a batch",
+            )
+        elif job_vars["PIPELINE"] == "COHORT":
+            job.update(
+                state=FAILED,
+                message="Joint genotyping is not supported in a batch",
+            )
+        elif int(job_vars["ALIGNMENT_CHUNKS"] or 1) > 1:
+            job.update(
+                state=FAILED,
+                message="Chunked alignment is not supported in a batch",
+            )
+        elif (
+            job_vars["HEDGE_AFTER_PREEMPTIONS"]
+            or job_vars["HEDGE_PERCENTILE"]
+        ):
+            job.update(
+                state=FAILED,
+                message="Hedged launches are not supported in a batch",
+            )
+        state.jobs[name] = job
+        new_jobs[name] = job
+
+    # Resolve the inputs of all jobs together, so shared reference and
+    # sites files are only looked up once
+    if check_inputs_exist and new_jobs:
+        if client is None:
+            from google.cloud import storage
+
+            project = list(new_jobs.values())[0]["job_vars"]["PROJECT_ID"]
+            client = storage.Client(project=project, credentials=credentials)
+        stat = StorageStat(client, user_project=user_project)
+        rules = {}
+        paths = []
+        for name, job in new_jobs.items():
+            rules[name] = runner._input_rules(job["job_vars"])
+            for _, alternatives in rules[name]:
+                paths.extend(alternatives)
+        stat.resolve(paths)
+        for name, job in new_jobs.items():
+            missing = check_rules(stat, rules[name])
+            if missing:
+                job.update(state=FAILED, message="; ".join(missing))
+                logging.error("{}: {}".format(name, job["message"]))
+
+    def input_stats(name):
+        return dict(
+            (path, stat.stats[path])
+            for _, alternatives in rules[name]
+            for path in alternatives
+            if stat.exists(path)
+        )
+
+    for name, job in new_jobs.items():
+        if job["state"] == FAILED or not is_auto(job["job_vars"]):
+            continue
+        if not check_inputs_exist:
+            job.update(
+                state=FAILED,
+                message="AUTO sizing requires checking the input files",
+            )
+            continue
+        try:
+            reasons = runner.apply_auto_sizing(
+                job["job_vars"], input_stats(name)
+            )
+        except ValueError as err:
+            job.update(state=FAILED, message=str(err))
+            continue
+        for reason in reasons:
+            logging.warning("{}: chose {}".format(name, reason))
+
+    caches = {}
+    for name, job in new_jobs.items():
+        job_vars = job["job_vars"]
+        if job["state"] == FAILED or not job_vars["RESULT_CACHE"]:
+            continue
+        if not check_inputs_exist:
+            job.update(
+                state=FAILED,
+                message="The result cache requires checking the input files",
+            )
+            continue
+        job["cache_key"] = cache_key(job_vars, input_stats(name))
+        # Only the objects written after this are recorded as outputs
+        job["added"] = time.time()
+        if force:
+            continue
+        location = job_vars["RESULT_CACHE"]
+        if location not in caches:
+            caches[location] = open_cache(job_vars, credentials, user_project)
+        cached = caches[location].restore(
+            job["cache_key"], job_vars["OUTPUT_BUCKET"]
+        )
+        if cached:
+            job.update(
+                state=SUCCEEDED,
+                message="Reused the outputs of " + cached,
+                cached=True,
+            )
+    state.save()
+
+
+def record_results(state, credentials, user_project):
+    """Add the outputs of the succeeded jobs to their result caches"""
+    for name in sorted(state.jobs):
+        job = state.jobs[name]
+        if job["state"] != SUCCEEDED or not job.get("cache_key"):
+            continue
+        if job.get("cached"):
+            continue
+        cache = open_cache(job["job_vars"], credentials, user_project)
+        cache.record(
+            job["cache_key"],
+            job["job_vars"]["OUTPUT_BUCKET"],
+            job.get("added", 0),
+        )
+        job["cached"] = True
+    state.save()
+
+
+def ensure_bundles(state, credentials, args):
+    """Build the reference bundles of the pending jobs, once per bundle"""
+    from reference_bundle import ensure_reference_bundle
+
+    bundles = {}
+    for job in state.jobs.values():
+        if job["state"] == PENDING and job["job_vars"]["REFERENCE_BUNDLE"]:
+            bundle = job["job_vars"]["REFERENCE_BUNDLE"]
+            bundles.setdefault(bundle, []).append(job)
+    for bundle, jobs in sorted(bundles.items()):
+        if not ensure_reference_bundle(
+            [job["job_vars"] for job in jobs],
+            credentials,
+            user_project=args.requester_project,
+            polling_interval=args.polling_interval,
+            max_polling_interval=args.max_polling_interval,
+        ):
+            for job in jobs:
+                job["job_vars"]["REFERENCE_BUNDLE"] = None
+    state.save()
+
+
+def pack_jobs(state):
+    """Replace pending jobs with PACK_SAMPLES by packed jobs running several
+    of them on one VM"""
+    pending = sorted(
+        (job["seq"], name)
+        for name, job in state.jobs.items()
+        if job["state"] == PENDING
+        and job["job_vars"]["PIPELINE"] in PACKABLE_PIPELINES
+        and int(job["job_vars"]["PACK_SAMPLES"] or 1) > 1
+    )
+    named_vars = [(name, state.jobs[name]["job_vars"]) for _, name in pending]
+    for names in pack_groups(named_vars):
+        if len(names) < 2:
+            continue
+        members = [state.jobs[x] for x in names]
+        pack_vars = packed_job_vars([x["job_vars"] for x in members])
+        pack_name = pack_vars["OUTPUT_BUCKET"] + ":" + pack_vars["PIPELINE"]
+        job = new_job(
+            pack_vars,
+            min(x["seq"] for x in members),
+            max(x["priority"] for x in members),
+        )
+        job["members"] = names
+        state.jobs[pack_name] = job
+        for member in members:
+            member.update(
+                state=PACKED, pack=pack_name, message="Packed in " + pack_name
+            )
+        logging.warning(
+            "Packed {} jobs in {}".format(len(names), pack_name)
+        )
+    state.save()
+
+
+def unpack_results(state, credentials, user_project, client=None):
+    """Set the state of the jobs of finished packed jobs
+
+    The jobs of a failed packed job that completed, as shown by the marker
+    written for each sample, succeed.
+    """
+    for name in sorted(state.jobs):
+        job = state.jobs[name]
+        if not job.get("members") or job["state"] not in (SUCCEEDED, FAILED):
+            continue
+        markers = done_markers(job["job_vars"])
+        done = set(markers)
+        if job["state"] == FAILED:
+            if client is None:
+                from google.cloud import storage
+
+                client = storage.Client(
+                    project=job["job_vars"]["PROJECT_ID"],
+                    credentials=credentials,
+                )
+            stat = StorageStat(client, user_project=user_project)
+            stat.resolve(markers)
+            done = set(x for x in markers if stat.exists(x))
+        for member_name, marker in zip(job["members"], markers):
+            member = state.jobs[member_name]
+            if member["state"] != PACKED:
+                continue
+            if marker in done:
+                member.update(state=SUCCEEDED, message="Succeeded in " + name)
+            else:
+                member.update(
+                    state=FAILED,
+                    message="Failed in {}: {}".format(name, job["message"]),
+                )
+    state.save()
+
+
+def main(args):
+    try:
+        base_config = json.load(open(args.base_config))
+    except ValueError as e:
+        logging.error("Error reading the json file: " + args.base_config)
+        raise e
+    configs = []
+    for row in read_batch_tsv(args.batch_tsv):
+        config = copy.deepcopy(base_config)
+        config.update(row)
+        configs.append(config)
+
+    state_file = args.state_file or args.batch_tsv + ".state.json"
+    state = BatchState(state_file)
+    credentials = runner.get_credentials()
+    add_jobs(
+        state,
+        configs,
+        not args.no_check_inputs_exist,
+        credentials,
+        args.requester_project,
+        args.force,
+    )
+
+    executor_keys = (
+        "PROJECT_ID",
+        "PIPELINE_REGION",
+        "EXECUTOR",
+        "LOCAL_WORK_DIR",
+        "LOCAL_MAX_JOBS",
+    )
+    executors = {}
+    for job in state.jobs.values():
+        if job["state"] in (PENDING, RUNNING, CHECKING):
+            key = tuple(job["job_vars"][x] for x in executor_keys)
+            executors[key] = job["job_vars"]
+    if not executors:
+        logging.warning("No jobs left to run")
+    elif len(executors) > 1:
+        logging.error(
+            "All jobs in a batch must share a PROJECT_ID, region and executor"
+        )
+        sys.exit(-1)
+    else:
+        ensure_bundles(state, credentials, args)
+        pending = [
+            x["job_vars"] for x in state.jobs.values() if x["state"] == PENDING
+        ]
+        ensure_artifacts(
+            pending, credentials, user_project=args.requester_project
+        )
+        pack_jobs(state)
+        executor = make_executor(
+            list(executors.values())[0],
+            credentials,
+            polling_interval=args.polling_interval,
+            max_polling_interval=args.max_polling_interval,
+        )
+        scheduler = Scheduler(
+            state,
+            executor,
+            max_concurrent=args.max_concurrent,
+            launch_rate=args.launch_rate,
+        )
+        scheduler.run()
+        unpack_results(state, credentials, args.requester_project)
+        record_results(state, credentials, args.requester_project)
+
+    failed = 0
+    for name in sorted(state.jobs):
+        job = state.jobs[name]
+        if job.get("timeline") and job["state"] in (SUCCEEDED, FAILED):
+            write_timeline(
+                summarize_timeline(job["timeline"]),
+                job["job_vars"],
+                credentials,
+                args.requester_project,
+            )
+        print("{}\t{}\t{}".format(name, job["state"], job["message"] or ""))
+        failed += job["state"] == FAILED
+    return 1 if failed else 0
@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Benchmark the runner against simulated Google Cloud services
+"""
+
+import argparse
+import copy
+import functools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+import executors
+import hedging
+import sentieon_runner as runner
+
+from api_clients import api_errors
+from batch_scheduler import BatchState, Scheduler, add_jobs
+from polling import format_timestamp
+from stage_stats import percentile
+from timeline import summarize_timeline
+from zone_history import ZoneHistory
+
+EPOCH = 1600000000.0
+PROJECT = "benchmark-project"
+REGION = "us-central1"
+ZONE = "us-central1-a"
+PREEMPTED = "compute.instances.preempted"
+# The settings of a scenario. Durations are simulated seconds
+DEFAULT_SCENARIO = {
+    "api_latency_s": 0.2,
+    "error_rate": 0.0,
+    "errors": ["429", "500", "503", "ssl"],
+    "preemption_rate": 0.0,
+    "failure_rate": 0.0,
+    "queue_s": 30,
+    "provisioning_s": 60,
+    "image_pull_s": 45,
+    "run_s": 3600,
+    "cleanup_s": 20,
+    "preemption_record_delay_s": 60,
+    "preemptible_tries": 2,
+    "max_concurrent": 100,
+    "launch_rate": 60,
+    "lanes": 2,
+    # Settings that differ by zone, such as {"zone": {"preemption_rate": 1}}
+    "zones": {},
+    "zone_history": False,
+    "hedge_after_preemptions": None,
+}
+SCENARIOS = {
+    "baseline": {},
+    "api_errors": {"error_rate": 0.05},
+    "slow_api": {"api_latency_s": 2.0},
+    "preemption": {"preemption_rate": 0.3},
+    "failures": {"failure_rate": 0.1},
+    "zone_skew": {
+        "preemption_rate": 0.1,
+        "zones": {
+            "us-central1-a": {},
+            "us-central1-b": {"preemption_rate": 0.6},
+            "us-central1-c": {"queue_s": 900},
+        },
+    },
+}
+SCENARIOS["zone_history"] = dict(SCENARIOS["zone_skew"], zone_history=True)
+SCENARIOS["heavy_preemption"] = {
+    "preemption_rate": 0.5,
+    "preemptible_tries": 3,
+}
+SCENARIOS["hedging"] = dict(
+    SCENARIOS["heavy_preemption"], hedge_after_preemptions=1
+)
+
+
+def parse_args(vargs=None):
+    parser = argparse.ArgumentParser(
+        prog="sentieon_runner.py benchmark",
+        description="Run the runner against simulated Lifesciences, Compute "
+        "and Cloud Storage services and report its overhead",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="count", help="Increase the runner verbosity"
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(sorted(SCENARIOS)),
+        help="A comma-separated list of scenarios to run",
+    )
+    parser.add_argument(
+        "--scenario_file",
+        default=None,
+        help="A json file of {name: {setting: value}} scenarios, added to "
+        "the built-in ones",
+    )
+    parser.add_argument(
+        "--jobs",
+        default="1,10,100,1000",
+        help="A comma-separated list of the numbers of jobs to run",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("batch", "main"),
+        default="batch",
+        help="Run the jobs with the batch scheduler, or one at a time "
+        "through sentieon_runner.main()",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The random seed of a scenario"
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.jsonl",
+        help="A JSON-lines file the results are appended to",
+    )
+    parser.add_argument(
+        "--label", default=None, help="A label stored with the results"
+    )
+    return parser.parse_args(vargs)
+
+
+def simulated_error(kind):
+    if kind == "ssl":
+        return ssl.SSLError("Simulated SSL error")
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    return HttpError(httplib2.Response({"status": kind}), b"Simulated error")
+
+
+class SimClock(object):
+    """A clock that only advances when slept on"""
+
+    def __init__(self, start=EPOCH):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += max(0, seconds)
+
+
+class FakeRequest(object):
+    def __init__(self, cloud, kind, fun):
+        self.cloud = cloud
+        self.kind = kind
+        self.fun = fun
+
+    def execute(self):
+        return self.cloud.execute(self.kind, self.fun)
+
+
+class SimulatedCloud(object):
+    """The operations, preemptions and objects of a simulated project
+
+    Every Lifesciences and Compute request is counted, takes a random
+    latency of up to twice `api_latency_s` and fails with one of the
+    `errors` at the `error_rate`. Storage requests are only counted, as
+    they are made from several threads at once.
+    """
+
+    def __init__(self, scenario, clock, seed=0):
+        self.scenario = scenario
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+        self.crashes = 0
+        self.operations = {}
+        self.preempted = {}
+        self.objects = {}
+        self.lifesciences = FakeLifesciences(self)
+        self.compute = FakeCompute(self)
+        self.storage = FakeStorageClient(self)
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def execute(self, kind, fun):
+        self.count(kind)
+        latency = self.scenario["api_latency_s"]
+        self.clock.sleep(latency * 2 * self.rng.random())
+        if self.rng.random() < self.scenario["error_rate"]:
+            self.errors += 1
+            raise simulated_error(self.rng.choice(self.scenario["errors"]))
+        return fun()
+
+    def add_inputs(self, all_job_vars):
+        """Create the first alternative of every input rule of the jobs"""
+        for job_vars in all_job_vars:
+            for _, alternatives in runner._input_rules(job_vars):
+                self.objects[alternatives[0]] = {
+                    "size": 10 ** 9,
+                    "generation": 1,
+                    "crc32c": "AAAAAA==",
+                    "md5": None,
+                }
+
+    def launch(self, body):
+        """Plan the events of a new operation from the scenario"""
+        s = self.scenario
+        n = len(self.operations) + 1
+        name = "projects/{}/locations/{}/operations/{}".format(
+            PROJECT, REGION, n
+        )
+        instance = "benchmark-worker-{}".format(n)
+        preemptible = body["pipeline"]["resources"]["virtualMachine"][
+            "preemptible"
+        ]
+        zone = self.rng.choice(body["pipeline"]["resources"]["zones"])
+        s = dict(s, **s["zones"].get(zone, {}))
+        start = self.clock.time()
+        t = start + s["queue_s"]
+        worker = {"instance": instance, "zone": zone}
+        events = [(t, {"workerAssigned": worker})]
+        t += s["provisioning_s"]
+        events.append((t, {"pullStarted": {}}))
+        t += s["image_pull_s"]
+        events.append((t, {"pullStopped": {}}))
+        events.append((t, {"containerStarted": {"actionId": 1}}))
+        error = None
+        if preemptible and self.rng.random() < s["preemption_rate"]:
+            outcome = "preempted"
+            t += s["run_s"] * self.rng.random()
+            self.preempted[instance] = t
+            error = {"code": 14, "message": "Worker was terminated"}
+        else:
+            failed = self.rng.random() < s["failure_rate"]
+            outcome = "failed" if failed else "succeeded"
+            t += s["run_s"]
+            events.append(
+                (
+                    t,
+                    {
+                        "containerStopped": {
+                            "actionId": 1,
+                            "exitStatus": 1 if failed else 0,
+                        }
+                    },
+                )
+            )
+            events.append((t, {"containerStarted": {"actionId": 2}}))
+            t += s["cleanup_s"]
+            events.append(
+                (t, {"containerStopped": {"actionId": 2, "exitStatus": 0}})
+            )
+            if failed:
+                error = {"code": 9, "message": "Unexpected exit status 1"}
+        output_bucket = body["pipeline"]["environment"]["OUTPUT_BUCKET"]
+        self.operations[name] = {
+            "job": re.sub("/attempts/[^/]+$", "", output_bucket),
+            "output_bucket": output_bucket,
+            "start": start,
+            "end": t,
+            "events": events,
+            "error": error,
+            "outcome": outcome,
+            "observed": None,
+        }
+        return self.operation(name)
+
+    def operation(self, name):
+        op = self.operations[name]
+        now = self.clock.time()
+        events = [
+            dict(event, timestamp=format_timestamp(t))
+            for t, event in op["events"]
+            if t <= now
+        ]
+        metadata = {
+            "createTime": format_timestamp(op["start"]),
+            "events": events,
+        }
+        operation = {"name": name, "metadata": metadata}
+        if now >= op["end"]:
+            operation["done"] = True
+            operation["metadata"]["endTime"] = format_timestamp(op["end"])
+            if op["error"]:
+                operation["error"] = op["error"]
+            if op["observed"] is None:
+                op["observed"] = now
+                if not op["error"]:
+                    self.objects[op["output_bucket"] + "/out.vcf.gz"] = {
+                        "size": 10 ** 9,
+                        "generation": 1,
+                        "crc32c": "AAAAAA==",
+                        "md5": None,
+                    }
+        return operation
+
+    def cancel(self, name):
+        """Stop an operation, which ends after its cleanup"""
+        op = self.operations[name]
+        now = self.clock.time()
+        if now >= op["end"]:
+            return {}
+        op["end"] = now + self.scenario["cleanup_s"]
+        op["events"] = [x for x in op["events"] if x[0] <= now]
+        op["error"] = {"code": 1, "message": "Operation canceled"}
+        op["outcome"] = "canceled"
+        return {}
+
+    def preemptions(self, filter):
+        instance = re.search(r"instances/([^ )]+)", filter).group(1)
+        preempted = self.preempted.get(instance)
+        delay = self.scenario["preemption_record_delay_s"]
+        if preempted is None or self.clock.time() < preempted + delay:
+            return {}
+        return {"items": [{"operationType": PREEMPTED}]}
+
+
+class FakeLifesciences(object):
+    """projects().locations() of the Lifesciences API"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def pipelines(self):
+        return self
+
+    def operations(self):
+        return self
+
+    def list(self, name):
+        location = {
+            "locationId": REGION,
+            "name": "projects/{}/locations/{}".format(PROJECT, REGION),
+        }
+        return FakeRequest(
+            self.cloud, "locations.list", lambda: {"locations": [location]}
+        )
+
+    def run(self, parent, body):
+        return FakeRequest(
+            self.cloud, "pipelines.run", lambda: self.cloud.launch(body)
+        )
+
+    def get(self, name):
+        return FakeRequest(
+            self.cloud, "operations.get", lambda: self.cloud.operation(name)
+        )
+
+    def cancel(self, name, body):
+        return FakeRequest(
+            self.cloud, "operations.cancel", lambda: self.cloud.cancel(name)
+        )
+
+
+class FakeCompute(object):
+    """zoneOperations() of the Compute API"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def zoneOperations(self):
+        return self
+
+    def list(self, project, zone, filter):
+        return FakeRequest(
+            self.cloud,
+            "zoneOperations.list",
+            lambda: self.cloud.preemptions(filter),
+        )
+
+
+class FakeBlob(object):
+    def __init__(self, name, stat, bucket=None):
+        self.name = name
+        self.size = stat["size"]
+        self.generation = stat["generation"]
+        self.crc32c = stat["crc32c"]
+        self.md5_hash = stat["md5"]
+        self.bucket = bucket
+
+    def delete(self):
+        self.bucket.cloud.count("storage.delete")
+        del self.bucket.cloud.objects[self.bucket._path(self.name)]
+
+
+class FakeBucket(object):
+    def __init__(self, cloud, name):
+        self.cloud = cloud
+        self.name = name
+
+    def _path(self, name):
+        return "gs://{}/{}".format(self.name, name)
+
+    def list_blobs(self, prefix="", delimiter=None, fields=None):
+        self.cloud.count("storage.list")
+        blobs = []
+        for path, stat in sorted(self.cloud.objects.items()):
+            name = path[len(self._path("")) :]
+            if not path.startswith(self._path(prefix)):
+                continue
+            if delimiter and delimiter in name[len(prefix) :]:
+                continue
+            blobs.append(FakeBlob(name, stat, self))
+        return blobs
+
+    def get_blob(self, name):
+        self.cloud.count("storage.get")
+        stat = self.cloud.objects.get(self._path(name))
+        return FakeBlob(name, stat, self) if stat else None
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        self.cloud.count("storage.copy")
+        stat = self.cloud.objects[self._path(blob.name)]
+        path = destination_bucket._path(new_name)
+        self.cloud.objects[path] = dict(stat)
+
+
+class FakeStorageClient(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def bucket(self, name, user_project=None):
+        return FakeBucket(self.cloud, name)
+
+
+def job_config(scenario, i):
+    lanes = range(scenario["lanes"])
+    fastq = "gs://benchmark-input/job-{}/lane{}_{}.fastq.gz"
+    return {
+        "PROJECT_ID": PROJECT,
+        "PIPELINE_REGION": REGION,
+        "ZONES": ",".join(sorted(scenario["zones"])) or ZONE,
+        "OUTPUT_BUCKET": "gs://benchmark-output/job-{}".format(i),
+        "REF": "gs://benchmark-reference/genome.fa",
+        "FQ1": ",".join(fastq.format(i, x, 1) for x in lanes),
+        "FQ2": ",".join(fastq.format(i, x, 2) for x in lanes),
+        "READGROUP": ",".join(
+            "@RG\\tID:job{}-{}\\tSM:job{}\\tPL:ILLUMINA".format(i, x, i)
+            for x in lanes
+        ),
+        "BQSR_SITES": "gs://benchmark-reference/dbsnp.vcf.gz",
+        "DBSNP": "gs://benchmark-reference/dbsnp.vcf.gz",
+        "PREEMPTIBLE_TRIES": scenario["preemptible_tries"],
+        "NONPREEMPTIBLE_TRY": True,
+        "HEDGE_AFTER_PREEMPTIONS": scenario["hedge_after_preemptions"],
+    }
+
+
+def run_batch(cloud, clock, configs, zone_history=None):
+    """Run the jobs with the batch scheduler, returning their states"""
+    state = BatchState()
+    add_jobs(state, configs, True, None, None, client=cloud.storage)
+    try:
+        service_parent = runner.get_service_parent(
+            cloud.lifesciences, PROJECT, REGION
+        )
+    except api_errors():
+        # An error the runner does not retry ends the whole batch
+        cloud.crashes += 1
+        return {}
+    executor = executors.LifesciencesExecutor(
+        cloud.lifesciences,
+        cloud.compute,
+        service_parent,
+        zone_history=zone_history
+        and ZoneHistory(zone_history, clock=clock.time),
+        clock=clock.time,
+        sleep=clock.sleep,
+    )
+    scheduler = Scheduler(
+        state,
+        executor,
+        max_concurrent=cloud.scenario["max_concurrent"],
+        launch_rate=cloud.scenario["launch_rate"],
+        clock=clock.time,
+        sleep=clock.sleep,
+    )
+    return scheduler.run()
+
+
+class patched(object):
+    """Replace attributes of a module while in the context"""
+
+    def __init__(self, module, **attrs):
+        self.module = module
+        self.attrs = attrs
+        self.saved = {}
+
+    def __enter__(self):
+        for name, value in self.attrs.items():
+            self.saved[name] = getattr(self.module, name)
+            setattr(self.module, name, value)
+
+    def __exit__(self, *exc):
+        for name, value in self.saved.items():
+            setattr(self.module, name, value)
+
+
+def run_main(cloud, clock, configs):
+    """Run the jobs one at a time through sentieon_runner.main()"""
+    check_inputs_exist = runner._check_inputs_exist
+    with patched(
+        runner,
+        get_credentials=lambda: None,
+        build_services=lambda credentials, cache=None: (
+            cloud.lifesciences,
+            cloud.compute,
+        ),
+        _check_inputs_exist=lambda *args, **kwargs: check_inputs_exist(
+            *args, client=cloud.storage, **kwargs
+        ),
+        wait_for_preemption=functools.partial(
+            runner.wait_for_preemption, clock=clock.time, sleep=clock.sleep
+        ),
+        report_timeline=lambda attempts, *args: attempts
+        and summarize_timeline(attempts),
+    ), patched(
+        hedging, storage_client=lambda *args: cloud.storage
+    ), patched(
+        executors,
+        make_executor=functools.partial(
+            executors.make_executor, clock=clock.time, sleep=clock.sleep
+        ),
+    ):
+        for config in configs:
+            try:
+                runner.main(copy.deepcopy(config))
+            except SystemExit:
+                pass
+            except api_errors():
+                cloud.crashes += 1
+    states = {}
+    for op in cloud.operations.values():
+        if op["outcome"] == "succeeded" or op["job"] not in states:
+            states[op["job"]] = op["outcome"].upper()
+    return states
+
+
+def spread(values):
+    if not values:
+        return None
+    return {
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "max": max(values),
+    }
+
+
+def summarize_run(cloud, states, start, jobs):
+    """The API calls, latencies and outcomes of a finished run"""
+    ops = sorted(cloud.operations.values(), key=lambda x: x["start"])
+    first_launch = {}
+    by_job = {}
+    for op in ops:
+        first_launch.setdefault(op["job"], op["start"] - start)
+        by_job.setdefault(op["job"], []).append(op)
+    relaunch = []
+    for job_ops in by_job.values():
+        for op, next_op in zip(job_ops, job_ops[1:]):
+            if op["outcome"] == "preempted" and next_op["start"] >= op["end"]:
+                relaunch.append(next_op["start"] - op["end"])
+    detect = [
+        op["observed"] - op["end"]
+        for op in ops
+        if op["outcome"] != "succeeded" and op["observed"] is not None
+    ]
+    total_calls = sum(cloud.calls.values())
+    return {
+        "succeeded": sum(1 for x in states.values() if x == "SUCCEEDED"),
+        "failed": jobs - sum(1 for x in states.values() if x == "SUCCEEDED"),
+        "attempts": len(ops),
+        "api_calls": cloud.calls,
+        "api_calls_per_job": float(total_calls) / jobs,
+        "api_errors": cloud.errors,
+        "runner_crashes": cloud.crashes,
+        "launch_latency_s": spread(list(first_launch.values())),
+        "failure_detect_s": spread(detect),
+        "preemption_relaunch_s": spread(relaunch),
+        "makespan_s": cloud.clock.time() - start,
+    }
+
+
+def run_scenario(name, scenario, jobs, mode, seed=0):
+    clock = SimClock()
+    cloud = SimulatedCloud(scenario, clock, seed)
+    configs = [job_config(scenario, i) for i in range(jobs)]
+    cloud.add_inputs(runner.load_job_vars(x) for x in configs)
+    zone_history = None
+    if scenario["zone_history"]:
+        zone_history = tempfile.mkdtemp() + "/zone_history.json"
+        for config in configs:
+            config["ZONE_HISTORY"] = zone_history
+    random.seed(seed)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    wall = time.time()
+    if mode == "batch":
+        states = run_batch(cloud, clock, configs, zone_history)
+    else:
+        states = run_main(cloud, clock, configs)
+    wall = time.time() - wall
+    if zone_history:
+        shutil.rmtree(os.path.dirname(zone_history))
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (
+        end_usage.ru_stime - usage.ru_stime
+    )
+    result = {
+        "scenario": name,
+        "settings": scenario,
+        "mode": mode,
+        "jobs": jobs,
+        "seed": seed,
+        "runner_cpu_s": cpu,
+        "runner_cpu_ms_per_job": cpu * 1000.0 / jobs,
+        "runner_wall_s": wall,
+        "max_rss_kb": end_usage.ru_maxrss,
+    }
+    result.update(summarize_run(cloud, states, EPOCH, jobs))
+    return result
+
+
+def _p50(value):
+    return "{:.1f}".format(value["p50"]) if value else "-"
+
+
+def main(args):
+    scenarios = copy.deepcopy(SCENARIOS)
+    if args.scenario_file:
+        with open(args.scenario_file) as f:
+            scenarios.update(json.load(f))
+    names = args.scenarios.split(",")
+    unknown = [x for x in names if x not in scenarios]
+    if unknown:
+        logging.error("Unknown scenarios: " + ", ".join(unknown))
+        return 1
+    if not args.verbose:
+        # The runner logs every launch and failure of the simulated jobs
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    header = [
+        "scenario",
+        "jobs",
+        "succeeded",
+        "crashes",
+        "calls_per_job",
+        "launch_p50_s",
+        "detect_p50_s",
+        "relaunch_p50_s",
+        "cpu_ms_per_job",
+        "max_rss_kb",
+    ]
+    print("\t".join(header))
+    for name in names:
+        scenario = dict(DEFAULT_SCENARIO, **scenarios[name])
+        if args.mode == "batch" and scenario["hedge_after_preemptions"]:
+            # The batch scheduler rejects hedged jobs
+            print(
+                "Skipping the {} scenario, as hedged launches are not "
+                "supported in a batch. Run it with --mode main".format(name),
+                file=sys.stderr,
+            )
+            continue
+        for jobs in [int(x) for x in args.jobs.split(",")]:
+            result = run_scenario(name, scenario, jobs, args.mode, args.seed)
+            result["label"] = args.label
+            result["time"] = time.time()
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+            row = [
+                name,
+                str(jobs),
+                str(result["succeeded"]),
+                str(result["runner_crashes"]),
+                "{:.1f}".format(result["api_calls_per_job"]),
+                _p50(result["launch_latency_s"]),
+                _p50(result["failure_detect_s"]),
+                _p50(result["preemption_relaunch_s"]),
+                "{:.2f}".format(result["runner_cpu_ms_per_job"]),
+                str(result["max_rss_kb"]),
+            ]
+            print("\t".join(row))
+    return 0
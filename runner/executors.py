@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Backends that run pipeline jobs, either as Lifesciences operations or on
+this host
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import time
+
+import sentieon_runner as runner
+
+from polling import RUN_ACTION, OperationPoller, format_timestamp
+from storage_check import split_gs_path
+from zone_history import ZoneHistory
+
+LOCAL_ZONE = "local"
+DOCKER_WORK_DIR = "/mnt/work"
+GCLOUD_CONFIG = os.path.expanduser("~/.config/gcloud")
+
+
+class Executor(object):
+    """Submit, poll and cancel pipeline jobs
+
+    Every backend reports a job as a Lifesciences operation: a dict with
+    its "name", "done" once it has finished, an "error" if it failed and
+    "metadata" with the timestamped "events" of the job. The retry,
+    preemption and timeline code is shared by all backends.
+    """
+
+    # The most jobs running at one time, or None for no limit
+    max_jobs = None
+    # Whether jobs can be preempted, and so retried on preemptible tries
+    can_preempt = True
+
+    def submit(self, job_vars, pipeline_dict, preemptible):
+        """Start a job, returning its operation or None on failure"""
+        raise NotImplementedError
+
+    def fetch(self, name):
+        """The current state of an operation"""
+        raise NotImplementedError
+
+    def next_interval(self, operation):
+        """Seconds until a running operation is polled again"""
+        raise NotImplementedError
+
+    def error_delay(self, errors):
+        """Seconds until polling again after failed requests"""
+        raise NotImplementedError
+
+    def cancel(self, name):
+        raise NotImplementedError
+
+    def wait(self, operation):
+        """Wait for an operation to finish, returning the finished
+        operation or None if it could not be polled"""
+        while not operation.get("done", False):
+            self.sleep(self.next_interval(operation))
+            operation = self.fetch(operation["name"])
+        return operation
+
+    def worker(self, operation):
+        """The (instance, zone) that ran an operation"""
+        return runner.assigned_worker(operation)
+
+    def was_preempted(self, job_vars, worker):
+        return False
+
+    def record(self, operation, preempted):
+        """Learn from the outcome of a finished attempt"""
+
+    def close(self):
+        """Release the jobs this runner is responsible for"""
+
+
+class LifesciencesExecutor(Executor):
+    """Run jobs as Cloud Life Sciences operations on new VMs
+
+    Operations outlive the runner, so closing the executor leaves them
+    running.
+    """
+
+    def __init__(
+        self,
+        service,
+        compute_service,
+        service_parent,
+        polling_interval=30,
+        max_polling_interval=300,
+        zone_history=None,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.service = service
+        self.compute_service = compute_service
+        self.service_parent = service_parent
+        self.zone_history = zone_history
+        self.preemptible = {}
+        self.clock = clock
+        self.poller = OperationPoller(
+            service,
+            min_interval=polling_interval,
+            max_interval=max_polling_interval,
+            clock=clock,
+            sleep=sleep,
+        )
+        self.sleep = sleep
+
+    @classmethod
+    def from_job_vars(cls, job_vars, credentials, **kwargs):
+        service, compute_service = runner.build_services(credentials)
+        service_parent = runner.get_service_parent(
+            service, job_vars["PROJECT_ID"], job_vars["PIPELINE_REGION"]
+        )
+        if job_vars["ZONE_HISTORY"]:
+            kwargs["zone_history"] = ZoneHistory(
+                job_vars["ZONE_HISTORY"],
+                half_life_days=float(job_vars["ZONE_HISTORY_DAYS"]),
+                clock=kwargs.get("clock", time.time),
+            )
+        return cls(service, compute_service, service_parent, **kwargs)
+
+    def submit(self, job_vars, pipeline_dict, preemptible):
+        body = describe(job_vars, pipeline_dict, preemptible)
+        if self.zone_history:
+            resources = body["pipeline"]["resources"]
+            resources["zones"] = self.zone_history.choose(
+                resources["zones"], preemptible
+            )
+        operation = runner.launch_operation(
+            self.service, self.service_parent, body, sleep=self.sleep
+        )
+        if operation:
+            self.preemptible[operation["name"]] = preemptible
+        return operation
+
+    def fetch(self, name):
+        return self.poller.fetch(name)
+
+    def next_interval(self, operation):
+        return self.poller.next_interval(operation)
+
+    def error_delay(self, errors):
+        return self.poller.error_delay(errors)
+
+    def wait(self, operation):
+        return self.poller.wait(operation)
+
+    def cancel(self, name):
+        ops = self.service.projects().locations().operations()
+        ops.cancel(name=name, body={}).execute()
+
+    def was_preempted(self, job_vars, worker):
+        instance, zone = worker
+        return runner.was_preempted(
+            self.compute_service, job_vars["PROJECT_ID"], instance, zone
+        )
+
+    def record(self, operation, preempted):
+        worker = self.worker(operation)
+        preemptible = self.preemptible.pop(operation["name"], None)
+        if not self.zone_history or not worker:
+            return
+        if preemptible is None:
+            # Launched by an earlier runner
+            vm = (
+                operation.get("metadata", {})
+                .get("pipeline", {})
+                .get("resources", {})
+                .get("virtualMachine", {})
+            )
+            preemptible = vm.get("preemptible", False)
+        self.zone_history.record(worker[1], operation, preempted, preemptible)
+
+
+def job_environment(job_vars, pipeline_dict):
+    """The pipeline environment as strings for a local process"""
+    env = {}
+    for name, value in runner.pipeline_environment(
+        job_vars, pipeline_dict
+    ).items():
+        if isinstance(value, (bool, int, float)):
+            value = json.dumps(value)
+        env[name] = value
+    return env
+
+
+def local_command(job_vars, scratch, env_names, docker=False, container=None):
+    """The command line running a job on this host
+
+    Without Docker, the host is expected to be set up like the pipeline
+    image, with the pipeline scripts and their helpers in /opt/sentieon.
+    The job environment is passed through the docker client.
+    """
+    script = runner.pipeline_scripts[job_vars["PIPELINE"]]
+    if not docker:
+        return ["/bin/bash", script]
+    command = ["docker", "run", "--rm", "-v", scratch + ":" + DOCKER_WORK_DIR]
+    if container:
+        command += ["--name", container]
+    for name in sorted(env_names):
+        command += ["-e", name]
+    if os.path.isdir(GCLOUD_CONFIG):
+        command += ["-v", GCLOUD_CONFIG + ":/root/.config/gcloud:ro"]
+    # The scratch space is written by root in the container, so it is
+    # emptied there once the pipeline exits
+    command += [
+        job_vars["DOCKER_IMAGE"],
+        "/bin/bash",
+        "-c",
+        "/bin/bash {}; status=$?; find {} -mindepth 1 -delete; "
+        "exit $status".format(script, DOCKER_WORK_DIR),
+    ]
+    return command
+
+
+def describe(job_vars, pipeline_dict, preemptible):
+    """The request that runs a job, as printed by a dry run"""
+    if job_vars["EXECUTOR"] in ("LOCAL", "DOCKER"):
+        scratch = os.path.join(job_vars["LOCAL_WORK_DIR"], "<job>", "work")
+        env = job_environment(job_vars, pipeline_dict)
+        return {
+            "command": local_command(
+                job_vars, scratch, env, job_vars["EXECUTOR"] == "DOCKER"
+            ),
+            "environment": env,
+        }
+    body = runner.build_pipeline_body(job_vars, pipeline_dict)
+    runner.set_preemptible(body, preemptible)
+    return body
+
+
+class LocalExecutor(Executor):
+    """Run jobs as processes, or Docker containers, on this host
+
+    Each job gets a directory under `work_dir` with its scratch space and
+    logs. The logs are copied to the job's 'worker_logs/' and the
+    directory of a succeeded job is removed. At most `max_jobs` jobs run
+    at one time, and jobs still running when the executor is closed are
+    cancelled. Local jobs are never preempted, so a job gets a single
+    attempt whatever its PREEMPTIBLE_TRIES.
+    """
+
+    can_preempt = False
+
+    def __init__(
+        self,
+        work_dir,
+        max_jobs=1,
+        docker=False,
+        credentials=None,
+        polling_interval=30,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.work_dir = work_dir
+        self.max_jobs = max_jobs
+        self.docker = docker
+        self.credentials = credentials
+        self.polling_interval = polling_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.host = socket.gethostname()
+        self.counter = 0
+        self.jobs = {}
+
+    def _running(self):
+        return [x for x in self.jobs.values() if x["end"] is None]
+
+    def submit(self, job_vars, pipeline_dict, preemptible):
+        if len(self._running()) >= self.max_jobs:
+            logging.error(
+                "Already running {} local jobs".format(self.max_jobs)
+            )
+            return None
+        self.counter += 1
+        label = re.sub(
+            "[^A-Za-z0-9_.-]+", "_", job_vars["OUTPUT_BUCKET"][5:]
+        ).strip("_")
+        job_id = "{}-{}-{}".format(label, os.getpid(), self.counter)
+        job_dir = os.path.join(self.work_dir, job_id)
+        scratch = os.path.join(job_dir, "work")
+        os.makedirs(scratch)
+
+        job_env = job_environment(job_vars, pipeline_dict)
+        env = dict(os.environ)
+        env.update(job_env)
+        if not self.docker:
+            env["SCRATCH_DIR"] = scratch
+        container = "sentieon-" + job_id
+        command = local_command(
+            job_vars, scratch, job_env, self.docker, container
+        )
+        logging.debug("Running: " + " ".join(command))
+        stdout = open(os.path.join(job_dir, "stdout.txt"), "w")
+        stderr = open(os.path.join(job_dir, "stderr.txt"), "w")
+        try:
+            # In its own process group, so cancelling stops the whole job
+            process = subprocess.Popen(
+                command,
+                env=env,
+                cwd=job_dir,
+                stdout=stdout,
+                stderr=stderr,
+                preexec_fn=os.setsid,
+            )
+        except OSError as err:
+            logging.error("Could not run {}: {}".format(command[0], err))
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return None
+        finally:
+            stdout.close()
+            stderr.close()
+
+        name = "local/" + job_id
+        self.jobs[name] = {
+            "process": process,
+            "job_vars": job_vars,
+            "dir": job_dir,
+            "container": container,
+            "start": self.clock(),
+            "end": None,
+        }
+        return self.fetch(name)
+
+    def _finish(self, job):
+        job_vars = job["job_vars"]
+        try:
+            from google.cloud import storage
+
+            client = storage.Client(
+                project=job_vars["PROJECT_ID"], credentials=self.credentials
+            )
+            bucket_name, prefix = split_gs_path(job_vars["OUTPUT_BUCKET"])
+            bucket = client.bucket(
+                bucket_name, user_project=job_vars["REQUESTER_PROJECT"]
+            )
+            for log in ("stdout.txt", "stderr.txt"):
+                name = "worker_logs/" + log
+                blob = bucket.blob(prefix + "/" + name if prefix else name)
+                blob.upload_from_filename(os.path.join(job["dir"], log))
+        except Exception as err:  # Catch all exceptions
+            logging.warning("Could not upload the job logs: {}".format(err))
+        shutil.rmtree(os.path.join(job["dir"], "work"), ignore_errors=True)
+        if job["process"].returncode == 0:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+        else:
+            logging.warning("The job logs are kept in " + job["dir"])
+
+    def fetch(self, name):
+        job = self.jobs.get(name)
+        if job is None:
+            return {
+                "name": name,
+                "done": True,
+                "error": {
+                    "message": "The local job was lost when its runner "
+                    "stopped"
+                },
+            }
+        status = job["process"].poll()
+        if status is not None and job["end"] is None:
+            job["end"] = self.clock()
+            self._finish(job)
+        events = [
+            (
+                job["start"],
+                {
+                    "workerAssigned": {
+                        "instance": self.host,
+                        "zone": LOCAL_ZONE,
+                    }
+                },
+            ),
+            (job["start"], {"containerStarted": {"actionId": RUN_ACTION}}),
+        ]
+        if job["end"] is not None:
+            events.append(
+                (
+                    job["end"],
+                    {
+                        "containerStopped": {
+                            "actionId": RUN_ACTION,
+                            "exitStatus": status,
+                        }
+                    },
+                )
+            )
+        operation = {
+            "name": name,
+            "done": job["end"] is not None,
+            "metadata": {
+                "createTime": format_timestamp(job["start"]),
+                "events": [
+                    dict(event, timestamp=format_timestamp(t))
+                    for t, event in reversed(events)
+                ],
+            },
+        }
+        if job["end"] is not None:
+            operation["metadata"]["endTime"] = format_timestamp(job["end"])
+            if status != 0:
+                operation["error"] = {
+                    "message": "The pipeline exited with status {}".format(
+                        status
+                    )
+                }
+        return operation
+
+    def next_interval(self, operation):
+        return self.polling_interval
+
+    def error_delay(self, errors):
+        return self.polling_interval
+
+    def cancel(self, name):
+        job = self.jobs[name]
+        if job["end"] is not None:
+            return
+        if self.docker:
+            subprocess.call(
+                ["docker", "kill", job["container"]],
+                stdout=open(os.devnull, "w"),
+                stderr=subprocess.STDOUT,
+            )
+        try:
+            os.killpg(job["process"].pid, signal.SIGTERM)
+        except OSError:
+            pass
+        job["process"].wait()
+        self.fetch(name)
+
+    def close(self):
+        for name, job in sorted(self.jobs.items()):
+            if job["end"] is None:
+                logging.warning("Cancelling local job " + name)
+                self.cancel(name)
+
+
+def make_executor(
+    job_vars,
+    credentials,
+    polling_interval=30,
+    max_polling_interval=300,
+    clock=time.time,
+    sleep=time.sleep,
+):
+    """The executor chosen by the 'EXECUTOR' of a job"""
+    if job_vars["EXECUTOR"] in ("LOCAL", "DOCKER"):
+        return LocalExecutor(
+            job_vars["LOCAL_WORK_DIR"],
+            max_jobs=int(job_vars["LOCAL_MAX_JOBS"] or 1),
+            docker=job_vars["EXECUTOR"] == "DOCKER",
+            credentials=credentials,
+            polling_interval=polling_interval,
+            clock=clock,
+            sleep=sleep,
+        )
+    return LifesciencesExecutor.from_job_vars(
+        job_vars,
+        credentials,
+        polling_interval=polling_interval,
+        max_polling_interval=max_polling_interval,
+        clock=clock,
+        sleep=sleep,
+    )
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Hedge preemptible attempts with a standard attempt running alongside them
+"""
+
+import logging
+
+from api_clients import api_errors
+from polling import run_action_failed, wait_for_preemption
+from stage_stats import percentile
+from storage_check import split_gs_path
+from timeline import attempt_timeline
+from zone_history import ZoneHistory
+
+PREEMPTIBLE = "preemptible"
+STANDARD = "standard"
+ATTEMPTS_PREFIX = "attempts"
+LOGS_PREFIX = "worker_logs"
+# Outputs that are not promoted from the winning attempt
+SKIPPED_PREFIXES = ("checkpoints/",)
+
+
+def hedge_threshold(job_vars):
+    """Seconds after which a standard attempt is started, from the
+    HEDGE_PERCENTILE of the durations of the runs in the ZONE_HISTORY"""
+    if not job_vars["HEDGE_PERCENTILE"] or not job_vars["ZONE_HISTORY"]:
+        return None
+    history = ZoneHistory(job_vars["ZONE_HISTORY"])
+    durations = [
+        x["assign_s"] + x["run_s"]
+        for x in history.observations()
+        if x["run_s"] is not None
+    ]
+    if not durations:
+        logging.warning(
+            "No finished runs in the 'ZONE_HISTORY' to hedge after. Only "
+            "'HEDGE_AFTER_PREEMPTIONS' applies"
+        )
+        return None
+    return percentile(durations, float(job_vars["HEDGE_PERCENTILE"]))
+
+
+def attempt_prefix(output_bucket, kind):
+    return "{}/{}/{}".format(output_bucket, ATTEMPTS_PREFIX, kind)
+
+
+def storage_client(job_vars, credentials):
+    from google.cloud import storage
+
+    return storage.Client(
+        project=job_vars["PROJECT_ID"], credentials=credentials
+    )
+
+
+def _blobs(client, gs_path, user_project=None):
+    bucket_name, prefix = split_gs_path(gs_path)
+    bucket = client.bucket(bucket_name, user_project=user_project)
+    return bucket, prefix, bucket.list_blobs(prefix=prefix + "/")
+
+
+def copy_tree(client, src, dst, user_project=None, skipped=()):
+    """Copy the objects under a directory to another directory"""
+    src_bucket, src_prefix, blobs = _blobs(client, src, user_project)
+    dst_bucket_name, dst_prefix = split_gs_path(dst)
+    dst_bucket = client.bucket(dst_bucket_name, user_project=user_project)
+    for blob in blobs:
+        name = blob.name[len(src_prefix) + 1 :]
+        if skipped and name.startswith(skipped):
+            continue
+        src_bucket.copy_blob(
+            blob, dst_bucket, dst_prefix + "/" + name if dst_prefix else name
+        )
+
+
+def promote(client, src, dst, user_project=None):
+    """Copy the outputs of the winning attempt to the output bucket"""
+    copy_tree(client, src, dst, user_project, SKIPPED_PREFIXES)
+
+
+def keep_logs(client, src, dst, user_project=None):
+    """Copy the worker logs of an attempt to a directory"""
+    copy_tree(client, src + "/" + LOGS_PREFIX, dst, user_project)
+
+
+def remove(client, gs_path, user_project=None):
+    _, _, blobs = _blobs(client, gs_path, user_project)
+    for blob in blobs:
+        blob.delete()
+
+
+def run_hedged(
+    executor,
+    job_vars,
+    pipeline_dict,
+    attempts,
+    timelines,
+    client,
+    user_project=None,
+):
+    """Run a job on preemptible VMs, hedged with a standard VM
+
+    A standard attempt is started alongside the preemptible ones once they
+    have been preempted HEDGE_AFTER_PREEMPTIONS times, once the job has run
+    longer than the hedge threshold, or once the preemptible tries are
+    used up. Each kind of attempt writes to its own prefix of the output
+    bucket. The first attempt to succeed wins, the other is cancelled and
+    the outputs of the winner are copied to the output bucket. The logs of
+    the other attempts are kept under worker_logs/<kind>/, and those of an
+    attempt that failed in worker_logs/. An attempt prefix is only removed
+    once its outputs and logs have been copied.
+
+    Returns whether the job succeeded.
+    """
+    output_bucket = job_vars["OUTPUT_BUCKET"]
+    attempt_vars = {}
+    for kind in (PREEMPTIBLE, STANDARD):
+        attempt_vars[kind] = dict(
+            job_vars, OUTPUT_BUCKET=attempt_prefix(output_bucket, kind)
+        )
+    hedge_after = int(job_vars["HEDGE_AFTER_PREEMPTIONS"] or 0)
+    hedge_s = hedge_threshold(job_vars)
+    if hedge_s is not None:
+        logging.info("Hedging after {:.0f}s".format(hedge_s))
+    clock, sleep = executor.clock, executor.sleep
+    start = clock()
+    running = {}
+    preemptions = 0
+    winner = None
+    failed = None
+
+    def launch(kind):
+        if kind == PREEMPTIBLE:
+            preemptible = attempts.take()
+        else:
+            preemptible = attempts.take_nonpreemptible()
+        operation = executor.submit(
+            attempt_vars[kind], pipeline_dict, preemptible
+        )
+        if not operation:
+            logging.error("Failed to launch a {} attempt".format(kind))
+            return
+        logging.warning(
+            "Launched {} attempt: {}".format(kind, operation["name"])
+        )
+        running[kind] = [
+            operation,
+            clock() + executor.next_interval(operation),
+            0,
+        ]
+
+    def hedge_due():
+        """When the standard attempt should start, or None"""
+        if STANDARD in running or not attempts.nonpreemptible_tries:
+            return None
+        if PREEMPTIBLE not in running:
+            return clock()
+        if hedge_after and preemptions >= hedge_after:
+            return clock()
+        return start + hedge_s if hedge_s is not None else None
+
+    def finished(kind, operation):
+        """Handle a failed attempt, returning whether it was preempted"""
+        timelines.append(attempt_timeline(operation))
+        worker = executor.worker(operation)
+        if not worker:
+            logging.error("The {} attempt failed before running:".format(kind))
+            logging.error(str(operation["error"]))
+            return False
+        preempted = False
+        if executor.can_preempt and not run_action_failed(operation):
+            preempted = wait_for_preemption(
+                lambda: executor.was_preempted(job_vars, worker),
+                clock=clock,
+                sleep=sleep,
+            )
+        executor.record(operation, preempted)
+        if preempted:
+            timelines[-1]["preempted"] = True
+        return preempted
+
+    if attempts.preemptible_tries:
+        launch(PREEMPTIBLE)
+    while winner is None and failed is None:
+        due = hedge_due()
+        if due is not None and due <= clock():
+            launch(STANDARD)
+            due = None
+        if not running:
+            break
+        next_due = min(x[1] for x in running.values())
+        if due is not None:
+            next_due = min(next_due, due)
+        sleep(max(0, next_due - clock()))
+
+        for kind in sorted(running):
+            operation, op_due, errors = running[kind]
+            if op_due > clock():
+                continue
+            try:
+                operation = executor.fetch(operation["name"])
+            except api_errors() as e:
+                logging.warning(str(e))
+                running[kind][1] = clock() + executor.error_delay(errors + 1)
+                running[kind][2] = errors + 1
+                continue
+            if not operation.get("done", False):
+                running[kind] = [
+                    operation,
+                    clock() + executor.next_interval(operation),
+                    0,
+                ]
+                continue
+            del running[kind]
+            if "error" not in operation:
+                logging.warning("The {} attempt succeeded".format(kind))
+                executor.record(operation, False)
+                timelines.append(attempt_timeline(operation))
+                winner = kind
+                break
+            if finished(kind, operation):
+                preemptions += 1
+                logging.warning(
+                    "The {} attempt was preempted".format(kind)
+                )
+                if kind == PREEMPTIBLE and attempts.preemptible_tries:
+                    launch(PREEMPTIBLE)
+                continue
+            logging.error(
+                "The {} attempt failed, but not due to preemption".format(
+                    kind
+                )
+            )
+            failed = kind
+            break
+
+    # Stop the other attempt before its outputs are removed
+    for kind, (operation, _, _) in sorted(running.items()):
+        logging.warning("Cancelling the {} attempt".format(kind))
+        try:
+            executor.cancel(operation["name"])
+            operation = executor.wait(operation)
+        except api_errors() as e:
+            logging.warning(str(e))
+            operation = None
+        if operation:
+            timelines.append(attempt_timeline(operation))
+    for kind in (PREEMPTIBLE, STANDARD):
+        src = attempt_vars[kind]["OUTPUT_BUCKET"]
+        if kind == winner:
+            promote(client, src, output_bucket, user_project)
+        elif kind == failed:
+            keep_logs(
+                client, src, output_bucket + "/" + LOGS_PREFIX, user_project
+            )
+        else:
+            keep_logs(
+                client,
+                src,
+                "{}/{}/{}".format(output_bucket, LOGS_PREFIX, kind),
+                user_project,
+            )
+        remove(client, src, user_project)
+    return winner is not None
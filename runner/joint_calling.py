@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Joint genotype the GVCFs of a cohort across many VMs
+"""
+
+import copy
+import logging
+import sys
+
+from batch_scheduler import run_jobs, scheduler_args
+from sharding import (
+    balanced_shards,
+    nondecoy_contigs,
+    parse_fai,
+    shard_length,
+    shard_regions,
+)
+from storage_check import StorageStat, read_gs_text, split_gs_path
+
+# The GVCF in the variants/ of a GERMLINE or CCDG run with GVCF_OUTPUT
+RUN_GVCFS = ("hc.g.vcf.gz", "dnascope.g.vcf.gz")
+MANIFEST_NAME = "gvcfs.txt"
+
+
+def storage_client(job_vars, credentials):
+    from google.cloud import storage
+
+    return storage.Client(
+        project=job_vars["PROJECT_ID"], credentials=credentials
+    )
+
+
+def parse_manifest(text):
+    """The first column of each line, skipping blank and comment lines"""
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        entries.append(line.split("\t")[0].strip())
+    return entries
+
+
+def cohort_entries(job_vars, client, user_project=None):
+    if job_vars["GVCFS"]:
+        return [x.strip() for x in job_vars["GVCFS"].split(",") if x.strip()]
+    manifest = job_vars["GVCF_MANIFEST"]
+    if manifest.startswith("gs://"):
+        return parse_manifest(read_gs_text(client, manifest, user_project))
+    with open(manifest) as f:
+        return parse_manifest(f.read())
+
+
+def candidate_gvcfs(entry):
+    """A GVCF, or the GVCFs the OUTPUT_BUCKET of a run could hold"""
+    if entry.endswith(".vcf.gz"):
+        return [entry]
+    return ["{}/variants/{}".format(entry.rstrip("/"), x) for x in RUN_GVCFS]
+
+
+def resolve_gvcfs(job_vars, credentials, user_project=None):
+    """The GVCFs of the cohort and the stats of them and their indices
+
+    Entries of the GVCFS or GVCF_MANIFEST are GVCF files or the
+    OUTPUT_BUCKET of a run with GVCF_OUTPUT, such as the jobs of a batch.
+    """
+    client = storage_client(job_vars, credentials)
+    entries = cohort_entries(job_vars, client, user_project)
+    if not entries:
+        logging.error("The cohort has no GVCF files")
+        sys.exit(-1)
+    stat = StorageStat(client, user_project=user_project)
+    paths = []
+    for entry in entries:
+        for gvcf in candidate_gvcfs(entry):
+            paths.extend([gvcf, gvcf + ".tbi"])
+    stat.resolve(paths)
+
+    gvcfs, stats, missing = [], {}, []
+    for entry in entries:
+        found = [x for x in candidate_gvcfs(entry) if stat.exists(x)]
+        if not found:
+            missing.append("Could not find a GVCF for {}".format(entry))
+            continue
+        if not stat.exists(found[0] + ".tbi"):
+            missing.append("Could not find index for file " + found[0])
+            continue
+        gvcfs.append(found[0])
+        for path in (found[0], found[0] + ".tbi"):
+            stats[path] = stat.stats[path]
+    if missing:
+        for msg in missing:
+            logging.error(msg)
+        sys.exit(-1)
+    if len(set(gvcfs)) != len(gvcfs):
+        logging.error("The cohort lists a GVCF file more than once")
+        sys.exit(-1)
+    return gvcfs, stats
+
+
+def write_manifest(client, gvcfs, output_bucket, user_project=None):
+    """Upload the list of GVCFs read by every shard"""
+    bucket_name, prefix = split_gs_path(output_bucket)
+    name = MANIFEST_NAME
+    if prefix:
+        name = prefix.rstrip("/") + "/" + name
+    bucket = client.bucket(bucket_name, user_project=user_project)
+    bucket.blob(name).upload_from_string(
+        "\n".join(gvcfs) + "\n", content_type="text/plain"
+    )
+    return "gs://{}/{}".format(bucket_name, name)
+
+
+def shard_job_vars(job_vars, manifest, shards):
+    """The job_vars of the genotyping operation for each shard"""
+    all_vars = []
+    for i, shard in enumerate(shards):
+        shard_vars = copy.deepcopy(job_vars)
+        shard_vars.update(
+            GVCFS=None,
+            GVCF_MANIFEST=manifest,
+            SHARD=",".join(shard_regions(shard)),
+            OUTPUT_BUCKET="{}/shards/shard-{:04d}".format(
+                job_vars["OUTPUT_BUCKET"], i
+            ),
+            CALLING_SHARDS=None,
+        )
+        all_vars.append(shard_vars)
+    return all_vars
+
+
+def gather_job_vars(job_vars, shard_outputs):
+    gather_vars = copy.deepcopy(job_vars)
+    gather_vars.update(
+        GVCFS=None,
+        GVCF_MANIFEST=None,
+        SHARD_OUTPUTS=",".join(shard_outputs),
+        MACHINE_TYPE=job_vars["GATHER_MACHINE_TYPE"],
+        CALLING_SHARDS=None,
+    )
+    return gather_vars
+
+
+def run_joint_calling(
+    job_vars,
+    gvcfs,
+    credentials,
+    user_project=None,
+    polling_interval=30,
+    max_polling_interval=300,
+    dry_run=False,
+):
+    """Genotype the GVCFs in CALLING_SHARDS operations and merge the
+    shards into a single VCF
+
+    Each shard reads only its regions of every GVCF, so no operation
+    reads the whole cohort.
+    """
+    client = storage_client(job_vars, credentials)
+    fai = read_gs_text(client, job_vars["REF"] + ".fai", user_project)
+    contigs = nondecoy_contigs(parse_fai(fai))
+    n_shards = int(job_vars["CALLING_SHARDS"] or 1)
+    shards = balanced_shards(contigs, n_shards) if n_shards > 1 else []
+    logging.info("Joint genotyping {} GVCF files".format(len(gvcfs)))
+    for i, shard in enumerate(shards):
+        logging.info(
+            "Shard {}: {} bp in {} region(s)".format(
+                i, shard_length(shard), len(shard)
+            )
+        )
+    if dry_run:
+        manifest = "{}/{}".format(job_vars["OUTPUT_BUCKET"], MANIFEST_NAME)
+    else:
+        manifest = write_manifest(
+            client, gvcfs, job_vars["OUTPUT_BUCKET"], user_project
+        )
+    all_shard_vars = shard_job_vars(job_vars, manifest, shards)
+    if all_shard_vars:
+        gather_vars = gather_job_vars(
+            job_vars,
+            [x["OUTPUT_BUCKET"] + "/shard.vcf.gz" for x in all_shard_vars],
+        )
+        stages = [
+            (all_shard_vars, "Joint genotyping failed in one or more shards"),
+            ([gather_vars], "Merging the joint genotyped shards failed"),
+        ]
+    else:
+        cohort_vars = copy.deepcopy(job_vars)
+        cohort_vars.update(GVCFS=None, GVCF_MANIFEST=manifest)
+        stages = [([cohort_vars], "Joint genotyping failed")]
+    if dry_run:
+        for all_vars, _ in stages:
+            for x in all_vars:
+                label = x["SHARD"] or "cohort"
+                if x["SHARD_OUTPUTS"]:
+                    label = "gather"
+                print("{}\t{}".format(x["OUTPUT_BUCKET"], label))
+        return
+
+    args = scheduler_args(
+        job_vars, credentials, polling_interval, max_polling_interval
+    )
+    for all_vars, error in stages:
+        if not run_jobs(all_vars, args):
+            logging.error(error)
+            sys.exit(4)
+    logging.warning("Operation succeeded")
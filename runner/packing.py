@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Pack the small jobs of a batch into operations running several samples
+"""
+
+import copy
+import hashlib
+import json
+
+import sentieon_runner as runner
+
+from executors import job_environment
+
+PACKABLE_PIPELINES = ("GERMLINE", "CCDG", "SOMATIC")
+# Options that may differ between the samples of a packed operation. All
+# other options, including the reference and sites files, are shared
+SAMPLE_KEYS = (
+    "FQ1",
+    "FQ2",
+    "BAM",
+    "READGROUP",
+    "TUMOR_FQ1",
+    "TUMOR_FQ2",
+    "TUMOR_BAM",
+    "TUMOR_READGROUP",
+    "INTERVAL",
+    "INTERVAL_FILE",
+    "RECAL_TABLE",
+    "START_FROM",
+    "OUTPUT_BUCKET",
+)
+PACK_PREFIX = "worker_logs/pack"
+
+
+def pack_key(job_vars):
+    """Jobs with the same key can run in one packed operation"""
+    shared = dict(
+        (k, v) for k, v in job_vars.items() if k not in SAMPLE_KEYS
+    )
+    return json.dumps(shared, sort_keys=True)
+
+
+def pack_groups(named_vars):
+    """Split (name, job_vars) pairs into groups of up to PACK_SAMPLES jobs
+    with the same pack key, in their original order"""
+    by_key = {}
+    order = []
+    sizes = {}
+    for name, job_vars in named_vars:
+        key = pack_key(job_vars)
+        if key not in by_key:
+            by_key[key] = []
+            order.append(key)
+            sizes[key] = int(job_vars["PACK_SAMPLES"] or 1)
+        by_key[key].append(name)
+    groups = []
+    for key in order:
+        names = by_key[key]
+        for i in range(0, len(names), sizes[key]):
+            groups.append(names[i : i + sizes[key]])
+    return groups
+
+
+def sample_environment(job_vars):
+    """The environment of the pipeline script of a sample, with the path
+    of the marker written when the sample completes"""
+    env = job_environment(
+        job_vars, runner.check_job_vars(copy.deepcopy(job_vars))
+    )
+    digest = hashlib.sha256(
+        json.dumps(env, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    env["PACK_DONE"] = "{}/checkpoints/packed-{}.done".format(
+        job_vars["OUTPUT_BUCKET"], digest[:16]
+    )
+    return env
+
+
+def packed_job_vars(all_vars):
+    """The job_vars of an operation running the jobs of a pack group
+
+    The operation writes its own logs under the first sample's
+    OUTPUT_BUCKET. Samples run at the same time each get a DISK_SIZE of
+    local disk.
+    """
+    first = all_vars[0]
+    concurrency = min(int(first["PACK_CONCURRENCY"] or 1), len(all_vars))
+    pack_vars = copy.deepcopy(first)
+    for key in SAMPLE_KEYS:
+        pack_vars[key] = None
+    pack_vars.update(
+        PIPELINE="PACK",
+        PACK_PIPELINE=first["PIPELINE"],
+        PACK_JOBS=json.dumps(
+            [sample_environment(x) for x in all_vars], sort_keys=True
+        ),
+        OUTPUT_BUCKET="{}/{}".format(first["OUTPUT_BUCKET"], PACK_PREFIX),
+        DISK_SIZE=int(first["DISK_SIZE"]) * concurrency,
+    )
+    return pack_vars
+
+
+def done_markers(pack_vars):
+    """The marker of each sample of a packed operation"""
+    return [x["PACK_DONE"] for x in json.loads(pack_vars["PACK_JOBS"])]
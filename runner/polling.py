@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Adaptive polling of Lifesciences operations and their preemption records
+"""
+
+import calendar
+import logging
+import random
+import time
+
+from api_clients import api_errors
+
+RUN_ACTION = 1
+CLEANUP_ACTION = 2
+# Exit statuses above this are 128 plus the signal that killed a process
+SIGNAL_EXIT = 128
+
+
+def parse_timestamp(timestamp):
+    """Convert an RFC 3339 timestamp to seconds since the epoch"""
+    date, _, frac = timestamp.rstrip("Z").partition(".")
+    seconds = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+    if frac:
+        seconds += float("0." + frac[:6])
+    return seconds
+
+
+def format_timestamp(seconds):
+    """Convert seconds since the epoch to an RFC 3339 timestamp"""
+    return "{}.{:06d}Z".format(
+        time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(int(seconds))),
+        int((seconds - int(seconds)) * 1e6),
+    )
+
+
+def operation_events(operation):
+    """The events of an operation as (time, event) in chronological order"""
+    events = operation.get("metadata", {}).get("events", [])
+    timed = [(parse_timestamp(e["timestamp"]), e) for e in events]
+    return sorted(timed, key=lambda x: x[0])
+
+
+def event_time(events, key, action_id=None):
+    """The time of the last event of a type, optionally for one action"""
+    found = None
+    for t, event in events:
+        if key not in event:
+            continue
+        if action_id is not None and event[key].get("actionId") != action_id:
+            continue
+        found = t
+    return found
+
+
+def run_action_failed(operation):
+    """Whether the pipeline action itself exited with an error
+
+    An action killed by a signal (exit status above 128), as when a
+    preemptible VM shuts down, is not counted, so that the preemption
+    records are still checked.
+    """
+    for _, event in operation_events(operation):
+        stopped = event.get("containerStopped") or event.get(
+            "unexpectedExitStatus"
+        )
+        if (
+            stopped
+            and stopped.get("actionId") == RUN_ACTION
+            and 0 < stopped.get("exitStatus", 0) <= SIGNAL_EXIT
+        ):
+            return True
+    return False
+
+
+class OperationPoller(object):
+    """Poll an operation at intervals derived from its event timeline
+
+    The operation is polled every `min_interval` seconds while it is
+    starting (queued, provisioning, pulling images) and after the pipeline
+    action stops. While the pipeline action is running the interval grows
+    with the time spent in the action (`fraction` of the elapsed time), up
+    to `max_interval`. Failed requests are retried with capped exponential
+    backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        service,
+        min_interval=30,
+        max_interval=300,
+        fraction=0.1,
+        max_errors=6,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.service = service
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.fraction = fraction
+        self.max_errors = max_errors
+        self.clock = clock
+        self.sleep = sleep
+
+    def fetch(self, name):
+        ops = self.service.projects().locations().operations()
+        return ops.get(name=name).execute()
+
+    def next_interval(self, operation):
+        events = operation_events(operation)
+        run_started = event_time(events, "containerStarted", RUN_ACTION)
+        run_stopped = event_time(events, "containerStopped", RUN_ACTION)
+        if run_started is None or (
+            run_stopped is not None and run_stopped >= run_started
+        ):
+            return self.min_interval
+        elapsed = max(0, self.clock() - run_started)
+        return min(
+            self.max_interval, max(self.min_interval, elapsed * self.fraction)
+        )
+
+    def error_delay(self, errors):
+        delay = min(self.max_interval, self.min_interval * 2 ** (errors - 1))
+        return delay * (0.5 + random.random() / 2)
+
+    def wait(self, operation):
+        """Wait for an operation to finish
+
+        Returns the finished operation, or None after `max_errors`
+        consecutive failed requests.
+        """
+        errors = 0
+        delay = self.next_interval(operation)
+        while not operation.get("done", False):
+            self.sleep(delay)
+            try:
+                operation = self.fetch(operation["name"])
+            except api_errors() as e:
+                logging.warning(str(e))
+                errors += 1
+                if errors > self.max_errors:
+                    return None
+                delay = self.error_delay(errors)
+                continue
+            errors = 0
+            delay = self.next_interval(operation)
+            logging.debug(
+                "Next poll of {} in {:.0f}s".format(operation["name"], delay)
+            )
+        return operation
+
+
+def wait_for_preemption(
+    check, deadline=300, interval=15, clock=time.time, sleep=time.sleep
+):
+    """Repeatedly call `check` until it returns True or the deadline passes
+
+    Preemption records can take a few minutes to appear after an operation
+    fails, so the record is looked for every `interval` seconds instead of
+    once after a fixed delay.
+    """
+    end = clock() + deadline
+    while True:
+        try:
+            if check():
+                return True
+        except api_errors() as e:
+            logging.warning(str(e))
+        if clock() >= end:
+            return False
+        sleep(min(interval, max(0, end - clock())))
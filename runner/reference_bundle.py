@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Pack the reference and sites files of jobs into a single reusable bundle
+"""
+
+import copy
+import json
+import logging
+
+from batch_scheduler import run_jobs, scheduler_args
+from storage_check import StorageStat, read_gs_text, split_gs_path
+
+BUNDLE_FORMAT = 2
+BUNDLE_MACHINE_TYPE = "n1-standard-8"
+REF_SUFFIXES = (".fai", ".dict")
+BWA_SUFFIXES = (".amb", ".ann", ".bwt", ".pac", ".sa", ".alt")
+SITES_SUFFIXES = (".idx", ".tbi")
+# The BWA index is only downloaded by jobs aligning FASTQ, so it is packed
+# into its own part of the bundle
+BUNDLE_PART = "bundle"
+BWA_PART = "bwa"
+
+
+def candidate_files(job_vars):
+    """All reference and sites files a job could download, in order"""
+    ref = job_vars["REF"]
+    ref_base = ref[:-3] if ref.endswith(".fa") else ref[:-6]
+    paths = [ref] + [ref + x for x in REF_SUFFIXES] + [ref_base + ".dict"]
+    for key in ("BQSR_SITES", "REALIGN_SITES", "DBSNP"):
+        for sites_file in (job_vars[key] or "").split(","):
+            if sites_file:
+                paths.append(sites_file)
+                paths += [sites_file + x for x in SITES_SUFFIXES]
+    return paths
+
+
+def aligns_fastq(job_vars):
+    return bool(job_vars.get("FQ1") or job_vars.get("TUMOR_FQ1"))
+
+
+def bwa_candidates(job_vars):
+    """The BWA index files a job could download, of either variant"""
+    if not aligns_fastq(job_vars):
+        return []
+    return [
+        job_vars["REF"] + middle + x
+        for middle in (".64", "")
+        for x in BWA_SUFFIXES
+    ]
+
+
+def bwa_files(job_vars, stats):
+    """The files of the BWA index variant that download_reference uses"""
+    if not aligns_fastq(job_vars):
+        return []
+    ref = job_vars["REF"]
+    for middle in (".64", ""):
+        if ref + middle + ".amb" in stats:
+            paths = [ref + middle + x for x in BWA_SUFFIXES]
+            return [x for x in paths if x in stats]
+    return []
+
+
+def manifest_entry(path, stat, part):
+    return {
+        "path": path,
+        "size": stat["size"],
+        "generation": stat["generation"],
+        "crc32c": stat["crc32c"],
+        "part": part,
+    }
+
+
+def current_entries(manifest, stats):
+    """The manifest entries whose source object is unchanged"""
+    if not manifest or manifest.get("format") != BUNDLE_FORMAT:
+        return []
+    return [
+        entry
+        for entry in manifest["files"]
+        if entry["path"] in stats
+        and manifest_entry(entry["path"], stats[entry["path"]], entry["part"])
+        == entry
+    ]
+
+
+def read_manifest(client, bundle, user_project=None):
+    try:
+        return json.loads(
+            read_gs_text(client, bundle + "/manifest.json", user_project)
+        )
+    except Exception as err:  # Catch all exceptions
+        logging.info("No usable manifest in {}: {}".format(bundle, err))
+        return None
+
+
+def write_manifest(client, bundle, files, stats, user_project=None):
+    """Record the bundle contents once the tar file of each part has been
+    written. `files` maps the path of each packed file to its part"""
+    bucket_name, prefix = split_gs_path(bundle)
+    bucket = client.bucket(bucket_name, user_project=user_project)
+    parts = {}
+    for part in sorted(set(files.values())):
+        packed = bucket.get_blob("{}/{}.tar".format(prefix, part))
+        parts[part] = {"size": packed.size, "crc32c": packed.crc32c}
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "parts": parts,
+        "files": [
+            manifest_entry(x, stats[x], files[x]) for x in sorted(files)
+        ],
+    }
+    bucket.blob(prefix + "/manifest.json").upload_from_string(
+        json.dumps(manifest, indent=2, sort_keys=True),
+        content_type="application/json",
+    )
+
+
+def bundle_job_vars(job_vars, files):
+    bundle_vars = copy.deepcopy(job_vars)
+    bwa = sorted(x for x, part in files.items() if part == BWA_PART)
+    bundle_vars.update(
+        PIPELINE="BUNDLE_REFERENCE",
+        BUNDLE_FILES=",".join(
+            sorted(x for x, part in files.items() if part == BUNDLE_PART)
+        ),
+        BUNDLE_BWA_FILES=",".join(bwa) or None,
+        OUTPUT_BUCKET=job_vars["REFERENCE_BUNDLE"],
+        MACHINE_TYPE=BUNDLE_MACHINE_TYPE,
+        ALIGNMENT_CHUNKS=None,
+        CALLING_SHARDS=None,
+    )
+    return bundle_vars
+
+
+def ensure_reference_bundle(
+    all_job_vars,
+    credentials,
+    user_project=None,
+    polling_interval=30,
+    max_polling_interval=300,
+    dry_run=False,
+):
+    """Make the REFERENCE_BUNDLE shared by jobs cover all of their files
+
+    The bundle is left as it is when its manifest lists every reference
+    and sites file of the jobs and none of the files have changed.
+    Otherwise the bundle is rebuilt with one operation. The BWA index is
+    only bundled for jobs aligning FASTQ, in a separate part. Returns
+    whether the jobs can use the bundle.
+    """
+    from google.cloud import storage
+
+    job_vars = all_job_vars[0]
+    bundle = job_vars["REFERENCE_BUNDLE"]
+    client = storage.Client(
+        project=job_vars["PROJECT_ID"], credentials=credentials
+    )
+    manifest = read_manifest(client, bundle, user_project)
+    paths = []
+    for x in all_job_vars:
+        paths.extend(candidate_files(x) + bwa_candidates(x))
+    if manifest:
+        paths.extend(entry["path"] for entry in manifest.get("files", []))
+    stat = StorageStat(client, user_project=user_project)
+    stats = stat.resolve(paths)
+    needed = {}
+    for x in all_job_vars:
+        for path in candidate_files(x):
+            if path in stats:
+                needed[path] = BUNDLE_PART
+        for path in bwa_files(x, stats):
+            needed[path] = BWA_PART
+    current = current_entries(manifest, stats)
+    if (
+        manifest
+        and len(current) == len(manifest["files"])
+        and set(needed.items())
+        <= set((entry["path"], entry["part"]) for entry in current)
+    ):
+        logging.info(
+            "Using the reference bundle {} of {} files".format(
+                bundle, len(current)
+            )
+        )
+        return True
+
+    files = needed
+    logging.warning(
+        "Building the reference bundle {} of {} files ({} bytes)".format(
+            bundle, len(files), sum(stats[x]["size"] or 0 for x in files)
+        )
+    )
+    if dry_run:
+        return True
+    args = scheduler_args(
+        job_vars, credentials, polling_interval, max_polling_interval
+    )
+    if not run_jobs([bundle_job_vars(job_vars, files)], args):
+        logging.error(
+            "Building the reference bundle failed. Files will be "
+            "downloaded individually"
+        )
+        return False
+    write_manifest(client, bundle, files, stats, user_project)
+    return True
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Reuse the outputs of an earlier run with the same options and inputs
+"""
+
+import calendar
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from storage_check import split_gs_path
+
+CACHE_FORMAT = 1
+DAY = 24 * 60 * 60
+# Options that choose where and how a job runs, but not its outputs
+IGNORED_KEYS = (
+    "OUTPUT_BUCKET",
+    "PROJECT_ID",
+    "REQUESTER_PROJECT",
+    "EMAIL",
+    "SENTIEON_KEY",
+    "EXECUTOR",
+    "LOCAL_WORK_DIR",
+    "LOCAL_MAX_JOBS",
+    "ZONES",
+    "ZONE_HISTORY",
+    "ZONE_HISTORY_DAYS",
+    "PIPELINE_REGION",
+    "MACHINE_TYPE",
+    "DISK_SIZE",
+    "SIZING_TABLE",
+    "CPU_PLATFORM",
+    "PREEMPTIBLE_TRIES",
+    "NONPREEMPTIBLE_TRY",
+    "HEDGE_AFTER_PREEMPTIONS",
+    "HEDGE_PERCENTILE",
+    "REFERENCE_BUNDLE",
+    "ARTIFACT_CACHE",
+    "CHECKPOINTS",
+    "PACK_SAMPLES",
+    "PACK_CONCURRENCY",
+    "RESULT_CACHE",
+    "RESULT_CACHE_DAYS",
+    "RESULT_CACHE_ENTRIES",
+)
+# Output prefixes that are not results of the job
+SKIPPED_PREFIXES = ("worker_logs/", "checkpoints/", "attempts/")
+UPDATE_TRIES = 5
+
+
+def cache_key(job_vars, input_stats):
+    """A digest of everything that determines the outputs of a job
+
+    This is the job options after the defaults are merged, including the
+    SENTIEON_VERSION and DOCKER_IMAGE, and the generation and CRC32C of
+    every input file.
+    """
+    options = dict(
+        (k, v) for k, v in job_vars.items() if k not in IGNORED_KEYS
+    )
+    inputs = sorted(
+        [path, stat["generation"], stat["crc32c"]]
+        for path, stat in input_stats.items()
+    )
+    payload = json.dumps(
+        {"format": CACHE_FORMAT, "options": options, "inputs": inputs},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def evict(entries, max_age_days, max_entries, now=None):
+    """Drop expired entries, then the least recently used ones over the
+    limit"""
+    now = now or time.time()
+    if max_age_days:
+        for key in list(entries):
+            if entries[key]["created"] < now - float(max_age_days) * DAY:
+                del entries[key]
+    if max_entries and len(entries) > int(max_entries):
+        by_use = sorted(entries, key=lambda x: entries[x]["last_used"])
+        for key in by_use[: len(entries) - int(max_entries)]:
+            del entries[key]
+    return entries
+
+
+def _object_name(prefix, name):
+    return prefix + "/" + name if prefix else name
+
+
+def _created(blob):
+    """The creation time of an object, in seconds since the epoch"""
+    created = blob.time_created
+    return calendar.timegm(created.utctimetuple()) + created.microsecond / 1e6
+
+
+class ResultCache(object):
+    """An index of cache keys to the outputs of earlier runs
+
+    The index is a json file in Google Cloud Storage or on the local
+    disk. Updates of a Cloud Storage index are conditional on its
+    generation, so runners sharing an index do not lose each other's
+    entries.
+    """
+
+    def __init__(
+        self,
+        location,
+        client,
+        user_project=None,
+        max_age_days=None,
+        max_entries=None,
+    ):
+        self.location = location
+        self.client = client
+        self.user_project = user_project
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+
+    def _bucket(self, name):
+        return self.client.bucket(name, user_project=self.user_project)
+
+    def _read(self):
+        """The index entries and the generation they were read at"""
+        if not self.location.startswith("gs://"):
+            if not os.path.exists(self.location):
+                return {}, None
+            with open(self.location) as f:
+                return json.load(f)["entries"], None
+        bucket, name = split_gs_path(self.location)
+        blob = self._bucket(bucket).get_blob(name)
+        if blob is None:
+            return {}, 0
+        index = json.loads(blob.download_as_string().decode("utf-8"))
+        return index["entries"], blob.generation
+
+    def _write(self, entries, generation):
+        text = json.dumps(
+            {"format": CACHE_FORMAT, "entries": entries},
+            indent=2,
+            sort_keys=True,
+        )
+        if not self.location.startswith("gs://"):
+            # A unique file, so runners sharing the index do not write to
+            # the same temporary file
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.location)),
+                prefix=os.path.basename(self.location) + ".",
+                suffix=".tmp",
+            )
+            # Readable by others, like a file written with open()
+            os.chmod(tmp, 0o644)
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.rename(tmp, self.location)
+            return
+        bucket, name = split_gs_path(self.location)
+        self._bucket(bucket).blob(name).upload_from_string(
+            text,
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+
+    def update(self, fun):
+        """Apply fun to the index entries and write them back, retrying
+        if another runner changed the index meanwhile"""
+        from google.api_core.exceptions import PreconditionFailed
+
+        for attempt in range(UPDATE_TRIES):
+            entries, generation = self._read()
+            fun(entries)
+            evict(entries, self.max_age_days, self.max_entries)
+            try:
+                self._write(entries, generation)
+                return
+            except PreconditionFailed:
+                if attempt + 1 == UPDATE_TRIES:
+                    raise
+
+    def lookup(self, key):
+        entries, _ = self._read()
+        return entries.get(key)
+
+    def _current(self, entry):
+        """Whether the recorded outputs are unchanged"""
+        bucket_name, prefix = split_gs_path(entry["output_bucket"])
+        bucket = self._bucket(bucket_name)
+        for name, generation in entry["outputs"].items():
+            blob = bucket.get_blob(_object_name(prefix, name))
+            if blob is None or blob.generation != generation:
+                return False
+        return True
+
+    def _copy(self, entry, output_bucket):
+        src_bucket_name, src_prefix = split_gs_path(entry["output_bucket"])
+        dst_bucket_name, dst_prefix = split_gs_path(output_bucket)
+        src_bucket = self._bucket(src_bucket_name)
+        dst_bucket = self._bucket(dst_bucket_name)
+        for name in sorted(entry["outputs"]):
+            src_bucket.copy_blob(
+                src_bucket.blob(_object_name(src_prefix, name)),
+                dst_bucket,
+                _object_name(dst_prefix, name),
+            )
+
+    def restore(self, key, output_bucket):
+        """Copy the outputs of an earlier run with the same key to the
+        output_bucket, returning the output bucket of the earlier run or
+        None on a miss
+
+        Entries whose outputs were deleted or overwritten since are
+        invalidated.
+        """
+        entry = self.lookup(key)
+        if not entry:
+            return None
+        if not self._current(entry):
+            logging.warning(
+                "The cached outputs in {} have changed. Discarding them "
+                "from the result cache".format(entry["output_bucket"])
+            )
+            self.update(lambda entries: entries.pop(key, None))
+            return None
+        if entry["output_bucket"] != output_bucket:
+            self._copy(entry, output_bucket)
+
+        def touch(entries):
+            if key in entries:
+                entries[key]["last_used"] = time.time()
+
+        self.update(touch)
+        return entry["output_bucket"]
+
+    def record(self, key, output_bucket, since):
+        """Add the outputs of a finished run to the index
+
+        Only the objects created since the run started, at `since` seconds
+        since the epoch, are outputs of the run. Older objects in the
+        output bucket are left out of the entry.
+        """
+        bucket_name, prefix = split_gs_path(output_bucket)
+        outputs = {}
+        listed = self._bucket(bucket_name).list_blobs(
+            prefix=_object_name(prefix, "")
+        )
+        for blob in listed:
+            name = blob.name[len(_object_name(prefix, "")) :]
+            if name.startswith(SKIPPED_PREFIXES) or _created(blob) < since:
+                continue
+            outputs[name] = blob.generation
+        now = time.time()
+        entry = {
+            "output_bucket": output_bucket,
+            "outputs": outputs,
+            "created": now,
+            "last_used": now,
+        }
+        self.update(lambda entries: entries.update({key: entry}))
+
+
+def open_cache(job_vars, credentials, user_project=None):
+    from google.cloud import storage
+
+    client = storage.Client(
+        project=job_vars["PROJECT_ID"], credentials=credentials
+    )
+    return ResultCache(
+        job_vars["RESULT_CACHE"],
+        client,
+        user_project=user_project,
+        max_age_days=job_vars["RESULT_CACHE_DAYS"],
+        max_entries=job_vars["RESULT_CACHE_ENTRIES"],
+    )
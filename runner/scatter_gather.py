@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Call variants across many VMs from a preprocessed BAM file
+"""
+
+import copy
+import logging
+import sys
+
+from autosize import DISK_HEADROOM_GB, GB, input_bytes, local_ssd_disk
+from batch_scheduler import run_jobs, scheduler_args
+from sharding import (
+    balanced_shards,
+    nondecoy_contigs,
+    parse_fai,
+    shard_length,
+    shard_regions,
+)
+from storage_check import read_gs_text
+
+
+def shard_output(shard_vars):
+    ext = "g.vcf.gz" if shard_vars["GVCF_OUTPUT"] else "vcf.gz"
+    return "{}/shard.{}".format(shard_vars["OUTPUT_BUCKET"], ext)
+
+
+def shard_disk_sizes(job_vars, shards, input_stats):
+    """The DISK_SIZE of each shard, holding its share of the BAM files
+
+    Shards read only their regions of the BAM files, taken to be in
+    proportion to their length, along with the reference and sites files.
+    """
+    reads, other = input_bytes(job_vars, input_stats)
+    total = sum(shard_length(x) for x in shards)
+    sizes = []
+    for shard in shards:
+        reads_gb = float(reads) * shard_length(shard) / total / GB
+        needed = reads_gb + float(other) / GB + DISK_HEADROOM_GB
+        _, size = local_ssd_disk(needed, job_vars["MACHINE_TYPE"])
+        sizes.append(size)
+    return sizes
+
+
+def shard_job_vars(job_vars, shards, disk_sizes=None):
+    """The job_vars of the calling operation for each shard"""
+    all_vars = []
+    for i, shard in enumerate(shards):
+        shard_vars = copy.deepcopy(job_vars)
+        shard_vars.update(
+            PIPELINE="CALL_SHARD",
+            SHARD=",".join(shard_regions(shard)),
+            OUTPUT_BUCKET="{}/shards/shard-{:04d}".format(
+                job_vars["OUTPUT_BUCKET"], i
+            ),
+            CALLING_SHARDS=None,
+        )
+        if disk_sizes:
+            shard_vars["DISK_SIZE"] = disk_sizes[i]
+        all_vars.append(shard_vars)
+    return all_vars
+
+
+def gather_job_vars(job_vars, shard_outputs):
+    gather_vars = copy.deepcopy(job_vars)
+    gather_vars.update(
+        PIPELINE="CALL_GATHER",
+        SHARD_OUTPUTS=",".join(shard_outputs),
+        MACHINE_TYPE=job_vars["GATHER_MACHINE_TYPE"],
+        CALLING_SHARDS=None,
+    )
+    return gather_vars
+
+
+def run_sharded_calling(
+    job_vars,
+    credentials,
+    user_project=None,
+    polling_interval=30,
+    max_polling_interval=300,
+    dry_run=False,
+    input_stats=None,
+):
+    """Scatter variant calling over CALLING_SHARDS operations and gather
+    the results into a single VCF or GVCF
+
+    With `input_stats`, the disk of each shard is sized from the share of
+    the inputs it reads instead of the job DISK_SIZE.
+    """
+    from google.cloud import storage
+
+    client = storage.Client(
+        project=job_vars["PROJECT_ID"], credentials=credentials
+    )
+    fai = read_gs_text(client, job_vars["REF"] + ".fai", user_project)
+    contigs = nondecoy_contigs(parse_fai(fai))
+    shards = balanced_shards(contigs, int(job_vars["CALLING_SHARDS"]))
+    for i, shard in enumerate(shards):
+        logging.info(
+            "Shard {}: {} bp in {} region(s)".format(
+                i, shard_length(shard), len(shard)
+            )
+        )
+    disk_sizes = None
+    if input_stats:
+        disk_sizes = shard_disk_sizes(job_vars, shards, input_stats)
+    all_shard_vars = shard_job_vars(job_vars, shards, disk_sizes)
+    gather_vars = gather_job_vars(
+        job_vars, [shard_output(x) for x in all_shard_vars]
+    )
+    if dry_run:
+        for shard_vars in all_shard_vars:
+            print(
+                "{}\t{}\t{}".format(
+                    shard_vars["OUTPUT_BUCKET"],
+                    shard_vars["SHARD"],
+                    shard_vars["DISK_SIZE"],
+                )
+            )
+        print("{}\t{}".format(gather_vars["OUTPUT_BUCKET"], "gather"))
+        return
+
+    args = scheduler_args(
+        job_vars, credentials, polling_interval, max_polling_interval
+    )
+    if not run_jobs(all_shard_vars, args):
+        logging.error("Variant calling failed in one or more shards")
+        sys.exit(4)
+    if not run_jobs([gather_vars], args):
+        logging.error("Merging the sharded variant calls failed")
+        sys.exit(4)
+    logging.warning("Operation succeeded")
@@ -6,66 +6,69 @@ r"""
 Runs the Sentieon Genomics Tools workflows using Google Pipelines API
 """
 
-import yaml
 import json
 import argparse
 import os
 import sys
 import copy
 import time
-import ssl
 import warnings
 import logging
 import random
-import google.auth
-import googleapiclient.errors
 
-from apiclient.discovery import build
 from pprint import pformat
-from googleapiclient.errors import HttpError
+from api_clients import DiscoveryCache, api_errors, build_service
+from autosize import AUTO, choose_resources, is_auto
+from polling import run_action_failed, wait_for_preemption
+from result_cache import cache_key, open_cache
+from storage_check import StorageStat, check_rules
+from timeline import attempt_timeline, report_timeline
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 germline_yaml = script_dir + "/germline.yaml"
 somatic_yaml = script_dir + "/somatic.yaml"
 ccdg_yaml = script_dir + "/ccdg.yaml"
+call_shard_yaml = script_dir + "/call_shard.yaml"
+call_gather_yaml = script_dir + "/call_gather.yaml"
+cohort_yaml = script_dir + "/cohort.yaml"
+pack_yaml = script_dir + "/pack.yaml"
+align_chunk_yaml = script_dir + "/align_chunk.yaml"
+bundle_reference_yaml = script_dir + "/bundle_reference.yaml"
 default_json = script_dir + "/runner_default.json"
+pipeline_yamls = {
+    "GERMLINE": germline_yaml,
+    "SOMATIC": somatic_yaml,
+    "CCDG": ccdg_yaml,
+    "CALL_SHARD": call_shard_yaml,
+    "CALL_GATHER": call_gather_yaml,
+    "COHORT": cohort_yaml,
+    "PACK": pack_yaml,
+    "ALIGN_CHUNK": align_chunk_yaml,
+    "BUNDLE_REFERENCE": bundle_reference_yaml,
+}
+pipeline_scripts = {
+    "GERMLINE": "/opt/sentieon/gc_germline.sh",
+    "SOMATIC": "/opt/sentieon/gc_somatic.sh",
+    "CCDG": "/opt/sentieon/gc_ccdg_germline.sh",
+    "CALL_SHARD": "/opt/sentieon/gc_call_shard.sh",
+    "CALL_GATHER": "/opt/sentieon/gc_call_gather.sh",
+    "COHORT": "/opt/sentieon/gc_joint.sh",
+    "PACK": "/opt/sentieon/gc_pack.sh",
+    "ALIGN_CHUNK": "/opt/sentieon/gc_align_chunk.sh",
+    "BUNDLE_REFERENCE": "/opt/sentieon/gc_bundle_reference.sh",
+}
+START_FROM_STAGES = ("DEDUP_BAM", "CALLING")
+EXECUTORS = ("LIFESCIENCES", "LOCAL", "DOCKER")
+api_versions = (("lifesciences", "v2beta"), ("compute", "v1"))
 target_url_base = (
     "https://www.googleapis.com/compute/v1/projects/{project}/"
     "zones/{zone}/instances/{instance}"
 )
 
 
-def cloud_storage_exists(client, gs_path, user_project=None):
-    try:
-        bucket, blob = gs_path[5:].split("/", 1)
-        bucket = client.bucket(bucket, user_project=user_project)
-        blob = bucket.blob(blob)
-        res = blob.exists()
-    except Exception as err:  # Catch all exceptions
-        print(
-            "Error polling file in Google Cloud Storage: " + str(err),
-            file=sys.stderr,
-        )
-        raise ValueError(
-            "Error: Could not find {gs_path} in Google Cloud "
-            "Storage".format(**locals())
-        )
-    return res
-
-
-def _check_inputs_exist(
-    job_vars, credentials, project=None, user_project=None
-):
-    from google.cloud import storage
-
-    with warnings.catch_warnings():
-        warnings.filterwarnings(
-            "ignore",
-            "Your application has authenticated "
-            "using end user credentials from Google Cloud "
-            "SDK",
-        )
-        client = storage.Client(project=project, credentials=credentials)
+def _input_rules(job_vars):
+    """Build (message, [alternative paths]) rules for the job inputs"""
+    rules = []
 
     # The DBSNP, BQSR and Realign sites files
     sites_files = []
@@ -78,28 +81,29 @@ def _check_inputs_exist(
         else []
     )
     sites_files += [job_vars["DBSNP"]] if job_vars["DBSNP"] else []
+    if job_vars["RECAL_TABLE"]:
+        rules.append(
+            (
+                "Could not find the supplied file {}".format(
+                    job_vars["RECAL_TABLE"]
+                ),
+                [job_vars["RECAL_TABLE"]],
+            )
+        )
     for sites_file in sites_files:
-        if not cloud_storage_exists(
-            client, sites_file, user_project=user_project
-        ):
-            logging.error("Could not find supplied file {}".format(sites_file))
-            sys.exit(-1)
-        if sites_file.endswith("vcf.gz"):
-            if not cloud_storage_exists(
-                client, sites_file + ".tbi", user_project=user_project
-            ):
-                logging.error(
-                    "Could not find index for file {}".format(sites_file)
-                )
-                sys.exit(-1)
-        else:
-            if not cloud_storage_exists(
-                client, sites_file + ".idx", user_project=user_project
-            ):
-                logging.error(
-                    "Could not find index for file {}".format(sites_file)
-                )
-                sys.exit(-1)
+        rules.append(
+            (
+                "Could not find supplied file {}".format(sites_file),
+                [sites_file],
+            )
+        )
+        idx = ".tbi" if sites_file.endswith("vcf.gz") else ".idx"
+        rules.append(
+            (
+                "Could not find index for file {}".format(sites_file),
+                [sites_file + idx],
+            )
+        )
 
     # The data input files
     gs_split_files = (
@@ -110,69 +114,84 @@ def _check_inputs_exist(
         job_vars["BAM"],
         job_vars["TUMOR_BAM"],
     )
-    gs_files = ()
     for split_file in gs_split_files:
         if not split_file:
             continue
         for input_file in split_file.split(","):
-            if not cloud_storage_exists(
-                client, input_file, user_project=user_project
-            ):
-                logging.error(
-                    "Could not find the supplied file {}".format(input_file)
+            rules.append(
+                (
+                    "Could not find the supplied file {}".format(input_file),
+                    [input_file],
                 )
-                sys.exit(-1)
-    for input_file in gs_files:
-        if not cloud_storage_exists(
-            client, input_file, user_project=user_project
-        ):
-            logging.error(
-                "Could not file the supplied file {}".format(input_file)
             )
-            sys.exit(-1)
 
     # All reference files
     ref = job_vars["REF"]
     ref_base = ref[:-3] if ref.endswith(".fa") else ref[:-6]
-    if not cloud_storage_exists(client, ref, user_project=user_project):
-        logging.error("Reference file not found")
-        sys.exit(-1)
-    if not cloud_storage_exists(
-        client, ref + ".fai", user_project=user_project
-    ):
-        logging.error("Reference fai index not found")
-        sys.exit(-1)
-    if not cloud_storage_exists(
-        client, ref + ".dict", user_project=user_project
-    ) and not cloud_storage_exists(
-        client, ref_base + ".dict", user_project=user_project
-    ):
-        logging.error("Reference dict index not found")
-        sys.exit(-1)
+    rules.append(("Reference file not found", [ref]))
+    rules.append(("Reference fai index not found", [ref + ".fai"]))
+    rules.append(
+        ("Reference dict index not found", [ref + ".dict", ref_base + ".dict"])
+    )
     # FQ specific
     if job_vars["FQ1"] or job_vars["TUMOR_FQ1"]:
         for suffix in [".amb", ".ann", ".bwt", ".pac", ".sa"]:
-            if not cloud_storage_exists(
-                client, ref + suffix, user_project=user_project
-            ) and not cloud_storage_exists(
-                client, ref + ".64" + suffix, user_project=user_project
-            ):
-                logging.error(
-                    "Reference BWA index {} not found".format(suffix)
+            rules.append(
+                (
+                    "Reference BWA index {} not found".format(suffix),
+                    [ref + suffix, ref + ".64" + suffix],
                 )
-                sys.exit(-1)
+            )
     # BAM specific
     bam_vars = ("BAM", "TUMOR_BAM")
     for bam_type in bam_vars:
         if job_vars[bam_type]:
             for bam in job_vars[bam_type].split(","):
-                if not cloud_storage_exists(
-                    client, bam + ".bai", user_project=user_project
-                ) and not cloud_storage_exists(
-                    client, bam + "bai", user_project=user_project
-                ):
-                    logging.error("BAM supplied but BAI not found")
-                    sys.exit(-1)
+                if bam.endswith(".cram"):
+                    rules.append(
+                        (
+                            "CRAM supplied but CRAI not found",
+                            [bam + ".crai", bam[:-5] + ".crai"],
+                        )
+                    )
+                    continue
+                bam_base = bam[:-4] if bam.endswith(".bam") else bam
+                rules.append(
+                    (
+                        "BAM supplied but BAI not found",
+                        [bam + ".bai", bam_base + ".bai"],
+                    )
+                )
+    return rules
+
+
+def _check_inputs_exist(
+    job_vars, credentials, project=None, user_project=None, client=None
+):
+    """Check that all job inputs exist in Google Cloud Storage
+
+    Returns a dict of {gs_path: {"size", "generation", "crc32c", "md5"}}
+    for every input file (and index) that was found.
+    """
+    if client is None:
+        from google.cloud import storage
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings(
+                "ignore",
+                "Your application has authenticated "
+                "using end user credentials from Google Cloud "
+                "SDK",
+            )
+            client = storage.Client(project=project, credentials=credentials)
+
+    stat = StorageStat(client, user_project=user_project)
+    missing = check_rules(stat, _input_rules(job_vars))
+    if missing:
+        for msg in missing:
+            logging.error(msg)
+        sys.exit(-1)
+    return stat.stats
 
 
 def parse_args(vargs=None):
@@ -193,13 +212,39 @@ def parse_args(vargs=None):
         "--polling_interval",
         type=float,
         default=30,
-        help="Seconds between polling the running operation",
+        help="Minimum seconds between polling the running operation",
+    )
+    parser.add_argument(
+        "--max_polling_interval",
+        type=float,
+        default=300,
+        help="Maximum seconds between polling the running operation. The "
+        "interval grows towards this value during long pipeline stages",
     )
     parser.add_argument(
         "--requester_project",
         default=None,
         help="A project to charge for local 'requester pays' requests",
     )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Validate the configuration and print the pipeline request "
+        "without running it",
+    )
+    parser.add_argument(
+        "--profile_startup",
+        "--profile-startup",
+        action="store_true",
+        help="Report the time taken by imports and API client construction "
+        "and exit",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run the pipeline even if the RESULT_CACHE holds the outputs "
+        "of an identical run",
+    )
     return parser.parse_args(vargs)
 
 
@@ -217,13 +262,8 @@ def setup_logging(verbosity=0):
     logging.basicConfig(level=log_level, format=log_format)
 
 
-def main(
-    pipeline_config,
-    polling_interval=30,
-    check_inputs_exist=True,
-    requester_project=None,
-):
-    # Grab input arguments from the json file
+def load_job_vars(pipeline_config):
+    """Merge a pipeline configuration with the runner defaults"""
     try:
         job_vars = json.load(open(default_json))
     except ValueError as e:
@@ -231,10 +271,16 @@ def main(
         raise e
     job_vars.update(pipeline_config)
 
-    preemptible_tries = int(job_vars["PREEMPTIBLE_TRIES"])
-    if job_vars["NONPREEMPTIBLE_TRY"]:
-        non_preemptible_tries = 1
-    preemptible = True if preemptible_tries > 0 else False
+    # Try not to create nearly empty directories
+    for key in ("OUTPUT_BUCKET", "REFERENCE_BUNDLE"):
+        if job_vars[key]:
+            job_vars[key] = job_vars[key].rstrip("/")
+    return job_vars
+
+
+def get_credentials():
+    import google.auth
+
     with warnings.catch_warnings():
         warnings.filterwarnings(
             "ignore",
@@ -243,7 +289,28 @@ def main(
             "SDK",
         )
         credentials, project_id = google.auth.default()
+    return credentials
+
+
+_pipeline_dicts = {}
 
+
+def load_pipeline_yaml(pipeline_yaml):
+    if pipeline_yaml not in _pipeline_dicts:
+        import yaml
+
+        try:
+            _pipeline_dicts[pipeline_yaml] = yaml.safe_load(
+                open(pipeline_yaml)
+            )
+        except IOError:
+            logging.error('No yaml "{}" found.'.format(pipeline_yaml))
+            sys.exit(-1)
+    return copy.deepcopy(_pipeline_dicts[pipeline_yaml])
+
+
+def check_job_vars(job_vars):
+    """Validate the job configuration, returning the pipeline yaml dict"""
     # Warn with depreciated JSON keys
     if "MIN_RAM_GB" in job_vars or "MIN_CPU" in job_vars:
         logging.warning(
@@ -254,33 +321,73 @@ def main(
 
     # Grab the yaml for the workflow
     pipeline = job_vars["PIPELINE"]
-    if pipeline == "GERMLINE":
-        pipeline_yaml = germline_yaml
-    elif pipeline == "SOMATIC":
-        pipeline_yaml = somatic_yaml
-    elif pipeline == "CCDG":
-        pipeline_yaml = ccdg_yaml
-    else:
+    if pipeline not in pipeline_yamls:
         logging.error(
             "Pipeline '" + pipeline + "'. Valid "
-            "values are 'GERMLINE' and 'SOMATIC'"
+            "values are 'GERMLINE', 'SOMATIC', 'CCDG' and 'COHORT'"
         )
         sys.exit(-1)
-    try:
-        pipeline_dict = yaml.safe_load(open(pipeline_yaml))
-    except IOError:
-        logging.error('No yaml "{}" found.'.format(pipeline_yaml))
-        sys.exit(-1)
-
-    # Try not to create nearly empty directories
-    while job_vars["OUTPUT_BUCKET"].endswith("/"):
-        job_vars["OUTPUT_BUCKET"] = job_vars["OUTPUT_BUCKET"][:-1]
+    pipeline_dict = load_pipeline_yaml(pipeline_yamls[pipeline])
 
     # Some basic error checking to fail early
     if not job_vars["PROJECT_ID"]:
         logging.error("Please supply a PROJECT_ID")
         sys.exit(-1)
-    project = job_vars["PROJECT_ID"]
+    if not job_vars["OUTPUT_BUCKET"]:
+        logging.error("Please supply an OUTPUT_BUCKET")
+        sys.exit(-1)
+    if job_vars["HEDGE_AFTER_PREEMPTIONS"] or job_vars["HEDGE_PERCENTILE"]:
+        if (
+            job_vars["EXECUTOR"] != "LIFESCIENCES"
+            or not int(job_vars["PREEMPTIBLE_TRIES"])
+            or not job_vars["NONPREEMPTIBLE_TRY"]
+        ):
+            logging.error(
+                "Hedged launches require 'PREEMPTIBLE_TRIES' and "
+                "'NONPREEMPTIBLE_TRY' on the Lifesciences executor"
+            )
+            sys.exit(-1)
+        if (
+            int(job_vars["CALLING_SHARDS"] or 1) > 1
+            or int(job_vars["ALIGNMENT_CHUNKS"] or 1) > 1
+        ):
+            logging.error(
+                "Hedged launches cannot be used with 'CALLING_SHARDS' or "
+                "'ALIGNMENT_CHUNKS'"
+            )
+            sys.exit(-1)
+        if job_vars["HEDGE_PERCENTILE"] and not job_vars["ZONE_HISTORY"]:
+            logging.error(
+                "'HEDGE_PERCENTILE' requires a 'ZONE_HISTORY' of earlier "
+                "runs"
+            )
+            sys.exit(-1)
+    zone_history = job_vars["ZONE_HISTORY"]
+    if zone_history and zone_history.startswith("gs://"):
+        logging.error("'ZONE_HISTORY' must be a local file")
+        sys.exit(-1)
+    if job_vars["EXECUTOR"] not in EXECUTORS:
+        logging.error("'EXECUTOR' must be one of " + str(EXECUTORS))
+        sys.exit(-1)
+    if job_vars["EXECUTOR"] == "LIFESCIENCES" and not job_vars["ZONES"]:
+        logging.error("Please supply at least one zone to run the pipeline")
+        sys.exit(-1)
+    if (
+        job_vars["EXECUTOR"] != "LIFESCIENCES"
+        and not job_vars["LOCAL_WORK_DIR"]
+    ):
+        logging.error(
+            "Please supply a 'LOCAL_WORK_DIR' to run the pipeline on this "
+            "host"
+        )
+        sys.exit(-1)
+
+    bundle = job_vars["REFERENCE_BUNDLE"]
+    if bundle and not bundle.startswith("gs://"):
+        logging.error(
+            "'REFERENCE_BUNDLE' must be a Google Cloud Storage directory"
+        )
+        sys.exit(-1)
 
     # Shared errors
     if job_vars["FQ1"] and job_vars["BAM"]:
@@ -311,12 +418,54 @@ def main(
         ):
             logging.error("No output files requested")
             sys.exit(-1)
-        if job_vars["RECALIBRATED_OUTPUT"] and job_vars["BQSR_SITES"] is None:
+        if (
+            job_vars["RECALIBRATED_OUTPUT"]
+            and job_vars["BQSR_SITES"] is None
+            and not job_vars["RECAL_TABLE"]
+        ):
             logging.error(
                 "Cannot output a recalibrated BAM file without "
                 "running BQSR. Please supply 'BQSR_SITES'"
             )
             sys.exit(-1)
+        # Starting from the outputs of an earlier run
+        start_from = job_vars["START_FROM"]
+        if start_from:
+            if start_from not in START_FROM_STAGES:
+                logging.error(
+                    "'START_FROM' must be one of " + str(START_FROM_STAGES)
+                )
+                sys.exit(-1)
+            if pipeline != "GERMLINE":
+                logging.error(
+                    "'START_FROM' is only supported by the GERMLINE pipeline"
+                )
+                sys.exit(-1)
+            if not job_vars["BAM"]:
+                logging.error(
+                    "'START_FROM' requires the deduplicated 'BAM' of an "
+                    "earlier run, such as the one in its 'aligned_reads/'"
+                )
+                sys.exit(-1)
+            if start_from == "CALLING" and job_vars["NO_HAPLOTYPER"]:
+                logging.error("No output files requested")
+                sys.exit(-1)
+            if (
+                start_from == "CALLING"
+                and job_vars["BQSR_SITES"]
+                and not job_vars["RECAL_TABLE"]
+            ):
+                logging.warning(
+                    "Calling from an earlier run ignores 'BQSR_SITES'. "
+                    "Supply its 'RECAL_TABLE' to apply base recalibration"
+                )
+        elif job_vars["RECAL_TABLE"] and int(
+            job_vars["CALLING_SHARDS"] or 1
+        ) <= 1:
+            logging.error(
+                "'RECAL_TABLE' requires 'START_FROM' or 'CALLING_SHARDS'"
+            )
+            sys.exit(-1)
         valid_algos = ("Haplotyper", "DNAscope")
         if job_vars["CALLING_ALGO"] not in valid_algos:
             logging.error(
@@ -325,6 +474,34 @@ def main(
                 "'CALLING_ALGO' to one of " + str(valid_algos)
             )
             sys.exit(-1)
+        # Sharded variant calling checks
+        if int(job_vars["CALLING_SHARDS"] or 1) > 1:
+            if pipeline != "GERMLINE" or not job_vars["BAM"]:
+                logging.error(
+                    "Sharded variant calling requires the GERMLINE pipeline "
+                    "and a preprocessed 'BAM'"
+                )
+                sys.exit(-1)
+            if job_vars["NO_HAPLOTYPER"]:
+                logging.error("Sharded variant calling requires a VCF output")
+                sys.exit(-1)
+            if job_vars["BQSR_SITES"] and not job_vars["RECAL_TABLE"]:
+                logging.warning(
+                    "Sharded variant calling ignores 'BQSR_SITES'. Supply "
+                    "a 'RECAL_TABLE' to apply base recalibration"
+                )
+        # Chunked alignment checks
+        if int(job_vars["ALIGNMENT_CHUNKS"] or 1) > 1:
+            if not job_vars["FQ1"]:
+                logging.error("Chunked alignment requires 'FQ1' inputs")
+                sys.exit(-1)
+            if int(job_vars["CALLING_SHARDS"] or 1) > 1:
+                logging.error(
+                    "'ALIGNMENT_CHUNKS' and 'CALLING_SHARDS' cannot be "
+                    "used together. Please run sharded variant calling "
+                    "on the deduplicated BAM output"
+                )
+                sys.exit(-1)
         # Additional CCDG checks
         if pipeline == "CCDG":
             if job_vars["BQSR_SITES"] is None:
@@ -333,6 +510,59 @@ def main(
                     "BQSR. Please supply 'BQSR_SITES'"
                 )
                 sys.exit(-1)
+    elif pipeline == "CALL_SHARD" or pipeline == "CALL_GATHER":
+        if pipeline == "CALL_SHARD" and not (
+            job_vars["BAM"] and job_vars["SHARD"]
+        ):
+            logging.error("Please supply a 'BAM' and a 'SHARD'")
+            sys.exit(-1)
+        if pipeline == "CALL_GATHER" and not job_vars["SHARD_OUTPUTS"]:
+            logging.error("Please supply the 'SHARD_OUTPUTS' to merge")
+            sys.exit(-1)
+        valid_algos = ("Haplotyper", "DNAscope")
+        if job_vars["CALLING_ALGO"] not in valid_algos:
+            logging.error(
+                job_vars["CALLING_ALGO"] + "' is not a "
+                "valid germline variant calling algo. Please set "
+                "'CALLING_ALGO' to one of " + str(valid_algos)
+            )
+            sys.exit(-1)
+    elif pipeline == "COHORT":
+        if not (
+            job_vars["GVCFS"]
+            or job_vars["GVCF_MANIFEST"]
+            or job_vars["SHARD_OUTPUTS"]
+        ):
+            logging.error(
+                "Please supply the 'GVCFS' or a 'GVCF_MANIFEST' to genotype"
+            )
+            sys.exit(-1)
+        if job_vars["GVCFS"] and job_vars["GVCF_MANIFEST"]:
+            logging.error(
+                "Please supply either 'GVCFS' or 'GVCF_MANIFEST' (not both)"
+            )
+            sys.exit(-1)
+        if job_vars["HEDGE_AFTER_PREEMPTIONS"] or job_vars["HEDGE_PERCENTILE"]:
+            logging.error("Hedged launches cannot be used with 'COHORT'")
+            sys.exit(-1)
+    elif pipeline == "PACK":
+        if not job_vars["PACK_JOBS"] or not job_vars["PACK_PIPELINE"]:
+            logging.error("Please supply the 'PACK_JOBS' to run")
+            sys.exit(-1)
+    elif pipeline == "ALIGN_CHUNK":
+        if not job_vars["FQ1"]:
+            logging.error("Please supply the 'FQ1' to align")
+            sys.exit(-1)
+        if job_vars["CHUNK_PIPELINE"] not in ("GERMLINE", "CCDG"):
+            logging.error("'CHUNK_PIPELINE' must be 'GERMLINE' or 'CCDG'")
+            sys.exit(-1)
+    elif pipeline == "BUNDLE_REFERENCE":
+        if not job_vars["REFERENCE_BUNDLE"] or not job_vars["BUNDLE_FILES"]:
+            logging.error(
+                "Please supply the 'REFERENCE_BUNDLE' and the "
+                "'BUNDLE_FILES' to pack"
+            )
+            sys.exit(-1)
     elif pipeline == "SOMATIC":
         if job_vars["TUMOR_FQ1"] and job_vars["TUMOR_BAM"]:
             logging.error(
@@ -372,19 +602,36 @@ def main(
                 "'CALLING_ALGO' to one of " + str(valid_algos)
             )
             sys.exit(-1)
-    if check_inputs_exist:
-        _check_inputs_exist(
-            job_vars,
-            credentials,
-            project=project,
-            user_project=requester_project,
-        )
+    return pipeline_dict
+
+
+def apply_auto_sizing(job_vars, input_stats):
+    """Replace an AUTO MACHINE_TYPE or DISK_SIZE using the input sizes
 
+    Returns the reasons for the chosen values. Raises ValueError if the
+    job cannot be sized.
+    """
+    chosen, reasons = choose_resources(
+        job_vars, input_stats, job_vars["SIZING_TABLE"]
+    )
+    job_vars.update(chosen)
+    return reasons
+
+
+def pipeline_environment(job_vars, pipeline_dict):
+    """The environment variables of the pipeline script"""
+    env_dict = {}
+    for input_var in pipeline_dict["inputParameters"]:
+        env_dict[input_var["name"]] = job_vars[input_var["name"]]
+        if env_dict[input_var["name"]] is None:
+            env_dict[input_var["name"]] = "None"
+    return env_dict
+
+
+def build_pipeline_body(job_vars, pipeline_dict):
+    """Build the Lifesciences pipelines.run request body for a job"""
     # Resources dict
-    zones = job_vars["ZONES"].split(",") if job_vars["ZONES"] else []
-    if not zones:
-        logging.error("Please supply at least one zone to run the pipeline")
-    region = zones[0][:-2]
+    zones = job_vars["ZONES"].split(",")
     disk = {
         "name": "local-disk",
         "type": "local-ssd",
@@ -392,7 +639,7 @@ def main(
     }
     vm_dict = {
         "machineType": job_vars["MACHINE_TYPE"],
-        "preemptible": preemptible,
+        "preemptible": int(job_vars["PREEMPTIBLE_TRIES"]) > 0,
         "disks": [disk],
         "serviceAccount": {
             "scopes": ["https://www.googleapis.com/auth/cloud-platform"]
@@ -401,24 +648,8 @@ def main(
     }
     resources_dict = {"zones": zones, "virtualMachine": vm_dict}
 
-    # Environment
-    env_dict = {}
-    for input_var in pipeline_dict["inputParameters"]:
-        env_dict[input_var["name"]] = job_vars[input_var["name"]]
-        if env_dict[input_var["name"]] is None:
-            env_dict[input_var["name"]] = "None"
-
     # Action
-    if pipeline == "GERMLINE":
-        _cmd = "/opt/sentieon/gc_germline.sh"
-    elif pipeline == "SOMATIC":
-        _cmd = "/opt/sentieon/gc_somatic.sh"
-    elif pipeline == "CCDG":
-        _cmd = "/opt/sentieon/gc_ccdg_germline.sh"
-    else:
-        logging.error("Error: Unknown pipeline " + pipeline)
-        sys.exit(-1)
-
+    _cmd = pipeline_scripts[job_vars["PIPELINE"]]
     run_action = {
         "containerName": "run-pipeline",
         "imageUri": job_vars["DOCKER_IMAGE"],
@@ -449,16 +680,125 @@ def main(
         "alwaysRun": True,
     }
 
-    # Build the API services
-    service = build("lifesciences", "v2beta", credentials=credentials)
-    compute_service = build("compute", "v1", credentials=credentials)
+    return {
+        "pipeline": {
+            "actions": [run_action, cleanup_action],
+            "resources": resources_dict,
+            "environment": pipeline_environment(job_vars, pipeline_dict),
+        }
+    }
+
+
+def set_preemptible(body, preemptible):
+    body["pipeline"]["resources"]["virtualMachine"]["preemptible"] = (
+        preemptible
+    )
+
+
+class Attempts(object):
+    """The remaining preemptible and standard attempts of a job"""
+
+    def __init__(self, preemptible_tries=0, nonpreemptible_try=True):
+        self.preemptible_tries = int(preemptible_tries)
+        self.nonpreemptible_tries = 1 if nonpreemptible_try else 0
+
+    @classmethod
+    def from_job_vars(cls, job_vars):
+        return cls(
+            job_vars["PREEMPTIBLE_TRIES"], job_vars["NONPREEMPTIBLE_TRY"]
+        )
+
+    def remaining(self):
+        return self.preemptible_tries + self.nonpreemptible_tries
+
+    def take(self):
+        """Use up an attempt, returning whether it is preemptible"""
+        if self.preemptible_tries > 0:
+            self.preemptible_tries -= 1
+            return True
+        if self.nonpreemptible_tries > 0:
+            self.nonpreemptible_tries -= 1
+            return False
+        raise ValueError("No attempts remaining")
 
-    # Check the PIPELINE_REGION
+    def single(self):
+        """One standard attempt, for jobs that cannot be preempted"""
+        return Attempts(0, self.remaining() > 0)
+
+    def take_nonpreemptible(self):
+        """Use up a standard attempt, leaving the preemptible ones"""
+        if self.nonpreemptible_tries <= 0:
+            raise ValueError("No standard attempts remaining")
+        self.nonpreemptible_tries -= 1
+        return False
+
+    def to_dict(self):
+        return {
+            "preemptible_tries": self.preemptible_tries,
+            "nonpreemptible_tries": self.nonpreemptible_tries,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        attempts = cls()
+        attempts.preemptible_tries = d["preemptible_tries"]
+        attempts.nonpreemptible_tries = d["nonpreemptible_tries"]
+        return attempts
+
+
+def build_services(credentials, cache=None):
+    cache = cache or DiscoveryCache()
+    return tuple(
+        build_service(api, version, credentials, cache=cache)
+        for api, version in api_versions
+    )
+
+
+def profile_startup():
+    """Report the time taken by imports and API client construction"""
+    timings = []
+
+    def timed(label, fn):
+        start = time.time()
+        result = fn()
+        timings.append((label, time.time() - start))
+        return result
+
+    for module in (
+        "yaml",
+        "google.auth",
+        "googleapiclient.discovery",
+        "google.cloud.storage",
+    ):
+        timed("import " + module, lambda: __import__(module))
+    credentials = timed("credentials", get_credentials)
+    cache = DiscoveryCache()
+    for api, version in api_versions:
+        document, fresh = cache.load(api, version)
+        label = "{} {} ({} discovery cache)".format(
+            api, version, "fresh" if fresh else "stale or empty"
+        )
+        timed(
+            "build " + label,
+            lambda: build_service(api, version, credentials, cache=cache),
+        )
+    for api, version in api_versions:
+        timed(
+            "build {} {} (warm discovery cache)".format(api, version),
+            lambda: build_service(api, version, credentials, cache=cache),
+        )
+    for label, seconds in timings:
+        print("{:<60}{:>8.3f}s".format(label, seconds))
+    print("{:<60}{:>8.3f}s".format("total", sum(x[1] for x in timings)))
+
+
+def get_service_parent(service, project, pipeline_region):
+    """Check the PIPELINE_REGION, returning the service parent"""
     name = "projects/" + project
     locations = service.projects().locations().list(name=name).execute()
     service_parent = []
     for _loc in locations.get("locations", []):
-        if _loc["locationId"] == job_vars["PIPELINE_REGION"]:
+        if _loc["locationId"] == pipeline_region:
             service_parent.append(_loc["name"])
     if len(service_parent) != 1:
         possible_regions = ", ".join(
@@ -466,187 +806,346 @@ def main(
         )
         logging.error(
             "Unknown PIPELINE_REGION '{}'. Please choose from: "
-            "{}".format(job_vars["PIPELINE_REGION"], possible_regions)
+            "{}".format(pipeline_region, possible_regions)
         )
         sys.exit(-1)
-    service_parent = service_parent[0]
+    return service_parent[0]
 
-    # Run the pipeline
+
+def launch_operation(service, service_parent, body, sleep=time.sleep):
+    """Run the pipeline, returning the operation or None on failure"""
+    logging.debug("Running pipeline:")
+    logging.debug(pformat(body, indent=2))
+    sys.stderr.flush()
     operation = None
-    counter = 0
-    while non_preemptible_tries > 0 or preemptible_tries > 0:
-        if operation:
-            while not operation.get("done", False):
-                new_op, tries = None, 0
-                while tries <= 5:
-                    time.sleep(polling_interval)
-                    try:
-                        ops = service.projects().locations().operations()
-                        new_op = ops.get(name=operation["name"]).execute()
-                        break
-                    except googleapiclient.errors.HttpError as e:
-                        logging.warning(str(e))
-                        tries += 1
-                    except ssl.SSLError as e:
-                        logging.warning(str(e))
-                        tries += 1
-                if not new_op:
-                    logging.error(
-                        "Network error while polling running operation."
-                    )
-                    sys.exit(1)
-                operation = new_op
-            logging.debug(pformat(operation, indent=2))
-            if "error" in operation:
-                assigned_events = list(
-                    filter(
-                        lambda x: "workerAssigned" in x.keys(),
-                        operation["metadata"]["events"],
-                    )
-                )
-                if not assigned_events:
-                    logging.error("Genomics operation failed before running:")
-                    logging.error(pformat(operation["error"], indent=2))
-                    sys.exit(2)
-
-                startup_event = assigned_events[-1]
-                instance = startup_event["workerAssigned"]["instance"]
-                zone = startup_event["workerAssigned"]["zone"]
-                url = target_url_base.format(**locals())
-                time.sleep(300)  # It may take some time to set the operation
-                compute_ops = (
-                    compute_service.zoneOperations()
-                    .list(
-                        project=project,
-                        zone=zone,
-                        filter=(
-                            "(targetLink eq {url}) (operationType eq "
-                            "compute.instances.preempted)"
-                        ).format(**locals()),
-                    )
-                    .execute()
-                )
-                if "items" in compute_ops and any(
-                    [
-                        (x["operationType"] == "compute.instances.preempted")
-                        for x in compute_ops["items"]
-                    ]
-                ):
-                    logging.warning(
-                        "Run {} failed. " "Retrying...".format(counter)
-                    )
-                else:
-                    logging.error(
-                        "Run {} failed, but not due to preemption. "
-                        "Exit".format(counter)
-                    )
-                    operation = None
-                    break
-            else:
-                break
+    backoff, backoff_interval = 0, 1
+    while backoff < 6:
+        sleep(backoff_interval * random.random() * (2 ** backoff - 1))
+        try:
+            op_pipelines = service.projects().locations().pipelines()
+            request = op_pipelines.run(parent=service_parent, body=body)
+            operation = request.execute()
+            break
+        except api_errors() as e:
+            logging.warning(str(e))
+            backoff += 1
+    if operation:
+        logging.debug(pformat(operation, indent=2))
+    return operation
 
-        if preemptible_tries > 0:
-            vm_dict["preemptible"] = True
-            preemptible_tries -= 1
-        else:
-            vm_dict["preemptible"] = False
-            non_preemptible_tries -= 1
-
-        logging.debug("Running pipeline:")
-        body = {
-            "pipeline": {
-                "actions": [run_action, cleanup_action],
-                "resources": resources_dict,
-                "environment": env_dict,
-            }
-        }
 
-        logging.debug(pformat(body, indent=2))
-        sys.stderr.flush()
-        backoff, backoff_interval = 0, 1
-        while backoff < 6:
-            time.sleep(backoff_interval * random.random() * (2 ** backoff - 1))
-            try:
-                op_pipelines = service.projects().locations().pipelines()
-                request = op_pipelines.run(parent=service_parent, body=body)
-                operation = request.execute()
-                break
-            except googleapiclient.errors.HttpError as e:
-                logging.warning(str(e))
-                backoff += 1
-        if not operation:
-            logging.error("Failed to launch job")
-            sys.exit(3)
+def assigned_worker(operation):
+    """The (instance, zone) of the last worker assigned to an operation"""
+    assigned_events = [
+        x
+        for x in operation.get("metadata", {}).get("events", [])
+        if "workerAssigned" in x
+    ]
+    if not assigned_events:
+        return None
+    startup_event = assigned_events[-1]
+    return (
+        startup_event["workerAssigned"]["instance"],
+        startup_event["workerAssigned"]["zone"],
+    )
+
+
+def was_preempted(compute_service, project, instance, zone):
+    url = target_url_base.format(**locals())
+    compute_ops = (
+        compute_service.zoneOperations()
+        .list(
+            project=project,
+            zone=zone,
+            filter=(
+                "(targetLink eq {url}) (operationType eq "
+                "compute.instances.preempted)"
+            ).format(**locals()),
+        )
+        .execute()
+    )
+    return "items" in compute_ops and any(
+        [
+            (x["operationType"] == "compute.instances.preempted")
+            for x in compute_ops["items"]
+        ]
+    )
+
+
+def main(
+    pipeline_config,
+    polling_interval=30,
+    check_inputs_exist=True,
+    requester_project=None,
+    max_polling_interval=300,
+    dry_run=False,
+    force=False,
+):
+    # Grab input arguments from the json file
+    job_vars = load_job_vars(pipeline_config)
+    pipeline_dict = check_job_vars(job_vars)
+    project = job_vars["PROJECT_ID"]
+    attempts = Attempts.from_job_vars(job_vars)
+    if not attempts.remaining():
+        logging.error(
+            "No attempts requested. Please set 'PREEMPTIBLE_TRIES' or "
+            "'NONPREEMPTIBLE_TRY'"
+        )
+        sys.exit(-1)
+    cohort = job_vars["PIPELINE"] == "COHORT"
+    sharded = not cohort and int(job_vars["CALLING_SHARDS"] or 1) > 1
+    chunked = int(job_vars["ALIGNMENT_CHUNKS"] or 1) > 1
+    credentials = None
+    if (
+        check_inputs_exist
+        or sharded
+        or cohort
+        or job_vars["REFERENCE_BUNDLE"]
+        or not dry_run
+    ):
+        credentials = get_credentials()
+
+    input_stats = {}
+    if check_inputs_exist:
+        input_stats = _check_inputs_exist(
+            job_vars,
+            credentials,
+            project=project,
+            user_project=requester_project,
+        )
+        logging.info(
+            "Found {} input files totaling {} bytes".format(
+                len(input_stats),
+                sum(x["size"] or 0 for x in input_stats.values()),
+            )
+        )
+
+    if cohort:
+        import joint_calling
+
+        gvcfs, gvcf_stats = joint_calling.resolve_gvcfs(
+            job_vars, credentials, user_project=requester_project
+        )
+        input_stats.update(gvcf_stats)
+
+    # Shards are sized from the share of the inputs they read
+    shard_stats = input_stats if job_vars["DISK_SIZE"] == AUTO else None
+    if is_auto(job_vars):
+        if not check_inputs_exist:
+            logging.error(
+                "'AUTO' machine and disk sizes are chosen from the sizes of "
+                "the input files, which are not checked"
+            )
+            sys.exit(-1)
+        try:
+            for reason in apply_auto_sizing(job_vars, input_stats):
+                logging.warning("Chose " + reason)
+        except ValueError as err:
+            logging.error(str(err))
+            sys.exit(-1)
+
+    # Only the objects written after this are recorded as outputs
+    cache, key, started = None, None, time.time()
+    if job_vars["RESULT_CACHE"] and not dry_run:
+        if not check_inputs_exist:
+            logging.error(
+                "The 'RESULT_CACHE' key includes the versions of the input "
+                "files, which are not checked"
+            )
+            sys.exit(-1)
+        cache = open_cache(job_vars, credentials, requester_project)
+        key = cache_key(job_vars, input_stats)
+        if force:
+            logging.warning("Ignoring the result cache")
         else:
+            cached = cache.restore(key, job_vars["OUTPUT_BUCKET"])
+            if cached:
+                logging.warning(
+                    "Reused the outputs of an identical run in " + cached
+                )
+                return
+
+    if job_vars["REFERENCE_BUNDLE"]:
+        import reference_bundle
+
+        if not reference_bundle.ensure_reference_bundle(
+            [job_vars],
+            credentials,
+            user_project=requester_project,
+            polling_interval=polling_interval,
+            max_polling_interval=max_polling_interval,
+            dry_run=dry_run,
+        ):
+            job_vars["REFERENCE_BUNDLE"] = None
+
+    if job_vars["ARTIFACT_CACHE"] and not dry_run:
+        import artifact_cache
+
+        artifact_cache.ensure_artifacts(
+            [job_vars], credentials, user_project=requester_project
+        )
+
+    if chunked:
+        import align_chunks
+
+        job_vars = align_chunks.run_chunked_alignment(
+            job_vars,
+            credentials,
+            input_stats,
+            polling_interval=polling_interval,
+            max_polling_interval=max_polling_interval,
+            dry_run=dry_run,
+        )
+        pipeline_dict = check_job_vars(job_vars)
+
+    if cohort:
+        joint_calling.run_joint_calling(
+            job_vars,
+            gvcfs,
+            credentials,
+            user_project=requester_project,
+            polling_interval=polling_interval,
+            max_polling_interval=max_polling_interval,
+            dry_run=dry_run,
+        )
+        if cache:
+            cache.record(key, job_vars["OUTPUT_BUCKET"], started)
+        return
+
+    if sharded:
+        import scatter_gather
+
+        scatter_gather.run_sharded_calling(
+            job_vars,
+            credentials,
+            user_project=requester_project,
+            polling_interval=polling_interval,
+            max_polling_interval=max_polling_interval,
+            dry_run=dry_run,
+            input_stats=shard_stats,
+        )
+        if cache:
+            cache.record(key, job_vars["OUTPUT_BUCKET"], started)
+        return
+
+    import executors
+
+    if dry_run:
+        body = executors.describe(job_vars, pipeline_dict, attempts.take())
+        print(json.dumps(body, indent=2, sort_keys=True))
+        return
+
+    # Run the pipeline
+    executor = executors.make_executor(
+        job_vars,
+        credentials,
+        polling_interval=polling_interval,
+        max_polling_interval=max_polling_interval,
+    )
+    if not executor.can_preempt:
+        attempts = attempts.single()
+    counter = 0
+    timelines = []
+    try:
+        if job_vars["HEDGE_AFTER_PREEMPTIONS"] or job_vars["HEDGE_PERCENTILE"]:
+            import hedging
+
+            if hedging.run_hedged(
+                executor,
+                job_vars,
+                pipeline_dict,
+                attempts,
+                timelines,
+                hedging.storage_client(job_vars, credentials),
+                user_project=requester_project,
+            ):
+                logging.warning("Operation succeeded")
+                if cache:
+                    cache.record(key, job_vars["OUTPUT_BUCKET"], started)
+            else:
+                logging.error("All attempts failed.")
+            return
+        while attempts.remaining() > 0:
+            operation = executor.submit(
+                job_vars, pipeline_dict, attempts.take()
+            )
+            if not operation:
+                logging.error("Failed to launch job")
+                sys.exit(3)
             logging.warning("Launched job: " + operation["name"])
-        counter += 1
-        logging.debug(pformat(operation, indent=2))
+            counter += 1
 
-    if operation:
-        while not operation.get("done", False):
-            new_op, tries = None, 0
-            while tries <= 5:
-                time.sleep(polling_interval)
-                try:
-                    new_op = (
-                        service.projects()
-                        .locations()
-                        .operations()
-                        .get(name=operation["name"])
-                        .execute()
-                    )
-                    break
-                except googleapiclient.errors.HttpError as e:
-                    logging.warning(str(e))
-                    tries += 1
-                except ssl.SSLError:
-                    logging.warning(str(e))
-                    tries += 1
-            if not new_op:
-                logging.error(
-                    "Network error while waiting for the final "
-                    "operation to finish"
-                )
+            operation = executor.wait(operation)
+            if not operation:
+                logging.error("Network error while polling running operation.")
                 sys.exit(1)
-            operation = new_op
-        logging.debug(pformat(operation, indent=2))
-        if "error" in operation:
-            assigned_events = list(
-                filter(
-                    lambda x: "workerAssigned" in x.keys(),
-                    operation["metadata"]["events"],
-                )
-            )
-            if not assigned_events:
+            logging.debug(pformat(operation, indent=2))
+            timelines.append(attempt_timeline(operation))
+            if "error" not in operation:
+                executor.record(operation, False)
+                logging.warning("Operation succeeded")
+                if cache:
+                    cache.record(key, job_vars["OUTPUT_BUCKET"], started)
+                return
+            worker = executor.worker(operation)
+            if not worker:
                 logging.error("Genomics operation failed before running:")
                 logging.error(pformat(operation["error"], indent=2))
                 sys.exit(2)
+            if not attempts.remaining():
+                logging.error("Final run failed.")
+                return
 
-            startup_event = assigned_events[-1]
-            instance = startup_event["workerAssigned"]["instance"]
-            zone = startup_event["workerAssigned"]["zone"]
-            url = target_url_base.format(**locals())
-            compute_ops = (
-                compute_service.zoneOperations()
-                .list(
-                    project=project,
-                    zone=zone,
-                    filter=(
-                        "(targetLink eq {url}) (operationType eq "
-                        "compute.instances.preempted)"
-                    ).format(**locals()),
+            # It may take some time for the preemption record to appear
+            preempted = False
+            if executor.can_preempt and not run_action_failed(operation):
+                preempted = wait_for_preemption(
+                    lambda: executor.was_preempted(job_vars, worker)
                 )
-                .execute()
-            )
-            logging.error("Final run failed.")
-        else:
-            logging.warning("Operation succeeded")
+            executor.record(operation, preempted)
+            if preempted:
+                timelines[-1]["preempted"] = True
+                logging.warning(
+                    "Run {} failed. " "Retrying...".format(counter)
+                )
+            else:
+                logging.error(
+                    "Run {} failed, but not due to preemption. "
+                    "Exit".format(counter)
+                )
+                return
+    finally:
+        executor.close()
+        report_timeline(timelines, job_vars, credentials, requester_project)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        import batch_scheduler
+
+        args = batch_scheduler.parse_args(sys.argv[2:])
+        setup_logging(args.verbose)
+        sys.exit(batch_scheduler.main(args))
+    if len(sys.argv) > 1 and sys.argv[1] == "stats":
+        import stage_stats
+
+        args = stage_stats.parse_args(sys.argv[2:])
+        setup_logging(args.verbose)
+        sys.exit(stage_stats.main(args))
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        import benchmark
+
+        args = benchmark.parse_args(sys.argv[2:])
+        setup_logging(args.verbose)
+        sys.exit(benchmark.main(args))
+
     args = parse_args()
     setup_logging(args.verbose)
 
+    if args.profile_startup:
+        profile_startup()
+        sys.exit(0)
+
     if not args.pipeline_config:
         logging.error("Please supply an input pipeline_config JSON")
         sys.exit(-1)
@@ -661,4 +1160,7 @@ if __name__ == "__main__":
         polling_interval=args.polling_interval,
         check_inputs_exist=not args.no_check_inputs_exist,
         requester_project=args.requester_project,
+        max_polling_interval=args.max_polling_interval,
+        dry_run=args.dry_run,
+        force=args.force,
     )
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Split a reference genome into shards of balanced length
+"""
+
+import re
+
+# Matches the contigs excluded by generate_nondecoy_bed in gc_functions.sh
+DECOY_PATTERN = re.compile("hs37d5|chrEBV|hs38d1|decoy")
+
+
+def parse_fai(fai_text):
+    """Parse a FASTA index into a list of (contig, length)"""
+    contigs = []
+    for line in fai_text.splitlines():
+        if not line.strip():
+            continue
+        fields = line.split("\t")
+        contigs.append((fields[0], int(fields[1])))
+    return contigs
+
+
+def nondecoy_contigs(contigs):
+    return [
+        (name, length)
+        for name, length in contigs
+        if not DECOY_PATTERN.search(name)
+    ]
+
+
+def balanced_shards(contigs, n_shards):
+    """Split contigs into at most `n_shards` shards of near-equal length
+
+    Contigs are kept in reference order and split across shard boundaries
+    where needed. Each shard is a list of (contig, start, end) half-open,
+    0-based intervals.
+    """
+    total = sum(length for _, length in contigs)
+    if total == 0 or n_shards < 1:
+        return []
+    target = -(-total // n_shards)
+    shards = [[]]
+    filled = 0
+    for name, length in contigs:
+        start = 0
+        while start < length:
+            if filled >= target and len(shards) < n_shards:
+                shards.append([])
+                filled = 0
+            take = length - start
+            if len(shards) < n_shards:
+                take = min(take, target - filled)
+            shards[-1].append((name, start, start + take))
+            filled += take
+            start += take
+    return [shard for shard in shards if shard]
+
+
+def shard_regions(shard):
+    """Format a shard as Sentieon 1-based, inclusive regions"""
+    return [
+        "{}:{}-{}".format(name, start + 1, end) for name, start, end in shard
+    ]
+
+
+def shard_length(shard):
+    return sum(end - start for _, start, end in shard)
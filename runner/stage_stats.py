@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Summarize the stage records of many pipeline runs
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+
+from storage_check import split_gs_path
+
+STAGE_LOG = "stages.jsonl"
+METRICS = (
+    ("wall_s", "wall_s", 1),
+    ("cpu_s", None, 1),
+    ("max_rss_gb", "max_rss_kb", 1024.0 ** 2),
+    ("read_gb", "read_bytes", 1e9),
+    ("write_gb", "write_bytes", 1e9),
+)
+
+
+def parse_args(vargs=None):
+    parser = argparse.ArgumentParser(
+        prog="sentieon_runner.py stats",
+        description="Print percentiles of the timing and resource usage of "
+        "each pipeline stage across many runs",
+    )
+    parser.add_argument(
+        "location",
+        help="A gs:// prefix or local directory searched for "
+        "{} stage logs".format(STAGE_LOG),
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="count", help="Increase the runner verbosity"
+    )
+    parser.add_argument(
+        "--percentiles",
+        default="50,90,99",
+        help="A comma-separated list of percentiles to report",
+    )
+    parser.add_argument(
+        "--project", default=None, help="The project used to list the bucket"
+    )
+    parser.add_argument(
+        "--requester_project",
+        default=None,
+        help="A project to charge for local 'requester pays' requests",
+    )
+    return parser.parse_args(vargs)
+
+
+def parse_records(text, source=None):
+    records = []
+    for i, line in enumerate(text.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            logging.warning(
+                "Skipping an invalid record at {}:{}".format(source, i + 1)
+            )
+    return records
+
+
+def load_local(path):
+    records = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.endswith(STAGE_LOG):
+                log_path = os.path.join(root, name)
+                with open(log_path) as f:
+                    records.extend(parse_records(f.read(), log_path))
+    return records
+
+
+def load_gs(prefix, project=None, user_project=None):
+    import sentieon_runner as runner
+    from google.cloud import storage
+
+    client = storage.Client(
+        project=project, credentials=runner.get_credentials()
+    )
+    bucket_name, name = split_gs_path(prefix)
+    bucket = client.bucket(bucket_name, user_project=user_project)
+    records = []
+    for blob in bucket.list_blobs(prefix=name):
+        if blob.name.endswith(STAGE_LOG):
+            text = blob.download_as_string().decode("utf-8")
+            source = "gs://{}/{}".format(bucket_name, blob.name)
+            records.extend(parse_records(text, source))
+    return records
+
+
+def stage_key(stage):
+    """Group stage names that differ only in file paths and counts"""
+    words = []
+    for word in stage.split():
+        if "/" in word:
+            break
+        words.append(re.sub("[0-9]+", "N", word))
+    return " ".join(words) or stage
+
+
+def percentile(values, q):
+    """The q-th percentile of values, interpolating between ranks"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def metric_value(record, metric):
+    name, key, scale = metric
+    if name == "cpu_s":
+        return (record.get("user_s") or 0) + (record.get("sys_s") or 0)
+    return (record.get(key) or 0) / scale
+
+
+def summarize(records, percentiles):
+    """Percentiles of each metric per stage, ordered by total wall time
+
+    Returns a list of (stage, runs, failed, {metric: [percentile values]}).
+    """
+    stages = {}
+    for record in records:
+        stages.setdefault(stage_key(record["stage"]), []).append(record)
+    summary = []
+    for stage, stage_records in stages.items():
+        values = {}
+        for metric in METRICS:
+            metric_values = [metric_value(x, metric) for x in stage_records]
+            values[metric[0]] = [
+                percentile(metric_values, q) for q in percentiles
+            ]
+        failed = sum(1 for x in stage_records if x.get("exit_code"))
+        total = sum(x.get("wall_s") or 0 for x in stage_records)
+        summary.append((total, stage, len(stage_records), failed, values))
+    summary.sort(key=lambda x: (-x[0], x[1]))
+    return [x[1:] for x in summary]
+
+
+def main(args):
+    percentiles = [float(x) for x in args.percentiles.split(",")]
+    if args.location.startswith("gs://"):
+        records = load_gs(args.location, args.project, args.requester_project)
+    else:
+        records = load_local(args.location)
+    if not records:
+        logging.error("No stage records found in " + args.location)
+        return 1
+
+    header = ["stage", "runs", "failed"]
+    for name, _, _ in METRICS:
+        header.extend("{}_p{:g}".format(name, q) for q in percentiles)
+    print("\t".join(header))
+    for stage, runs, failed, values in summarize(records, percentiles):
+        row = [stage, str(runs), str(failed)]
+        for name, _, _ in METRICS:
+            row.extend("{:.2f}".format(x) for x in values[name])
+        print("\t".join(row))
+    return 0
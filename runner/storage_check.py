@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Resolve many Google Cloud Storage paths with a few listing requests
+"""
+
+import logging
+import os
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+# Stop listing a prefix once it returns this many unrelated objects per
+# requested path and stat the requested objects individually instead
+MAX_LISTED_PER_PATH = 50
+MIN_LISTED_LIMIT = 1000
+STAT_THREADS = 16
+LIST_FIELDS = (
+    "items(name,size,generation,crc32c,md5Hash),prefixes,nextPageToken"
+)
+
+
+def split_gs_path(gs_path):
+    if not gs_path or not gs_path.startswith("gs://"):
+        raise ValueError(
+            "'{}' is not a Google Cloud Storage path".format(gs_path)
+        )
+    bucket, _, name = gs_path[5:].partition("/")
+    return bucket, name
+
+
+def read_gs_text(client, gs_path, user_project=None):
+    bucket, name = split_gs_path(gs_path)
+    blob = client.bucket(bucket, user_project=user_project).blob(name)
+    return blob.download_as_string().decode("utf-8")
+
+
+def _blob_stat(blob):
+    return {
+        "size": int(blob.size) if blob.size is not None else None,
+        "generation": blob.generation,
+        "crc32c": blob.crc32c,
+        "md5": blob.md5_hash,
+    }
+
+
+def group_paths(paths):
+    """Group object paths by bucket and parent 'directory'"""
+    groups = {}
+    for path in set(paths):
+        bucket, name = split_gs_path(path)
+        dirname = name.rsplit("/", 1)[0] + "/" if "/" in name else ""
+        groups.setdefault((bucket, dirname), []).append(name)
+    return groups
+
+
+class StorageStat(object):
+    """Existence and metadata of a set of Google Cloud Storage paths
+
+    Paths are grouped by bucket and directory, and each group is resolved
+    with a single (paged) listing of the longest common prefix of its
+    members. Groups are resolved concurrently in a bounded thread pool. A
+    group whose listing is denied or would return too many unrelated
+    objects falls back to concurrent per-object metadata requests.
+    """
+
+    def __init__(self, client, user_project=None, threads=STAT_THREADS):
+        self.client = client
+        self.user_project = user_project
+        self.threads = threads
+        self.stats = {}
+        self.checked = set()
+
+    def _bucket(self, bucket):
+        return self.client.bucket(bucket, user_project=self.user_project)
+
+    def _list_group(self, bucket, dirname, names):
+        prefix = os.path.commonprefix(names)
+        wanted = set(names)
+        limit = max(MIN_LISTED_LIMIT, MAX_LISTED_PER_PATH * len(names))
+        found = {}
+        listed = 0
+        blobs = self._bucket(bucket).list_blobs(
+            prefix=prefix, delimiter="/", fields=LIST_FIELDS
+        )
+        for blob in blobs:
+            listed += 1
+            if blob.name in wanted:
+                found[blob.name] = _blob_stat(blob)
+                if len(found) == len(wanted):
+                    break
+            if listed > limit:
+                return None
+        return found
+
+    def _stat_one(self, bucket, name):
+        blob = self._bucket(bucket).get_blob(name)
+        return _blob_stat(blob) if blob is not None else None
+
+    def _resolve_group(self, group):
+        (bucket, dirname), names = group
+        try:
+            found = self._list_group(bucket, dirname, names)
+        except Exception as err:  # Catch all exceptions
+            logging.info(
+                "Listing gs://{}/{} failed, falling back to per-object "
+                "requests: {}".format(bucket, dirname, err)
+            )
+            found = None
+        if found is not None:
+            return bucket, found, []
+        return bucket, {}, names
+
+    def _resolve_name(self, item):
+        bucket, name = item
+        return bucket, name, self._stat_one(bucket, name)
+
+    def resolve(self, paths):
+        """Look up all paths, returning {gs_path: stat} for existing ones"""
+        todo = [p for p in set(paths) if p not in self.checked]
+        if not todo:
+            return self.stats
+        groups = list(group_paths(todo).items())
+        pool = ThreadPool(min(self.threads, len(groups)))
+        try:
+            results = pool.map(self._resolve_group, groups)
+            fallback = []
+            for bucket, found, remaining in results:
+                for name, stat in found.items():
+                    self.stats["gs://{}/{}".format(bucket, name)] = stat
+                fallback.extend([(bucket, name) for name in remaining])
+            for bucket, name, stat in pool.map(self._resolve_name, fallback):
+                if stat is not None:
+                    self.stats["gs://{}/{}".format(bucket, name)] = stat
+        except Exception as err:  # Catch all exceptions
+            print(
+                "Error polling files in Google Cloud Storage: " + str(err),
+                file=sys.stderr,
+            )
+            raise ValueError(
+                "Error: Could not check files in Google Cloud Storage"
+            )
+        finally:
+            pool.close()
+            pool.join()
+        self.checked.update(todo)
+        return self.stats
+
+    def exists(self, gs_path):
+        return gs_path in self.stats
+
+
+def check_rules(stat, rules):
+    """Evaluate (message, [alternative paths]) rules against resolved paths
+
+    A rule is satisfied if any of its alternatives exists. Returns the
+    messages of all unsatisfied rules.
+    """
+    paths = []
+    for _, alternatives in rules:
+        paths.extend(alternatives)
+    stat.resolve(paths)
+    return [
+        msg
+        for msg, alternatives in rules
+        if not any(stat.exists(p) for p in alternatives)
+    ]
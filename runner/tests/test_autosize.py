@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import unittest
+
+RUNNER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RUNNER_DIR)
+
+from autosize import (  # noqa: E402
+    AUTO,
+    GB,
+    LOCAL_SSD_GB,
+    N1_LOCAL_SSD_COUNTS,
+    choose_resources,
+    local_ssd_counts,
+)
+
+BAM = "gs://reads-bucket/sample/sample.bam"
+FQ1 = "gs://reads-bucket/sample/lane1_1.fastq.gz"
+FQ2 = "gs://reads-bucket/sample/lane1_2.fastq.gz"
+REF = "gs://ref-bucket/hg38/genome.fa"
+
+
+def job(reads_gb, fastq=False, **kwargs):
+    """The job_vars and input stats of a job with reads_gb of reads"""
+    with open(os.path.join(RUNNER_DIR, "runner_default.json")) as f:
+        job_vars = json.load(f)
+    job_vars.update(MACHINE_TYPE=AUTO, DISK_SIZE=AUTO, REF=REF)
+    if fastq:
+        job_vars.update(FQ1=FQ1, FQ2=FQ2)
+        input_stats = {
+            FQ1: {"size": reads_gb * GB / 2},
+            FQ2: {"size": reads_gb * GB / 2},
+        }
+    else:
+        job_vars.update(BAM=BAM)
+        input_stats = {BAM: {"size": reads_gb * GB}}
+    job_vars.update(kwargs)
+    return job_vars, input_stats
+
+
+def chosen(reads_gb, **kwargs):
+    return choose_resources(*job(reads_gb, **kwargs))[0]
+
+
+class TestAutosize(unittest.TestCase):
+    def test_machine_type_rows(self):
+        cases = [
+            ("GERMLINE", "Haplotyper", 10, "n1-highcpu-16"),
+            ("GERMLINE", "Haplotyper", 30, "n1-highcpu-32"),
+            ("GERMLINE", "Haplotyper", 100, "n1-highcpu-64"),
+            # Size rows come before the algo row
+            ("GERMLINE", "DNAscope", 10, "n1-highcpu-16"),
+            ("GERMLINE", "DNAscope", 100, "n1-standard-64"),
+            ("CCDG", "Haplotyper", 40, "n1-highcpu-32"),
+            ("CCDG", "Haplotyper", 41, "n1-highcpu-64"),
+            ("SOMATIC", "TNhaplotyper2", 15, "n1-highcpu-32"),
+            ("SOMATIC", "TNhaplotyper2", 100, "n1-highcpu-64"),
+        ]
+        for pipeline, algo, reads_gb, machine_type in cases:
+            resources = chosen(
+                reads_gb, PIPELINE=pipeline, CALLING_ALGO=algo
+            )
+            self.assertEqual(
+                resources["MACHINE_TYPE"],
+                machine_type,
+                (pipeline, algo, reads_gb),
+            )
+
+    def test_disk_size(self):
+        # 100 GB x 3 + 50 GB of headroom fit in one partition
+        self.assertEqual(chosen(100)["DISK_SIZE"], LOCAL_SSD_GB)
+        # 300 GB x 3 + 50 GB need three partitions
+        self.assertEqual(chosen(300)["DISK_SIZE"], 3 * LOCAL_SSD_GB)
+
+    def test_stream_input(self):
+        # Streamed FASTQ saves one GB of disk per GB of reads
+        self.assertEqual(
+            chosen(300, fastq=True)["DISK_SIZE"], 3 * LOCAL_SSD_GB
+        )
+        self.assertEqual(
+            chosen(300, fastq=True, STREAM_INPUT=True)["DISK_SIZE"],
+            2 * LOCAL_SSD_GB,
+        )
+        # A BAM input is written to the disk either way
+        self.assertEqual(
+            chosen(300, STREAM_INPUT=True)["DISK_SIZE"], 3 * LOCAL_SSD_GB
+        )
+
+    def test_local_ssd_counts(self):
+        self.assertEqual(
+            local_ssd_counts("n1-highcpu-64"), N1_LOCAL_SSD_COUNTS
+        )
+        self.assertEqual(
+            local_ssd_counts("n2-standard-8"), (1, 2, 4, 8, 16, 24)
+        )
+        self.assertEqual(local_ssd_counts("n2-highcpu-32"), (4, 8, 16, 24))
+        self.assertEqual(local_ssd_counts("n2-highmem-128"), (16, 24))
+        self.assertEqual(local_ssd_counts("n2d-standard-96"), (8, 16, 24))
+        self.assertEqual(
+            local_ssd_counts("custom-8-32768"), N1_LOCAL_SSD_COUNTS
+        )
+        self.assertEqual(
+            local_ssd_counts("e2-standard-4"), N1_LOCAL_SSD_COUNTS
+        )
+
+    def test_rounded_to_accepted_counts(self):
+        # Three partitions are needed; n1 accepts 3, n2-32 only 4
+        cases = [
+            ("n1-highcpu-32", 3),
+            ("custom-32-65536", 3),
+            ("n2-highcpu-32", 4),
+            ("n2d-highcpu-32", 4),
+            ("n2-highcpu-96", 16),
+        ]
+        for machine_type, count in cases:
+            resources = chosen(300, MACHINE_TYPE=machine_type)
+            self.assertNotIn("MACHINE_TYPE", resources)
+            self.assertEqual(
+                resources["DISK_SIZE"], count * LOCAL_SSD_GB, machine_type
+            )
+
+    def test_capped(self):
+        # 4000 GB x 3 is more than 24 partitions hold
+        resources, reasons = choose_resources(*job(4000))
+        self.assertEqual(resources["DISK_SIZE"], 24 * LOCAL_SSD_GB)
+        self.assertIn("(capped)", reasons[-1])
+        resources, reasons = choose_resources(*job(100))
+        self.assertNotIn("(capped)", reasons[-1])
+
+    def test_no_matching_row(self):
+        table = [
+            {
+                "pipeline": "GERMLINE",
+                "max_input_gb": 15,
+                "machine_type": "n1-highcpu-16",
+                "disk_factor": 3,
+            },
+            {
+                "pipeline": "GERMLINE",
+                "algo": "DNAscope",
+                "machine_type": "n1-standard-64",
+                "disk_factor": 3,
+            },
+        ]
+        job_vars, input_stats = job(10)
+        self.assertEqual(
+            choose_resources(job_vars, input_stats, table)[0]["MACHINE_TYPE"],
+            "n1-highcpu-16",
+        )
+        job_vars, input_stats = job(100)
+        with self.assertRaises(ValueError):
+            choose_resources(job_vars, input_stats, table)
+        job_vars, input_stats = job(10, PIPELINE="SOMATIC")
+        with self.assertRaises(ValueError):
+            choose_resources(job_vars, input_stats, table)
+
+
+if __name__ == "__main__":
+    unittest.main()
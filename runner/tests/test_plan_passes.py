@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+RUNNER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(RUNNER_DIR), "pipeline_scripts")
+)
+
+from plan_passes import check_spec, fuse, read_spec, releases  # noqa: E402
+
+TABLE = "work/recal_data.table"
+METRICS = (
+    "--algo MeanQualityByCycle mq.txt --algo QualDistribution qd.txt "
+    "--algo GCBias --summary gc_summary.txt gc.txt"
+)
+# The streams and stages of a GERMLINE run with RECALIBRATED_OUTPUT, as
+# written by plan_stream and plan_stage
+GERMLINE = [
+    ("stream", "sorted", "-", "true", "work/sorted.bam"),
+    (
+        "stage",
+        "locus_collector",
+        "Locus collector",
+        "sorted",
+        "-",
+        "-",
+        "--traverse_param=200000/10000",
+        "-",
+        "false",
+        "--algo LocusCollector work/score.txt",
+        "save_checkpoint score work/score.txt",
+    ),
+    (
+        "stage",
+        "dedup",
+        "Dedup",
+        "sorted",
+        "-",
+        "-",
+        "--traverse_param=200000/10000",
+        "locus_collector",
+        "false",
+        "--algo Dedup --score_info work/score.txt work/dedup.bam",
+        "dedup_finished",
+    ),
+    ("stream", "deduped", "dedup", "true", "work/dedup.bam"),
+    (
+        "stage",
+        "metrics",
+        "Metrics collection",
+        "deduped,sorted",
+        "*",
+        "*",
+        "*",
+        "-",
+        "false",
+        METRICS,
+        "metrics_finished",
+    ),
+    (
+        "stage",
+        "qualcal",
+        "BQSR",
+        "deduped",
+        "-",
+        "-",
+        "-",
+        "-",
+        "false",
+        "--algo QualCal -k sites.vcf " + TABLE,
+        "-",
+    ),
+    (
+        "stage",
+        "qualcal_post",
+        "BQSR post",
+        "deduped",
+        TABLE,
+        "*",
+        "*",
+        "qualcal",
+        "false",
+        "--algo QualCal -k sites.vcf " + TABLE + ".post",
+        "-",
+    ),
+    (
+        "stage",
+        "read_writer",
+        "ReadWriter",
+        "deduped",
+        TABLE,
+        "-",
+        "-",
+        "qualcal",
+        "true",
+        "--algo ReadWriter work/recalibrated.bam",
+        "-",
+    ),
+    (
+        "stage",
+        "calling",
+        "Variant calling",
+        "deduped",
+        TABLE,
+        "ref_nondecoy.bed",
+        "-",
+        "qualcal",
+        "false",
+        "--algo Haplotyper work/hc.vcf.gz",
+        "calling_finished",
+    ),
+]
+
+
+class TestPlanPasses(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def plan(self, lines):
+        path = os.path.join(self.tmp_dir, "plan_spec.tsv")
+        with open(path, "w") as f:
+            for fields in lines:
+                f.write("\t".join(fields) + "\n")
+        streams, stages = read_spec(path)
+        check_spec(streams, stages)
+        return streams, stages
+
+    def test_germline_passes(self):
+        streams, stages = self.plan(GERMLINE)
+        passes = fuse(streams, stages)
+        self.assertEqual(
+            [
+                (
+                    p["stream"],
+                    [x["name"] for x in p["stages"]],
+                    p["background"],
+                )
+                for p in passes
+            ],
+            [
+                ("sorted", ["locus_collector", "metrics"], False),
+                ("sorted", ["dedup"], False),
+                ("deduped", ["qualcal"], False),
+                ("deduped", ["read_writer"], True),
+                ("deduped", ["qualcal_post", "calling"], False),
+            ],
+        )
+        # The fused pass takes the settings of its stages
+        self.assertEqual(passes[0]["options"], "--traverse_param=200000/10000")
+        self.assertEqual(passes[4]["table"], TABLE)
+        self.assertEqual(passes[4]["interval"], "ref_nondecoy.bed")
+
+    def test_sorted_released_after_dedup(self):
+        streams, stages = self.plan(GERMLINE)
+        passes = fuse(streams, stages)
+        after = releases(passes, streams)
+        dedup = [
+            i
+            for i, p in enumerate(passes)
+            if "dedup" in [x["name"] for x in p["stages"]]
+        ][0]
+        for i, paths in enumerate(after):
+            if i == dedup:
+                self.assertEqual(paths, ["work/sorted.bam"])
+            else:
+                self.assertNotIn("work/sorted.bam", paths)
+
+    def test_background_reads_kept(self):
+        # The deduped BAM is last read by the ReadWriter pass in the
+        # background, so it is never released
+        streams, stages = self.plan(GERMLINE)
+        after = releases(fuse(streams, stages), streams)
+        self.assertNotIn("work/dedup.bam", sum(after, []))
+
+        # Without the background pass, it is released after the last pass
+        no_writer = [x for x in GERMLINE if x[1] != "read_writer"]
+        streams, stages = self.plan(no_writer)
+        after = releases(fuse(streams, stages), streams)
+        self.assertEqual(after[-1], ["work/dedup.bam"])
+
+    def test_kept_streams(self):
+        # Streams that are not temporary, such as an input BAM, are kept
+        lines = list(GERMLINE)
+        lines[0] = ("stream", "sorted", "-", "false", "work/sorted.bam")
+        streams, stages = self.plan(lines)
+        after = releases(fuse(streams, stages), streams)
+        self.assertNotIn("work/sorted.bam", sum(after, []))
+
+    def test_out_of_order_spec(self):
+        # A stage reading the deduped BAM before Dedup is declared
+        lines = [GERMLINE[0], GERMLINE[3], GERMLINE[5]] + GERMLINE[1:3]
+        with self.assertRaises(ValueError) as raised:
+            self.plan(lines)
+        self.assertIn(
+            "reads deduped before it is written", str(raised.exception)
+        )
+
+        # A stage declared before a stage it needs
+        lines = [GERMLINE[0], GERMLINE[2], GERMLINE[1]]
+        with self.assertRaises(ValueError) as raised:
+            self.plan(lines)
+        self.assertIn("comes before locus_collector", str(raised.exception))
+
+    def test_skipped_stages(self):
+        # Stages completed by an earlier attempt are left out of the spec,
+        # and the stages needing them still plan
+        lines = [GERMLINE[3]] + GERMLINE[5:]
+        streams, stages = self.plan(lines)
+        self.assertEqual(streams["deduped"]["producers"], [])
+        passes = fuse(streams, stages)
+        self.assertEqual(len(passes), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import unittest
+
+RUNNER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RUNNER_DIR)
+
+import sentieon_runner as runner  # noqa: E402
+
+from storage_check import (  # noqa: E402
+    MAX_LISTED_PER_PATH,
+    MIN_LISTED_LIMIT,
+    StorageStat,
+    check_rules,
+)
+
+REF = "gs://ref-bucket/hg38/genome.fa"
+REF_FILES = [
+    REF,
+    REF + ".fai",
+    "gs://ref-bucket/hg38/genome.dict",
+    REF + ".amb",
+    REF + ".ann",
+    REF + ".bwt",
+    REF + ".pac",
+    REF + ".sa",
+]
+SITES = [
+    "gs://ref-bucket/sites/dbsnp.vcf.gz",
+    "gs://ref-bucket/sites/dbsnp.vcf.gz.tbi",
+    "gs://ref-bucket/sites/mills.vcf",
+    "gs://ref-bucket/sites/mills.vcf.idx",
+]
+
+
+class FakeBlob(object):
+    def __init__(self, name):
+        self.name = name
+        self.size = len(name)
+        self.generation = 1
+        self.crc32c = "AAAAAA=="
+        self.md5_hash = "AAAAAAAAAAAAAAAAAAAAAA=="
+
+
+class FakeBucket(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def names(self):
+        prefix = "gs://{}/".format(self.name)
+        return sorted(
+            x[len(prefix) :]
+            for x in self.client.objects
+            if x.startswith(prefix)
+        )
+
+    def list_blobs(self, prefix="", delimiter=None, fields=None):
+        self.client.calls["list_blobs"] += 1
+        if self.client.deny_list:
+            raise Exception("403 storage.objects.list denied")
+        for name in self.names():
+            if not name.startswith(prefix):
+                continue
+            if delimiter and delimiter in name[len(prefix) :]:
+                continue
+            yield FakeBlob(name)
+
+    def get_blob(self, name):
+        self.client.calls["get_blob"] += 1
+        path = "gs://{}/{}".format(self.name, name)
+        return FakeBlob(name) if path in self.client.objects else None
+
+
+class FakeClient(object):
+    """A storage client over a set of object paths, counting requests"""
+
+    def __init__(self, objects, deny_list=False):
+        self.objects = set(objects)
+        self.deny_list = deny_list
+        self.calls = {"list_blobs": 0, "get_blob": 0}
+
+    def bucket(self, name, user_project=None):
+        return FakeBucket(self, name)
+
+
+def fastq_job(lanes):
+    fastq = "gs://reads-bucket/sample/lane{}_{}.fastq.gz"
+    with open(os.path.join(RUNNER_DIR, "runner_default.json")) as f:
+        job_vars = json.load(f)
+    job_vars.update(
+        REF=REF,
+        FQ1=",".join(fastq.format(x, 1) for x in range(lanes)),
+        FQ2=",".join(fastq.format(x, 2) for x in range(lanes)),
+        BQSR_SITES=SITES[0] + "," + SITES[2],
+        DBSNP=SITES[0],
+    )
+    reads = job_vars["FQ1"].split(",") + job_vars["FQ2"].split(",")
+    return job_vars, reads
+
+
+def check_job(job_vars, objects, **kwargs):
+    client = FakeClient(objects, **kwargs)
+    missing = check_rules(StorageStat(client), runner._input_rules(job_vars))
+    return missing, client.calls
+
+
+class TestStorageCheck(unittest.TestCase):
+    def test_calls_grow_with_directories(self):
+        # The reads, the reference and the sites are in three directories
+        for lanes in (1, 8, 64):
+            job_vars, reads = fastq_job(lanes)
+            missing, calls = check_job(job_vars, reads + REF_FILES + SITES)
+            self.assertEqual(missing, [])
+            self.assertEqual(calls, {"list_blobs": 3, "get_blob": 0})
+
+    def test_missing_files(self):
+        job_vars, reads = fastq_job(8)
+        objects = set(reads + REF_FILES + SITES)
+        objects -= set([reads[3], SITES[1], REF + ".bwt"])
+        missing, calls = check_job(job_vars, objects)
+        # dbsnp is both a BQSR_SITES and the DBSNP file
+        self.assertEqual(
+            set(missing),
+            set(
+                [
+                    "Could not find the supplied file " + reads[3],
+                    "Could not find index for file " + SITES[0],
+                    "Reference BWA index .bwt not found",
+                ]
+            ),
+        )
+        self.assertEqual(calls, {"list_blobs": 3, "get_blob": 0})
+
+    def test_listing_denied(self):
+        job_vars, reads = fastq_job(8)
+        rules = runner._input_rules(job_vars)
+        paths = set(p for _, alternatives in rules for p in alternatives)
+        missing, calls = check_job(
+            job_vars, reads + REF_FILES + SITES, deny_list=True
+        )
+        self.assertEqual(missing, [])
+        self.assertEqual(calls["list_blobs"], 3)
+        self.assertEqual(calls["get_blob"], len(paths))
+
+    def test_too_many_listed_objects(self):
+        # Unrelated objects sorted before the reads in their directory
+        job_vars, reads = fastq_job(8)
+        limit = max(MIN_LISTED_LIMIT, MAX_LISTED_PER_PATH * len(reads))
+        others = [
+            "gs://reads-bucket/sample/lane{:05d}.txt".format(x)
+            for x in range(limit + 1)
+        ]
+        missing, calls = check_job(
+            job_vars, reads + REF_FILES + SITES + others
+        )
+        self.assertEqual(missing, [])
+        self.assertEqual(calls["list_blobs"], 3)
+        self.assertEqual(calls["get_blob"], len(reads))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Break the time of Lifesciences operations down into platform phases
+"""
+
+import json
+import logging
+
+from polling import (
+    CLEANUP_ACTION,
+    RUN_ACTION,
+    event_time,
+    operation_events,
+    parse_timestamp,
+)
+
+PHASES = (
+    "queued",
+    "provisioning",
+    "image_pull",
+    "startup",
+    "run_action",
+    "between_actions",
+    "cleanup_action",
+    "teardown",
+)
+TIMELINE_JSON = "worker_logs/timeline.json"
+
+
+def _first_time(events, key):
+    for t, event in events:
+        if key in event:
+            return t
+    return None
+
+
+def attempt_timeline(operation):
+    """The seconds an operation spent in each phase
+
+    Each phase lasts from its starting event to the next recorded event,
+    so the time of a phase whose event is missing is counted in the phase
+    before it.
+    """
+    metadata = operation.get("metadata", {})
+    events = operation_events(operation)
+    created = metadata.get("createTime")
+    created = parse_timestamp(created) if created else None
+    run_started = event_time(events, "containerStarted", RUN_ACTION)
+    pull_stopped = None
+    for t, event in events:
+        if "pullStopped" in event and (
+            run_started is None or t <= run_started
+        ):
+            pull_stopped = t
+    checkpoints = [
+        ("queued", created),
+        ("provisioning", _first_time(events, "workerAssigned")),
+        ("image_pull", _first_time(events, "pullStarted")),
+        ("startup", pull_stopped),
+        ("run_action", run_started),
+        (
+            "between_actions",
+            event_time(events, "containerStopped", RUN_ACTION),
+        ),
+        (
+            "cleanup_action",
+            event_time(events, "containerStarted", CLEANUP_ACTION),
+        ),
+        (
+            "teardown",
+            event_time(events, "containerStopped", CLEANUP_ACTION),
+        ),
+    ]
+    marks = []
+    for phase, t in checkpoints:
+        if t is not None and (not marks or t >= marks[-1][1]):
+            marks.append((phase, t))
+    end = metadata.get("endTime")
+    if end:
+        end = parse_timestamp(end)
+    elif events:
+        end = events[-1][0]
+    if marks and (end is None or end < marks[-1][1]):
+        end = marks[-1][1]
+
+    phases = dict((phase, 0.0) for phase in PHASES)
+    for (phase, t), (_, t_next) in zip(marks, marks[1:] + [(None, end)]):
+        phases[phase] += t_next - t
+    return {
+        "operation": operation.get("name"),
+        "succeeded": bool(operation.get("done")) and "error" not in operation,
+        "preempted": False,
+        "start": marks[0][1] if marks else None,
+        "end": end,
+        "phases": phases,
+    }
+
+
+def summarize_timeline(attempts):
+    """Totals over all attempts of a job, including time lost to
+    preemption and to relaunching after it"""
+    phases = dict((phase, 0.0) for phase in PHASES)
+    preempted = 0.0
+    relaunch = 0.0
+    previous_end = None
+    for attempt in attempts:
+        duration = sum(attempt["phases"].values())
+        if attempt["preempted"]:
+            preempted += duration
+        else:
+            for phase in PHASES:
+                phases[phase] += attempt["phases"][phase]
+        if previous_end is not None and attempt["start"] is not None:
+            relaunch += max(0.0, attempt["start"] - previous_end)
+        previous_end = attempt["end"] or previous_end
+    starts = [x["start"] for x in attempts if x["start"] is not None]
+    ends = [x["end"] for x in attempts if x["end"] is not None]
+    total = max(ends) - min(starts) if starts and ends else 0.0
+    return {
+        "attempts": attempts,
+        "phases": phases,
+        "preempted_s": preempted,
+        "relaunch_s": relaunch,
+        "pipeline_s": phases["run_action"],
+        "overhead_s": total - phases["run_action"],
+        "total_s": total,
+    }
+
+
+def _minutes(seconds):
+    return "{:.1f}".format(seconds / 60.0)
+
+
+def format_timeline(summary):
+    """A table of the minutes spent in each phase of each attempt"""
+    header = ["attempt"] + list(PHASES) + ["total"]
+    rows = []
+    for i, attempt in enumerate(summary["attempts"]):
+        label = str(i + 1)
+        if attempt["preempted"]:
+            label += " (preempted)"
+        elif not attempt["succeeded"]:
+            label += " (failed)"
+        phases = attempt["phases"]
+        rows.append(
+            [label]
+            + [_minutes(phases[x]) for x in PHASES]
+            + [_minutes(sum(phases.values()))]
+        )
+    widths = [
+        max(len(x[i]) for x in [header] + rows) for i in range(len(header))
+    ]
+    lines = [
+        "  ".join(x.rjust(w) for x, w in zip(row, widths))
+        for row in [header] + rows
+    ]
+    lines.append(
+        "Minutes in the pipeline: {}, platform overhead: {}, lost to "
+        "preemption: {}, relaunching: {}, total: {}".format(
+            _minutes(summary["pipeline_s"]),
+            _minutes(summary["overhead_s"]),
+            _minutes(summary["preempted_s"]),
+            _minutes(summary["relaunch_s"]),
+            _minutes(summary["total_s"]),
+        )
+    )
+    return "\n".join(lines)
+
+
+def write_timeline(summary, job_vars, credentials, user_project=None):
+    """Write the timeline summary as JSON with the job outputs"""
+    from google.cloud import storage
+    from storage_check import split_gs_path
+
+    gs_path = "{}/{}".format(job_vars["OUTPUT_BUCKET"], TIMELINE_JSON)
+    try:
+        client = storage.Client(
+            project=job_vars["PROJECT_ID"], credentials=credentials
+        )
+        bucket, name = split_gs_path(gs_path)
+        blob = client.bucket(bucket, user_project=user_project).blob(name)
+        blob.upload_from_string(
+            json.dumps(summary, indent=2, sort_keys=True),
+            content_type="application/json",
+        )
+    except Exception as err:  # Catch all exceptions
+        logging.warning("Could not write {}: {}".format(gs_path, err))
+
+
+def report_timeline(attempts, job_vars, credentials, user_project=None):
+    """Print the timeline of a job's attempts and write it as JSON"""
+    if not attempts:
+        return
+    summary = summarize_timeline(attempts)
+    print(format_timeline(summary))
+    write_timeline(summary, job_vars, credentials, user_project)
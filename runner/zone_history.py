@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+r"""
+Choose the zones of a launch from the outcomes of earlier attempts
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from timeline import attempt_timeline
+
+DAY = 24 * 60 * 60
+MAX_OBSERVATIONS = 5000
+# A zone counts as having this many attempts with the average outcome of
+# all zones, so zones with little or stale history are still tried
+PRIOR_WEIGHT = 1.0
+# Zones expected to take this much longer than the best zone are dropped
+SLACK = 0.25
+MAX_PREEMPTION_RATE = 0.9
+
+
+def _weighted_mean(pairs, prior, prior_weight=PRIOR_WEIGHT):
+    total = sum(w for w, _ in pairs) + prior_weight
+    return (sum(w * x for w, x in pairs) + prior_weight * prior) / total
+
+
+def zone_stats(observations, half_life_days, now=None):
+    """The time to a worker, run time and preemption rate of each zone
+
+    Observations are weighted by their age, halving every
+    `half_life_days`, and blended with the average of all zones.
+    """
+    now = now or time.time()
+    weighted = []
+    for obs in observations:
+        age = max(0, now - obs["time"]) / (float(half_life_days) * DAY)
+        weighted.append((0.5 ** age, obs))
+
+    def values(key, zone=None, preemptible_only=False):
+        return [
+            (w, float(obs[key]))
+            for w, obs in weighted
+            if obs[key] is not None
+            and (zone is None or obs["zone"] == zone)
+            and (obs["preemptible"] or not preemptible_only)
+        ]
+
+    overall = {}
+    for key, preemptible_only in (
+        ("assign_s", False),
+        ("run_s", False),
+        ("preempted", True),
+    ):
+        pairs = values(key, preemptible_only=preemptible_only)
+        overall[key] = _weighted_mean(pairs, 0.0, 0) if pairs else 0.0
+
+    stats = {}
+    for zone in set(obs["zone"] for obs in observations):
+        stats[zone] = {
+            "assign_s": _weighted_mean(
+                values("assign_s", zone), overall["assign_s"]
+            ),
+            "run_s": _weighted_mean(values("run_s", zone), overall["run_s"]),
+            "preemption_rate": _weighted_mean(
+                values("preempted", zone, True), overall["preempted"]
+            ),
+        }
+    default = {
+        "assign_s": overall["assign_s"],
+        "run_s": overall["run_s"],
+        "preemption_rate": overall["preempted"],
+    }
+    return stats, default
+
+
+def expected_seconds(stats, preemptible):
+    """The expected time from launch to completion in a zone
+
+    Every preempted attempt waits for a worker again and loses half a run
+    on average.
+    """
+    rate = stats["preemption_rate"] if preemptible else 0.0
+    rate = min(rate, MAX_PREEMPTION_RATE)
+    run = stats["run_s"]
+    return (stats["assign_s"] + rate * run / 2.0) / (1 - rate) + run
+
+
+def rank_zones(zones, observations, preemptible, half_life_days, now=None):
+    """The zones ordered by the expected time to complete, without the
+    ones expected to take much longer than the best"""
+    if not observations:
+        return list(zones)
+    stats, default = zone_stats(observations, half_life_days, now)
+    expected = dict(
+        (zone, expected_seconds(stats.get(zone, default), preemptible))
+        for zone in zones
+    )
+    ranked = sorted(zones, key=lambda x: expected[x])
+    limit = expected[ranked[0]] * (1 + SLACK)
+    return [x for x in ranked if expected[x] <= limit]
+
+
+class ZoneHistory(object):
+    """The outcomes of earlier attempts in each zone, kept in a local json
+    file"""
+
+    def __init__(self, path, half_life_days=7, clock=time.time):
+        self.path = path
+        self.half_life_days = half_life_days
+        self.clock = clock
+        self.cached = (None, [])
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            # Only parse the file again after another writer changed it
+            st = os.stat(self.path)
+            key = (st.st_mtime, st.st_size, st.st_ino)
+            if self.cached[0] != key:
+                with open(self.path) as f:
+                    self.cached = (key, json.load(f)["observations"])
+            return list(self.cached[1])
+        except (IOError, OSError, ValueError, KeyError) as err:
+            logging.warning(
+                "Ignoring the zone history {}: {}".format(self.path, err)
+            )
+            return []
+
+    def _write(self, observations):
+        """Replace the history file with `observations`
+
+        Each writer renames its own temporary file over the history, so
+        the file is never partly written. Writers are not serialized: the
+        last writer wins, and observations recorded by another runner
+        between its read and write are lost.
+        """
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix=os.path.basename(self.path) + ".",
+            suffix=".tmp",
+        )
+        # Readable by others, like a file written with open()
+        os.chmod(tmp, 0o644)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"observations": observations}, f, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def observations(self):
+        return self._read()
+
+    def choose(self, zones, preemptible):
+        chosen = rank_zones(
+            zones,
+            self._read(),
+            preemptible,
+            self.half_life_days,
+            self.clock(),
+        )
+        if chosen != list(zones):
+            logging.info("Launching in zones " + ",".join(chosen))
+        return chosen
+
+    def record(self, zone, operation, preempted, preemptible):
+        """Add the outcome of an attempt that ran in a zone"""
+        timeline = attempt_timeline(operation)
+        total = sum(timeline["phases"].values())
+        observation = {
+            "zone": zone,
+            "time": timeline["end"] or self.clock(),
+            "assign_s": timeline["phases"]["queued"],
+            "run_s": total - timeline["phases"]["queued"]
+            if timeline["succeeded"]
+            else None,
+            "preempted": 1 if preempted else 0,
+            "preemptible": bool(preemptible),
+        }
+        observations = self._read()
+        observations.append(observation)
+        try:
+            self._write(observations[-MAX_OBSERVATIONS:])
+        except (IOError, OSError) as err:
+            logging.warning(
+                "Could not write the zone history {}: {}".format(
+                    self.path, err
+                )
+            )